@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import socket
+import asyncio
+import threading
+import time
+from datetime import datetime
+import db
+from event_loop import get_event_loop, DatagramProtocol
+
+# Push-based change notification.
+#
+#   python change_relay.py                  relay on KPIT_RELAY_PORT
+#   python change_relay.py --interval 0.02  poll signals_log every 20 ms
+#
+# One relay process follows signals_log with a db.ChangeFeed and pushes
+# every new row to the subscribed panels over UDP. Panels see a change
+# within one relay interval, and the database sees a single poller however
+# many panels run. Panels keep polling, slowly, as a fallback and switch
+# back to their normal interval as soon as the relay goes quiet.
+#
+# Messages are JSON datagrams:
+#   panel -> relay   {'type': 'subscribe'}        renewed every SUBSCRIBE_INTERVAL
+#                    {'type': 'unsubscribe'}
+#   relay -> panel   {'type': 'changes', 'after_id': n, 'last_id': m, 'rows': [...]}
+#                    {'type': 'relay_heartbeat', 'last_id': m}
+# after_id chains each message to the previous one, so a panel that missed
+# a datagram notices and re-reads the database once.
+#
+# Both ends are asyncio datagram endpoints. Panels run theirs on the shared
+# loop of event_loop.py, next to SocketManager; the relay runs its own loop,
+# since its database polls block.
+
+# Where panels look for the relay; an empty KPIT_RELAY_HOST turns it off
+RELAY_HOST = os.environ.get('KPIT_RELAY_HOST', '127.0.0.1')
+RELAY_PORT = int(os.environ.get('KPIT_RELAY_PORT', '65440'))
+POLL_INTERVAL = 0.05       # Seconds between signals_log polls in the relay
+HEARTBEAT_INTERVAL = 1.0   # Relay heartbeat while nothing changes
+SUBSCRIBE_INTERVAL = 2.0   # Panels renew their subscription this often
+SUBSCRIBER_TTL = 3 * SUBSCRIBE_INTERVAL
+RELAY_TIMEOUT = 3 * HEARTBEAT_INTERVAL  # Relay counts as gone after this much silence
+ROWS_PER_MESSAGE = 40      # Keeps each datagram well under 8 KB
+MAX_DATAGRAM = 65535
+
+def encode_message(message):
+    return json.dumps(message, default=lambda value: value.isoformat(sep=' ')).encode()
+
+class ChangeRelay:
+    """Follows signals_log and pushes new rows to UDP subscribers"""
+    def __init__(self, host='0.0.0.0', port=RELAY_PORT, interval=POLL_INTERVAL):
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.running = False
+        self.thread = None
+        self.socket = None
+        self.transport = None
+        self.feed = db.ChangeFeed()
+        self.subscribers = {}  # (host, port) -> last subscribe time
+        self.stats = {'polls': 0, 'rows': 0, 'messages': 0, 'send_errors': 0}
+        self._last_sent = 0.0
+
+    def start(self):
+        """Serve from a daemon thread. Returns False if the port cannot be bound"""
+        if self.running:
+            return True
+        if not self.bind():
+            return False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return True
+
+    def serve_forever(self):
+        """Serve on the calling thread until stop()"""
+        if not self.running and not self.bind():
+            return
+        self._run()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+        if self.socket and not self.transport:
+            self.socket.close()  # Bound but never served
+            self.socket = None
+
+    def bind(self):
+        """Open the relay socket. Returns False if the port is taken"""
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
+            self.port = self.socket.getsockname()[1]
+        except OSError as e:
+            print(f"❌ Change relay cannot bind {self.host}:{self.port}: {e}")
+            self.socket = None
+            return False
+        self.running = True
+        return True
+
+    def _run(self):
+        """Run the relay on an event loop of its own until stop()"""
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            loop.close()
+
+    async def _serve(self):
+        """Answer subscribers as datagrams arrive and poll every interval"""
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self._handle_datagram), sock=self.socket
+        )
+        try:
+            while self.running:
+                next_poll = loop.time() + self.interval
+                self._expire_subscribers()
+                if self.subscribers:
+                    self._poll()
+                await asyncio.sleep(max(0.0, next_poll - loop.time()))
+        finally:
+            self.transport.close()
+            self.transport = None
+            self.socket = None
+
+    def _handle_datagram(self, data, addr):
+        try:
+            message = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        self._handle_message(message, addr)
+
+    def _handle_message(self, message, addr):
+        if message.get('type') == 'subscribe':
+            new = addr not in self.subscribers
+            self.subscribers[addr] = time.monotonic()
+            if new:
+                print(f"Panel subscribed: {addr[0]}:{addr[1]}")
+                # Tell the panel where the feed stands right away
+                if self.feed.last_id is None:
+                    self.feed.seek_latest()
+                self._send(addr, {'type': 'relay_heartbeat', 'last_id': self.feed.last_id})
+        elif message.get('type') == 'unsubscribe':
+            self.subscribers.pop(addr, None)
+
+    def _expire_subscribers(self):
+        deadline = time.monotonic() - SUBSCRIBER_TTL
+        for addr, seen in list(self.subscribers.items()):
+            if seen < deadline:
+                del self.subscribers[addr]
+                print(f"Panel subscription expired: {addr[0]}:{addr[1]}")
+
+    def _poll(self):
+        """Push rows added since the last poll. Returns them, or None if the database is unavailable"""
+        after_id = self.feed.last_id
+        rows = self.feed.poll()
+        self.stats['polls'] += 1
+        if rows:
+            self.stats['rows'] += len(rows)
+            self._push_rows(after_id, rows)
+        elif time.monotonic() - self._last_sent >= HEARTBEAT_INTERVAL:
+            self._heartbeat()
+        return rows
+
+    def _push_rows(self, after_id, rows, targets=None):
+        for i in range(0, len(rows), ROWS_PER_MESSAGE):
+            chunk = rows[i:i + ROWS_PER_MESSAGE]
+            # A row committed late has a lower id than the feed already passed
+            last_id = chunk[-1]['id'] if after_id is None else max(after_id, chunk[-1]['id'])
+            self._broadcast({'type': 'changes', 'after_id': after_id, 'last_id': last_id, 'rows': chunk}, targets)
+            after_id = last_id
+
+    def _heartbeat(self, targets=None):
+        self._broadcast({'type': 'relay_heartbeat', 'last_id': self.feed.last_id}, targets)
+
+    def _broadcast(self, message, targets=None):
+        """Send `message` to `targets` (default: every subscriber)"""
+        data = encode_message(message)
+        for addr in list(self.subscribers if targets is None else targets):
+            self._send(addr, data)
+        self._last_sent = time.monotonic()
+
+    def _send(self, addr, message):
+        data = message if isinstance(message, bytes) else encode_message(message)
+        try:
+            # On the socket itself: transport.sendto() would not report errors here
+            self.socket.sendto(data, addr)
+            self.stats['messages'] += 1
+        except BlockingIOError:
+            self.transport.sendto(data, addr)  # Send buffer full: the transport queues it
+            self.stats['messages'] += 1
+        except OSError as e:
+            self.stats['send_errors'] += 1
+            print(f"Error sending to {addr[0]}:{addr[1]}: {e}")
+
+class RelayClient:
+    """Panel side of the relay: keeps a subscription alive and hands over pushed rows.
+
+    on_changes(rows) gets lists of row dicts as returned by db.get_changes().
+    on_status(connected) is called when the relay appears or goes quiet.
+    on_gap() is called when pushed rows were lost; the caller should read
+    the database once. All callbacks run on the shared event loop thread.
+    """
+    def __init__(self, on_changes, on_status=None, on_gap=None, host=RELAY_HOST, port=RELAY_PORT):
+        self.on_changes = on_changes
+        self.on_status = on_status
+        self.on_gap = on_gap
+        self.relay = (host, port)
+        self.subscribe_message = {'type': 'subscribe'}
+        self.running = False
+        self.connected = False
+        self.last_id = None
+        self.loop = None
+        self.socket = None
+        self.transport = None
+        self.task = None
+        self._relay_addr = None  # self.relay with the host resolved
+        self._last_heard = 0.0
+
+    def start(self):
+        if self.running or not self.relay[0]:
+            return
+        self.loop = get_event_loop()
+        try:
+            asyncio.run_coroutine_threadsafe(self._open(), self.loop).result(timeout=2)
+            self.running = True
+        except Exception as e:
+            print(f"Failed to start relay client: {e}")
+
+    async def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', 0))
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self._on_datagram), sock=sock
+        )
+        self.socket = sock
+        self.task = self.loop.create_task(self._subscribe_loop())
+
+    def stop(self):
+        """Unsubscribe and close. Returns at once; the event loop does the closing"""
+        if not self.running:
+            return
+        self.running = False
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self._send_now(encode_message({'type': 'unsubscribe'}))
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.transport:
+            self.transport.close()
+        self.transport = None
+        self.socket = None
+
+    async def _subscribe_loop(self):
+        """Renew the subscription and notice when the relay goes quiet"""
+        next_subscribe = 0.0
+        while True:
+            now = time.monotonic()
+            if now >= next_subscribe:
+                if self._relay_addr is None:
+                    await self._resolve_relay()
+                self._send_now(encode_message(self.subscribe_message))
+                next_subscribe = now + SUBSCRIBE_INTERVAL
+            if self.connected and now - self._last_heard > RELAY_TIMEOUT:
+                self._set_connected(False)
+            await asyncio.sleep(min(next_subscribe - now, RELAY_TIMEOUT))
+
+    async def _resolve_relay(self):
+        # Off the loop thread, so a slow resolver cannot stall other sockets
+        try:
+            infos = await self.loop.getaddrinfo(*self.relay, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            self._relay_addr = infos[0][4]
+        except OSError:
+            pass  # Relay host unknown for now; keep trying
+
+    def _send(self, message):
+        """Send `message` to the relay from any thread"""
+        if self.running:
+            self.loop.call_soon_threadsafe(self._send_now, encode_message(message))
+
+    def _send_now(self, data):
+        if not self.transport or self._relay_addr is None:
+            return
+        try:
+            self.socket.sendto(data, self._relay_addr)
+        except OSError:
+            pass  # Relay host unreachable; keep trying
+
+    def _on_datagram(self, data, addr):
+        if addr[1] == self.relay[1]:
+            self._handle(data)
+
+    def _handle(self, data):
+        try:
+            message = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        self._last_heard = time.monotonic()
+        self._handle_message(message)
+        if not self.connected:
+            self._set_connected(True)
+
+    def _handle_message(self, message):
+        if message.get('type') == 'changes':
+            if self.last_id is not None and message['after_id'] != self.last_id:
+                self._gap()
+            self.last_id = message['last_id']
+            rows = message['rows']
+            for row in rows:
+                row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            self.on_changes(rows)
+        elif message.get('type') == 'relay_heartbeat':
+            last_id = message.get('last_id')
+            if self.last_id is not None and last_id is not None and last_id > self.last_id:
+                self._gap()
+            if last_id is not None:
+                self.last_id = last_id
+
+    def _gap(self):
+        if self.on_gap:
+            self.on_gap()
+
+    def _set_connected(self, connected):
+        self.connected = connected
+        if not connected:
+            self.last_id = None  # Start a fresh chain when the relay comes back
+        if self.on_status:
+            self.on_status(connected)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    port = int(args[args.index('--port') + 1]) if '--port' in args else RELAY_PORT
+    interval = float(args[args.index('--interval') + 1]) if '--interval' in args else POLL_INTERVAL
+    if not db.wait_until_ready(timeout=30):
+        print("❌ Database did not become reachable")
+        raise SystemExit(1)
+    relay = ChangeRelay(port=port, interval=interval)
+    if not relay.bind():
+        raise SystemExit(1)
+    print(f"✅ Change relay listening on UDP {port}, polling every {interval * 1000:.0f} ms")
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        relay.stop()
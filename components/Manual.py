@@ -15,11 +15,58 @@ from PyQt5.QtGui import (
     QRadialGradient, QLinearGradient, QFont, QPixmap
 )
 import db
+from state_hub import HubClient
 from .socket_manager import SocketManager
 from .LampControl import LampControl
 from .ControlButtons import ControlButton
+from .db_worker import DbWorker
+
+# Database poll interval (ms), and the fallback interval while change_relay.py pushes changes
+POLL_INTERVAL = 1000
+RELAY_POLL_INTERVAL = 15000
+SNAPSHOT_WAIT = 300  # ms to collect peer snapshots before picking the freshest
+KEYFRAME_INTERVAL = 5000  # ms between full state updates; the ones between carry changes only
+
+# --- Database calls (run on the DbWorker thread) ---
+def _check_connection():
+    """Check that the database answers and replay writes journaled while offline"""
+    # A validated connection has just made its round trip to the server
+    conn = db.get_connection(validate=True)
+    if not conn:
+        return False
+    conn.close()
+    db.replay_journal()
+    return True
+
+def _fetch_signal_states():
+    """Read the active PWF state and the latest CAN/LIN signals.
+
+    Returns None when no connection is available.
+    """
+    # Read our own queued writes back, not the state from before them
+    db.flush_writes()
+    snapshot = db.get_state_snapshot()
+    if snapshot is None:
+        return None
+    signals = snapshot['signals']
+    return {
+        'pwf_state': snapshot['pwf_state'],
+        'pwf_version': snapshot['pwf_version'],
+        'change_id': snapshot['change_id'],
+        'led': signals.get(('led', 'CAN')),
+        'button': signals.get(('button', 'CAN')),
+        'ledL': signals.get(('ledL', 'LIN')),
+        'buttonL': signals.get(('buttonL', 'LIN')),
+    }
 
 class ManualWindow(QWidget):
+    database_ready = pyqtSignal()
+    relay_changes = pyqtSignal(list)
+    relay_status = pyqtSignal(bool)
+    relay_gap = pyqtSignal()
+    hub_state = pyqtSignal(dict, bool)
+    hub_peer_update = pyqtSignal(dict)
+
     def __init__(self, parent=None):
         super().__init__(parent)
         print("Initializing ManualWindow")
@@ -28,26 +75,77 @@ class ManualWindow(QWidget):
         
         # Initialize states
         self.current_pwf_state = None
+        self.pwf_version = None  # Version of current_pwf_state, for conditional transitions
+        self.change_id = None  # Newest signals_log id the shown state includes
+        self.db_online = False
         self.protocol = 'CAN'  # Default protocol
         self.last_db_change = None
 
+        # Sequenced state updates. The epoch is the start time, so a restarted
+        # panel's updates win over anything left from its previous run
+        self.epoch = int(time.time())
+        self.send_seq = 0
+        self._last_sent_state = None
+        self._peer_seqs = {}  # source (one per panel instance) -> (epoch, seq) of its newest update applied
+
+        # Database access runs off the GUI thread
+        self.db_worker = DbWorker(parent=self)
+        self.db_worker.start()
+
         # Socket communication
         self.socket_manager = SocketManager()
+        # One source per panel instance; panels sharing a machine would
+        # otherwise drop each other's updates as their own echoes
+        self.source = f"GUI_{socket.gethostname()}_{self.socket_manager.instance_id[:8]}"
         self.socket_manager.update_received.connect(self.handle_socket_update)
         self.socket_manager.peer_discovered.connect(self.handle_new_peer)
+        self.socket_manager.peer_lost.connect(self.handle_lost_peer)
+        self.socket_manager.snapshot_requested.connect(self._on_snapshot_requested)
+        self.socket_manager.snapshot_received.connect(self._on_snapshot_received)
         self.socket_manager.start()
 
+        # Startup state comes from the freshest peer when it is up to date
+        self._snapshot_request = None
+        self._snapshot_replies = []
+        self.snapshot_timer = QTimer(self)
+        self.snapshot_timer.setSingleShot(True)
+        self.snapshot_timer.timeout.connect(self._choose_snapshot)
+
+        # Changes pushed by state_hub.py or change_relay.py. With a hub the
+        # panel stops polling; with a plain relay polling slows down
+        self.relay_changes.connect(self._apply_relay_changes)
+        self.relay_status.connect(self._on_relay_status)
+        self.relay_gap.connect(self.check_new_signals)
+        self.hub_state.connect(self._apply_hub_state)
+        self.hub_peer_update.connect(self.handle_socket_update)
+        self.relay_client = HubClient(
+            self.hub_state.emit, self.hub_peer_update.emit,
+            self.relay_changes.emit, self.relay_status.emit, self.relay_gap.emit
+        )
+        self.relay_client.start()
+
         # Setup UI
         self.init_ui()
 
-        # Start connection monitoring
+        # Start connection monitoring. The pool is created in the background;
+        # check again as soon as it is up instead of waiting for the next retry
         self.log("Application started")
+        self.connection_timer = QTimer(self)
+        self.connection_timer.setSingleShot(True)
+        self.connection_timer.timeout.connect(self.attempt_connection)
+        self.database_ready.connect(self.attempt_connection)
+        self._ready_callback = self.database_ready.emit
+        db.add_ready_callback(self._ready_callback)
+        db.warm_up()
         self.attempt_connection()
 
         # Setup timers
         self.signals_watcher = QTimer(self)
         self.signals_watcher.timeout.connect(self.check_new_signals)
-        self.signals_watcher.start(1000)
+        self.signals_watcher.start(POLL_INTERVAL)
+        self.keyframe_timer = QTimer(self)
+        self.keyframe_timer.timeout.connect(self._send_keyframe)
+        self.keyframe_timer.start(KEYFRAME_INTERVAL)
 
     def init_ui(self):
         self.setStyleSheet("""
@@ -289,16 +387,25 @@ class ManualWindow(QWidget):
 
     def handle_socket_update(self, message):
         if message.get('type') == 'state_update':
-            if message.get('source') == f"GUI_{socket.gethostname()}":
+            if message.get('source') == self.source or not self._accept_sequence(message):
                 return
                 
             self.blockSignals(True)
 
-            protocol = message.get('protocol', 'CAN')
-            self.can_btn.setChecked(protocol == 'CAN')
-            self.lin_btn.setChecked(protocol == 'LIN')
+            # Deltas only carry the fields that changed
+            protocol = message.get('protocol', self.protocol)
+            if 'protocol' in message:
+                self.can_btn.setChecked(protocol == 'CAN')
+                self.lin_btn.setChecked(protocol == 'LIN')
             
-            if 'pwf_state' in message:
+            # Keep the version our next conditional transition expects in
+            # step with the state; an older version means a stale PWF state
+            pwf_version = message.get('pwf_version')
+            stale_pwf = pwf_version is not None and self.pwf_version is not None and pwf_version < self.pwf_version
+            if pwf_version is not None and not stale_pwf:
+                self.pwf_version = pwf_version
+
+            if 'pwf_state' in message and not stale_pwf:
                 new_pwf_state = message['pwf_state']
                 if new_pwf_state != self.current_pwf_state:
                     self.current_pwf_state = new_pwf_state
@@ -364,175 +471,225 @@ class ManualWindow(QWidget):
             self.update_ui()
             self.blockSignals(False)
 
+    def _accept_sequence(self, message):
+        """False for an update older than one already applied from the same panel instance"""
+        if message.get('seq') is None:
+            return True  # Sender without sequence numbers
+        received = (message.get('epoch', 0), message['seq'])
+        last = self._peer_seqs.get(message.get('source'))
+        if last is not None and received <= last:
+            return False  # Duplicate or reordered packet
+        self._peer_seqs[message.get('source')] = received
+        return True
+
     def handle_new_peer(self, peer_ip):
         self.log(f"Discovered new peer: {peer_ip}")
-        self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Online")
+        self._set_db_status(self.db_online)  # Refreshes the peer count
+        self._send_keyframe()  # The new peer has not seen our state yet
 
-    def broadcast_state(self):
-        message = {
-            'type': 'state_update',
+    def handle_lost_peer(self, peer_ip):
+        self.log(f"Lost peer: {peer_ip}")
+        self._set_db_status(self.db_online)
+
+    def _send_keyframe(self):
+        if self._last_sent_state is not None:  # Nothing to repeat before the first update
+            self.broadcast_state(keyframe=True)
+
+    def broadcast_state(self, keyframe=False):
+        """Send our state to the other panels.
+
+        Between keyframes only the fields that changed since the last update
+        are sent. Every update carries the next sequence number, so receivers
+        can drop duplicates and packets that arrive out of order.
+        """
+        state = {
             'led_state': self.toggle_btn.current_led_state,
             'ledL_state': self.toggle_btnL.current_led_state,
             'button_state': self.toggle_btn.current_button_state,
             'buttonL_state': self.toggle_btnL.current_button_state,
             'pwf_state': self.current_pwf_state,
+            'pwf_version': self.pwf_version,
             'protocol': self.protocol,
-            'source': f"GUI_{socket.gethostname()}",
+        }
+        if keyframe or self._last_sent_state is None:
+            keyframe, fields = True, state
+        else:
+            fields = {key: value for key, value in state.items() if self._last_sent_state[key] != value}
+            if not fields:
+                return
+        self._last_sent_state = state
+        self.send_seq += 1
+        message = {
+            'type': 'state_update',
+            **fields,
+            'source': self.source,
+            'epoch': self.epoch,
+            'seq': self.send_seq,
+            'keyframe': keyframe,
             'timestamp': datetime.now().isoformat()
         }
-        self.socket_manager.send_update(message)
+        # Through the hub if there is one, else to every peer
+        if not self.relay_client.publish(message):
+            self.socket_manager.send_update(message)
 
     def attempt_connection(self):
-        try:
-            conn = db.get_connection()
-            if conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT 1")
-                cursor.fetchall()
-                conn.close()
-                
-                if not self.signals_watcher.isActive():
-                    self.signals_watcher.start(1000)
-                
-                self.p_btn.setEnabled(True)
-                self.s_btn.setEnabled(True)
-                self.w_btn.setEnabled(True)
-                self.f_btn.setEnabled(True)
-                
-                self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Online")
+        if self.relay_client.hub_mode:
+            # The hub watches the database for every panel
+            self._set_db_status(self.relay_client.db_online)
+            self.connection_timer.start(5000)
+            return
+        self.db_worker.submit(
+            _check_connection,
+            callback=self._on_connection_checked,
+            error_callback=lambda message: self._on_connection_checked(False),
+            key='attempt_connection'
+        )
+
+    def _on_connection_checked(self, connected):
+        if connected:
+            if not self.signals_watcher.isActive() and not self.relay_client.hub_mode:
+                self.signals_watcher.start(RELAY_POLL_INTERVAL if self.relay_client.connected else POLL_INTERVAL)
+
+            # Only reload after an outage, not on every check
+            reconnected = not self.db_online
+            self._set_db_status(True)
+            if reconnected:
                 self.load_initial_state()
-            else:
-                self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Offline")
-        except Exception as e:
+        else:
+            self._set_db_status(False)
+
+        self.connection_timer.start(5000)
+
+    def _set_db_status(self, online):
+        self.db_online = online
+        if online:
+            self.p_btn.setEnabled(True)
+            self.s_btn.setEnabled(True)
+            self.w_btn.setEnabled(True)
+            self.f_btn.setEnabled(True)
+            self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Online")
+        elif not db.is_ready():
+            self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Connecting...")
+        else:
             self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Offline")
-        
-        QTimer.singleShot(5000, self.attempt_connection)
 
     def check_new_signals(self):
-        conn = None
-        try:
-            conn = db.get_connection()
-            if conn is None:
-                self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Offline")
-                return
-                
-            cursor = conn.cursor()
-            
-            # Check PWF state
-            cursor.execute("SELECT state FROM pwf_state WHERE is_active = 1 ORDER BY timestamp DESC LIMIT 1")
-            pwf_result = cursor.fetchone()
-            if pwf_result:
-                new_pwf_state = pwf_result[0]
-                if new_pwf_state != self.current_pwf_state:
-                    self.current_pwf_state = new_pwf_state
-                    self._update_pwf_buttons()
-                    self.log(f"PWF state updated from DB to {new_pwf_state}")
-                    
-                    if new_pwf_state in ['P', 'S']:
-                        if self.toggle_btn.current_led_state == 'on':
-                            self.toggle_btn.current_led_state = 'off'
-                            self.car_lamp_widget.set_state(False)
-                            self._update_led_in_db('off', 'CAN')
-                        if self.toggle_btnL.current_led_state == 'on':
-                            self.toggle_btnL.current_led_state = 'off'
-                            self.car_lamp_widget.set_state(False)
-                            self._update_led_in_db('off', 'LIN')
-
-            # Check for CAN signals
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'led' AND protocol = 'CAN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            can_led_result = cursor.fetchone()
-            if can_led_result and self.current_pwf_state in ['W', 'F']:  # Only update in W/F modes
-                new_led_state = can_led_result[0]
-                if new_led_state != self.toggle_btn.current_led_state:
-                    self.toggle_btn.current_led_state = new_led_state
-                    self.car_lamp_widget.set_state(new_led_state == 'on')
-                    self.log(f"CAN LED state updated from DB to {new_led_state}")
-
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'button' AND protocol = 'CAN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            can_button_result = cursor.fetchone()
-            if can_button_result:
-                new_button_state = can_button_result[0]
-                if new_button_state != self.toggle_btn.current_button_state:
-                    self.toggle_btn.current_button_state = new_button_state
-                    self.log(f"CAN Button state updated from DB to {new_button_state}")
-                    
-                    if self.current_pwf_state in ['W', 'F']:  # Only update LED in W/F modes
-                        new_led = 'on' if new_button_state == 'pressed' else 'off'
-                        if new_led != self.toggle_btn.current_led_state:
-                            self.toggle_btn.current_led_state = new_led
-                            self.car_lamp_widget.set_state(new_led == 'on')
-                            self._update_led_in_db(new_led, 'CAN')
-
-            # Check for LIN signals
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'ledL' AND protocol = 'LIN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            lin_led_result = cursor.fetchone()
-            if lin_led_result and self.current_pwf_state in ['W', 'F']:  # Only update in W/F modes
-                new_led_state = lin_led_result[0]
-                if new_led_state != self.toggle_btnL.current_led_state:
-                    self.toggle_btnL.current_led_state = new_led_state
-                    self.car_lamp_widget.set_state(new_led_state == 'on')
-                    self.log(f"LIN LED state updated from DB to {new_led_state}")
-
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'buttonL' AND protocol = 'LIN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            lin_button_result = cursor.fetchone()
-            if lin_button_result:
-                new_button_state = lin_button_result[0]
-                if new_button_state != self.toggle_btnL.current_button_state:
-                    self.toggle_btnL.current_button_state = new_button_state
-                    self.log(f"LIN Button state updated from DB to {new_button_state}")
-                    
-                    if self.current_pwf_state in ['W', 'F']:  # Only update LED in W/F modes
-                        new_led = 'on' if new_button_state == 'pressed' else 'off'
-                        if new_led != self.toggle_btnL.current_led_state:
-                            self.toggle_btnL.current_led_state = new_led
-                            self.car_lamp_widget.set_state(new_led == 'on')
-                            self._update_led_in_db(new_led, 'LIN')
-            
-            self.update_ui()
-            
-        except Exception as e:
-            self.log(f"Error checking signals: {str(e)}")
+        self.db_worker.submit(
+            _fetch_signal_states,
+            callback=self._apply_db_signals,
+            error_callback=self._on_signals_error,
+            key='check_new_signals'
+        )
+
+    def _on_relay_status(self, connected):
+        if connected and self.relay_client.hub_mode:
+            self.log("State hub connected; the hub now watches the database")
+            self.signals_watcher.stop()
+            self._set_db_status(self.relay_client.db_online)
+        elif connected:
+            self.log("Change relay connected; database polling is now a fallback")
+            self.signals_watcher.setInterval(RELAY_POLL_INTERVAL)
+        else:
+            self.log("Change relay lost; polling the database")
+            self.signals_watcher.start(POLL_INTERVAL)
+            self.check_new_signals()
+
+    def _apply_hub_state(self, state, full):
+        if full:
+            self._apply_initial_state(state, broadcast=False)
+            return
+        states = {
+            'pwf_state': None, 'pwf_version': self.pwf_version, 'change_id': self.change_id,
+            'led': None, 'button': None, 'ledL': None, 'buttonL': None,
+        }
+        states.update(state)
+        self._apply_db_signals(states)
+
+    def _apply_relay_changes(self, rows):
+        states = {
+            'pwf_state': None, 'pwf_version': self.pwf_version,
+            'led': None, 'button': None, 'ledL': None, 'buttonL': None,
+            'change_id': rows[-1]['id'] if rows else self.change_id,
+        }
+        pwf_changed = False
+        for row in rows:
+            if row['signal_name'] == 'pwf_state_change':
+                pwf_changed = True
+            elif (row['signal_name'], row['protocol']) in db.TRACKED_SIGNALS:
+                states[row['signal_name']] = row['value']
+        self._apply_db_signals(states)
+        if pwf_changed:
+            # The new PWF version only comes from the database
+            self.check_new_signals()
+
+    def _on_signals_error(self, message):
+        self.log(f"Error checking signals: {message}")
+        self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Offline")
+
+    def _apply_db_signals(self, states):
+        if states is None:
             self.connection_status.setText(f"Peers: {len(self.socket_manager.peers)} | DB: Offline")
-        finally:
-            if conn and conn.is_connected():
-                conn.close()
+            return
+
+        # Check PWF state
+        new_pwf_state = states['pwf_state']
+        self.pwf_version = states['pwf_version']
+        self.change_id = states['change_id']
+        if new_pwf_state and new_pwf_state != self.current_pwf_state:
+            self.current_pwf_state = new_pwf_state
+            self._update_pwf_buttons()
+            self.log(f"PWF state updated from DB to {new_pwf_state}")
+
+            # The transition already switched the LEDs off in the database
+            if new_pwf_state in ['P', 'S'] and self._force_leds_off():
+                self.broadcast_state()
+
+        # Check for CAN signals
+        new_led_state = states['led']
+        if new_led_state and self.current_pwf_state in ['W', 'F']:  # Only update in W/F modes
+            if new_led_state != self.toggle_btn.current_led_state:
+                self.toggle_btn.current_led_state = new_led_state
+                self.car_lamp_widget.set_state(new_led_state == 'on')
+                self.log(f"CAN LED state updated from DB to {new_led_state}")
+
+        new_button_state = states['button']
+        if new_button_state and new_button_state != self.toggle_btn.current_button_state:
+            self.toggle_btn.current_button_state = new_button_state
+            self.log(f"CAN Button state updated from DB to {new_button_state}")
+
+            if self.current_pwf_state in ['W', 'F']:  # Only update LED in W/F modes
+                new_led = 'on' if new_button_state == 'pressed' else 'off'
+                if new_led != self.toggle_btn.current_led_state:
+                    self.toggle_btn.current_led_state = new_led
+                    self.car_lamp_widget.set_state(new_led == 'on')
+                    self._update_led_in_db(new_led, 'CAN')
+
+        # Check for LIN signals
+        new_led_state = states['ledL']
+        if new_led_state and self.current_pwf_state in ['W', 'F']:  # Only update in W/F modes
+            if new_led_state != self.toggle_btnL.current_led_state:
+                self.toggle_btnL.current_led_state = new_led_state
+                self.car_lamp_widget.set_state(new_led_state == 'on')
+                self.log(f"LIN LED state updated from DB to {new_led_state}")
+
+        new_button_state = states['buttonL']
+        if new_button_state and new_button_state != self.toggle_btnL.current_button_state:
+            self.toggle_btnL.current_button_state = new_button_state
+            self.log(f"LIN Button state updated from DB to {new_button_state}")
+
+            if self.current_pwf_state in ['W', 'F']:  # Only update LED in W/F modes
+                new_led = 'on' if new_button_state == 'pressed' else 'off'
+                if new_led != self.toggle_btnL.current_led_state:
+                    self.toggle_btnL.current_led_state = new_led
+                    self.car_lamp_widget.set_state(new_led == 'on')
+                    self._update_led_in_db(new_led, 'LIN')
+
+        self.update_ui()
 
     def _update_led_in_db(self, state, protocol):
-        conn = None
-        try:
-            conn = db.get_connection()
-            if conn is None:
-                return
-                
-            cursor = conn.cursor()
-            signal_name = 'led' if protocol == 'CAN' else 'ledL'
-            cursor.execute("""
-                INSERT INTO signals_log (signal_name, value, source, timestamp, protocol)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (signal_name, state, 'GUI', datetime.now().isoformat(), protocol))
-            conn.commit()
-            self.broadcast_state()
-        except Exception as e:
-            self.log(f"Error updating LED in DB: {str(e)}")
-        finally:
-            if conn and conn.is_connected():
-                conn.close()
+        signal_name = 'led' if protocol == 'CAN' else 'ledL'
+        db.queue_signals([(signal_name, state, protocol)])
+        self.broadcast_state()
 
     def on_pwf_state_change(self, button):
         new_state = button.text()
@@ -550,132 +707,149 @@ class ManualWindow(QWidget):
                 btn.setChecked(btn.text() == current_state)
             self.blockSignals(False)
             return
-            
-        conn = None
-        try:
-            conn = db.get_connection()
-            if conn is None:
-                raise Exception("Could not get database connection")
-            
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                UPDATE pwf_state 
-                SET is_active = 0
-            """)
-            
-            cursor.execute("""
-                UPDATE pwf_state 
-                SET is_active = 1, timestamp = CURRENT_TIMESTAMP
-                WHERE state = %s
-            """, (new_state,))
-
-            cursor.execute("""
-                INSERT INTO signals_log (signal_name, value, source, timestamp, protocol)
-                VALUES (%s, %s, %s, %s, %s)
-            """, ('pwf_state_change', new_state, 'GUI', datetime.now().isoformat(), self.protocol))
-            
-            conn.commit()
-            
-            self.current_pwf_state = new_state
-            
-            if new_state in ['P', 'S']:
-                if self.toggle_btn.current_led_state == 'on':
-                    self.toggle_btn.current_led_state = 'off'
-                    self.car_lamp_widget.set_state(False)
-                    self._update_led_in_db('off', 'CAN')
-                if self.toggle_btnL.current_led_state == 'on':
-                    self.toggle_btnL.current_led_state = 'off'
-                    self.car_lamp_widget.set_state(False)
-                    self._update_led_in_db('off', 'LIN')
-            
-            self.broadcast_state()
-            self.log(f"PWF state changed to {new_state} (via {self.protocol})")
-            self.update_ui()
-        except Exception as e:
-            self.log(f"Error changing PWF state: {str(e)}")
-            self.blockSignals(True)
-            for btn in self.pwf_group.buttons():
-                btn.setChecked(btn.text() == current_state)
-            self.blockSignals(False)
-        finally:
-            if conn and conn.is_connected():
-                conn.close()
+
+        # One conditional transition: it fails instead of overwriting a
+        # change another panel made since our last read
+        expected_version = self.pwf_version if current_state else None
+        self.db_worker.submit(
+            db.set_pwf_state, new_state, self.protocol, current_state, expected_version,
+            callback=lambda stored: (self._on_pwf_state_stored(new_state, expected_version) if stored
+                                     else self._on_pwf_state_failed("Could not store PWF state", current_state)),
+            error_callback=lambda message: self._on_pwf_state_failed(message, current_state)
+        )
+
+    def _on_pwf_state_stored(self, new_state, expected_version):
+        self.current_pwf_state = new_state
+        self.pwf_version = expected_version + 1 if expected_version is not None else None
+
+        # The transition switched the LEDs off in the same round trip
+        if new_state in ['P', 'S']:
+            self._force_leds_off()
+
+        self.broadcast_state()
+        self.log(f"PWF state changed to {new_state} (via {self.protocol})")
+        self.update_ui()
+
+    def _on_pwf_state_failed(self, message, previous_state):
+        self.log(f"Error changing PWF state: {message}")
+        self.blockSignals(True)
+        for btn in self.pwf_group.buttons():
+            btn.setChecked(btn.text() == previous_state)
+        self.blockSignals(False)
+        # Pick up whatever another panel changed in the meantime
+        self._load_state_from_db()
+
+    def _force_leds_off(self):
+        """Show both LEDs off; the database is already updated. Returns True if one was on"""
+        changed = False
+        for button in (self.toggle_btn, self.toggle_btnL):
+            if button.current_led_state == 'on':
+                button.current_led_state = 'off'
+                self.car_lamp_widget.set_state(False)
+                changed = True
+        return changed
 
     def load_initial_state(self):
-        conn = None
-        try:
-            conn = db.get_connection()
-            if conn is None:
-                return
-                
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                SELECT state FROM pwf_state 
-                WHERE is_active = 1
-                ORDER BY timestamp DESC 
-                LIMIT 1
-            """)
-            pwf_state = cursor.fetchone()
-            if pwf_state:
-                self.current_pwf_state = pwf_state[0]
-                self._update_pwf_buttons()
-                self.log(f"Initial PWF state loaded: {self.current_pwf_state}")
-            else:
-                self.log("No active PWF state found in database")
-
-            # Load CAN states
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'led' AND protocol = 'CAN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            can_led_state = cursor.fetchone()
-            if can_led_state:
-                self.toggle_btn.current_led_state = can_led_state[0]
-                if self.current_pwf_state in ['W', 'F']:  # Only set LED state in W/F modes
-                    self.car_lamp_widget.set_state(can_led_state[0] == 'on')
-                self.log(f"Initial CAN LED state loaded: {can_led_state[0]}")
-
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'button' AND protocol = 'CAN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            can_button_state = cursor.fetchone()
-            if can_button_state:
-                self.toggle_btn.current_button_state = can_button_state[0]
-                self.log(f"Initial CAN button state loaded: {can_button_state[0]}")
-
-            # Load LIN states
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'ledL' AND protocol = 'LIN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            lin_led_state = cursor.fetchone()
-            if lin_led_state:
-                self.toggle_btnL.current_led_state = lin_led_state[0]
-                self.log(f"Initial LIN LED state loaded: {lin_led_state[0]}")
-
-            cursor.execute("""
-                SELECT value FROM signals_log 
-                WHERE signal_name = 'buttonL' AND protocol = 'LIN'
-                ORDER BY timestamp DESC LIMIT 1
-            """)
-            lin_button_state = cursor.fetchone()
-            if lin_button_state:
-                self.toggle_btnL.current_button_state = lin_button_state[0]
-                self.log(f"Initial LIN button state loaded: {lin_button_state[0]}")
-            
-            self.update_ui()
+        """Load the current state from the hub, a peer or the database.
+
+        Without a hub, running peers are asked for their state first. The
+        freshest reply is used if one cheap check shows the database has
+        nothing newer; otherwise the full state is read from the database.
+        """
+        if self.relay_client.hub_mode:
+            self.relay_client.resync()
+            return
+        if self.snapshot_timer.isActive():
+            return  # Already waiting for peers
+        self._snapshot_replies = []
+        self._snapshot_request = self.socket_manager.request_snapshot()
+        if self._snapshot_request:
+            self.snapshot_timer.start(SNAPSHOT_WAIT)
+        else:
+            self._load_state_from_db()
+
+    def _on_snapshot_requested(self, host, request_id):
+        if self.change_id is None:
+            return  # Nothing loaded yet
+        state = {
+            'pwf_state': self.current_pwf_state,
+            'pwf_version': self.pwf_version,
+            'change_id': self.change_id,
+            'led': self.toggle_btn.current_led_state,
+            'button': self.toggle_btn.current_button_state,
+            'ledL': self.toggle_btnL.current_led_state,
+            'buttonL': self.toggle_btnL.current_button_state,
+        }
+        self.socket_manager.send_snapshot(host, request_id, self.change_id, state)
+
+    def _on_snapshot_received(self, message):
+        if self.snapshot_timer.isActive() and message.get('request_id') == self._snapshot_request:
+            self._snapshot_replies.append(message)
+
+    def _choose_snapshot(self):
+        if not self._snapshot_replies:
+            self._load_state_from_db()
+            return
+        freshest = max(self._snapshot_replies, key=lambda reply: reply['seq'])
+        self.db_worker.submit(
+            db.get_latest_change_id,
+            callback=lambda latest: self._apply_peer_snapshot(freshest, latest),
+            error_callback=lambda message: self._apply_peer_snapshot(freshest, None),
+            key='snapshot_version'
+        )
+
+    def _apply_peer_snapshot(self, reply, latest_change_id):
+        if latest_change_id is not None and reply['seq'] < latest_change_id:
+            # The database moved on since the peer's state
+            self._load_state_from_db()
+            return
+        self.log(f"State loaded from peer {reply['host']} (change {reply['seq']})")
+        self._apply_initial_state(reply['state'], broadcast=False)
+
+    def _load_state_from_db(self):
+        self.db_worker.submit(
+            _fetch_signal_states,
+            callback=self._apply_initial_state,
+            error_callback=lambda message: self.log(f"Error loading initial state: {message}"),
+            key='load_initial_state'
+        )
+
+    def _apply_initial_state(self, states, broadcast=True):
+        if states is None:
+            return
+
+        self.pwf_version = states['pwf_version']
+        self.change_id = states['change_id']
+        if states['pwf_state']:
+            self.current_pwf_state = states['pwf_state']
+            self._update_pwf_buttons()
+            self.log(f"Initial PWF state loaded: {self.current_pwf_state}")
+        else:
+            self.log("No active PWF state found in database")
+
+        # Load CAN states
+        if states['led']:
+            self.toggle_btn.current_led_state = states['led']
+            if self.current_pwf_state in ['W', 'F']:  # Only set LED state in W/F modes
+                self.car_lamp_widget.set_state(states['led'] == 'on')
+            self.log(f"Initial CAN LED state loaded: {states['led']}")
+
+        if states['button']:
+            self.toggle_btn.current_button_state = states['button']
+            self.log(f"Initial CAN button state loaded: {states['button']}")
+
+        # Load LIN states
+        if states['ledL']:
+            self.toggle_btnL.current_led_state = states['ledL']
+            self.log(f"Initial LIN LED state loaded: {states['ledL']}")
+
+        if states['buttonL']:
+            self.toggle_btnL.current_button_state = states['buttonL']
+            self.log(f"Initial LIN button state loaded: {states['buttonL']}")
+
+        self.update_ui()
+        if broadcast:
             self.broadcast_state()
-        except Exception as e:
-            self.log(f"Error loading initial state: {str(e)}")
-        finally:
-            if conn and conn.is_connected():
-                conn.close()
 
     def _update_pwf_buttons(self):
         self.blockSignals(True)
@@ -702,10 +876,16 @@ class ManualWindow(QWidget):
     def closeEvent(self, event):
         if hasattr(self, 'signals_watcher') and self.signals_watcher.isActive():
             self.signals_watcher.stop()
+        if hasattr(self, 'keyframe_timer'):
+            self.keyframe_timer.stop()
         if hasattr(self, 'socket_manager'):
             self.socket_manager.stop()
-            
-        time.sleep(0.5)
+        if hasattr(self, 'relay_client'):
+            self.relay_client.stop()
+        db.remove_ready_callback(self._ready_callback)
+        if hasattr(self, 'db_worker'):
+            self.db_worker.stop()
+        db.flush_writes()
         super().closeEvent(event)
     
     def go_back(self):
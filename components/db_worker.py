@@ -0,0 +1,127 @@
+import queue
+import threading
+import itertools
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+class DbWorker(QObject):
+    """Runs blocking database calls on a dedicated thread.
+
+    Requests are queued in order and executed one at a time. Results come
+    back to the GUI thread through Qt signals and are handed to the
+    callbacks given at submit time, so the event loop never waits on MySQL.
+    """
+    request_finished = pyqtSignal(int, object)
+    request_failed = pyqtSignal(int, str)
+
+    def __init__(self, default_timeout=5000, parent=None):
+        super().__init__(parent)
+        self.default_timeout = default_timeout  # milliseconds
+        self.running = False
+        self.thread = None
+        self._queue = queue.Queue()
+        self._pending = {}  # request_id -> (callback, error_callback, key)
+        self._keys = {}     # coalescing key -> request_id
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self.request_finished.connect(self._dispatch_result)
+        self.request_failed.connect(self._dispatch_error)
+
+    def start(self):
+        """Start the database thread"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, callback=None, error_callback=None, timeout=None, key=None, **kwargs):
+        """Queue func(*args, **kwargs) for the database thread.
+
+        callback(result) or error_callback(message) is called on the GUI
+        thread. A request still pending after `timeout` ms is failed with
+        "timed out" and its late result is dropped. If `key` is given and a
+        request with the same key is still pending, nothing is queued and
+        None is returned. Otherwise returns the request id.
+        """
+        if not self.running:
+            self.start()
+
+        with self._lock:
+            if key is not None and key in self._keys:
+                return None
+            request_id = next(self._ids)
+            self._pending[request_id] = (callback, error_callback, key)
+            if key is not None:
+                self._keys[key] = request_id
+
+        self._queue.put((request_id, func, args, kwargs))
+
+        timeout = self.default_timeout if timeout is None else timeout
+        if timeout:
+            QTimer.singleShot(timeout, lambda: self._expire(request_id))
+        return request_id
+
+    def cancel(self, request_id):
+        """Cancel a pending request. Returns True if it was still pending"""
+        return self._take(request_id) is not None
+
+    def cancel_all(self):
+        """Cancel every pending request"""
+        with self._lock:
+            self._pending.clear()
+            self._keys.clear()
+
+    def is_pending(self, key):
+        """Check whether a request with the given coalescing key is pending"""
+        with self._lock:
+            return key in self._keys
+
+    def stop(self):
+        """Stop the database thread without waiting for a running query"""
+        self.running = False
+        self.cancel_all()
+        self._queue.put(None)
+
+    def _take(self, request_id):
+        with self._lock:
+            entry = self._pending.pop(request_id, None)
+            if entry and entry[2] is not None:
+                self._keys.pop(entry[2], None)
+            return entry
+
+    def _run(self):
+        """Thread function executing queued requests"""
+        while self.running:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            request_id, func, args, kwargs = item
+            with self._lock:
+                if request_id not in self._pending:
+                    continue  # Cancelled or timed out before it started
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if self.running:
+                    self.request_failed.emit(request_id, str(e))
+            else:
+                if self.running:
+                    self.request_finished.emit(request_id, result)
+
+    def _expire(self, request_id):
+        entry = self._take(request_id)
+        if entry and entry[1]:
+            entry[1]("timed out")
+
+    def _dispatch_result(self, request_id, result):
+        entry = self._take(request_id)
+        if entry and entry[0]:
+            entry[0](result)
+
+    def _dispatch_error(self, request_id, message):
+        entry = self._take(request_id)
+        if entry and entry[1]:
+            entry[1](message)
@@ -1,163 +1,337 @@
+import os
 import socket
-import threading
-import json
+import asyncio
 import time
+import json
+import uuid
 from PyQt5.QtCore import QObject, pyqtSignal
+from event_loop import get_event_loop, DatagramProtocol
+from . import wire_format
+
+DISCOVERY_INTERVAL = 5.0  # Seconds between discovery heartbeats
+PEER_TTL = 3 * DISCOVERY_INTERVAL  # A peer not heard from for this long is dropped
+PEER_SEND_FAILURES = 3    # Consecutive send errors before a peer is dropped
+
+# Discovery: every panel broadcasts {'type': 'discovery', 'id': ..., 'wire': [...]}
+# to the discovery port every DISCOVERY_INTERVAL and listens there for the
+# others. A panel seen for the first time gets a 'discovery_response' with
+# the same fields straight away, so new panels find each other without
+# waiting a full interval. Any datagram from a peer keeps it alive. Only
+# our own heartbeats are skipped, by their id, so panels on the same
+# machine discover each other too.
+
+# Optional IP multicast: every update is sent once to the group instead of
+# once per peer. All panels must use the same group and port. An empty
+# KPIT_MULTICAST_GROUP keeps unicast, which is also used when the group
+# cannot be joined. For several panels on one machine use interface
+# 127.0.0.1; they then share the port, so only multicast reaches all of them.
+MULTICAST_GROUP = os.environ.get('KPIT_MULTICAST_GROUP', '')  # e.g. 239.255.43.21
+MULTICAST_TTL = int(os.environ.get('KPIT_MULTICAST_TTL', '1'))  # 1: local subnet only
+MULTICAST_INTERFACE = os.environ.get('KPIT_MULTICAST_INTERFACE', '')  # Local IP of the NIC; empty: OS default
 
 class SocketManager(QObject):
     update_received = pyqtSignal(dict)
     peer_discovered = pyqtSignal(str)
-    
-    def __init__(self, host='0.0.0.0', port=65432, broadcast_port=65433):
+    peer_lost = pyqtSignal(str)
+    snapshot_requested = pyqtSignal(str, str)  # host, request_id
+    snapshot_received = pyqtSignal(dict)
+
+    def __init__(self, host='0.0.0.0', port=65432, broadcast_port=65433, multicast_group=MULTICAST_GROUP,
+                 multicast_ttl=MULTICAST_TTL, multicast_interface=MULTICAST_INTERFACE):
         super().__init__()
         self.host = host
         self.port = port
         self.broadcast_port = broadcast_port
+        self.multicast_group = multicast_group
+        self.multicast_ttl = multicast_ttl
+        self.multicast_interface = multicast_interface
+        self.multicast = False  # True once the group is joined
         self.running = False
         self.peers = set()
+        self.peer_seen = {}  # host -> time.monotonic() it was last heard from
+        self.peer_wire = {}  # host -> binary wire version it reads (absent: JSON only)
+        self._send_failures = {}  # host -> consecutive send errors
+        self.instance_id = uuid.uuid4().hex  # Recognises our own discovery heartbeats
+        self.loop = None
+        self.transport = None
+        self.discovery_transport = None
+        # The sockets under the transports; sending on them directly reports
+        # errors to the caller instead of to the protocol
         self.socket = None
-        self.broadcast_socket = None
-        self.receive_thread = None
-        self.discovery_thread = None
-        
+        self.discovery_socket = None
+        self.discovery_task = None
+        self._snapshot_requests = set()  # ids of our own requests, to skip their broadcast echo
+
     def start(self):
         """Start both the main socket and discovery service"""
         if self.running:
             return True
-            
+
+        self.loop = get_event_loop()
         try:
-            # Main UDP socket for communication
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((self.host, self.port))
-            
-            # Broadcast socket for peer discovery
-            self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            self.broadcast_socket.settimeout(0.2)
-            
+            asyncio.run_coroutine_threadsafe(self._open(), self.loop).result(timeout=2)
             self.running = True
-            self.receive_thread = threading.Thread(target=self._receive_loop, daemon=True)
-            self.receive_thread.start()
-            
-            self.discovery_thread = threading.Thread(target=self._discovery_loop, daemon=True)
-            self.discovery_thread.start()
             return True
         except Exception as e:
             print(f"Failed to start socket manager: {e}")
             self.stop()
             return False
 
-    def _receive_loop(self):
-        """Thread function to receive messages"""
-        while self.running:
+    async def _open(self):
+        # Main UDP socket for communication
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind((self.host, self.port))
+        if self.multicast_group:
             try:
-                if not self.socket:
-                    time.sleep(0.1)
-                    continue
-                    
-                data, addr = self.socket.recvfrom(1024)
+                self._join_multicast(sock)
+                self.multicast = True
+            except OSError as e:
+                print(f"⚠️ Cannot join multicast group {self.multicast_group}, using unicast: {e}")
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self._on_datagram), sock=sock
+        )
+        self.socket = sock
+
+        # Discovery socket, shared with other panels on this machine
+        discovery_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            discovery_sock.bind(('', self.broadcast_port))
+        except OSError as e:
+            # We still announce ourselves and get the replies
+            print(f"⚠️ Discovery port {self.broadcast_port} unavailable, only announcing: {e}")
+            discovery_sock.bind(('', 0))
+        self.discovery_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramProtocol(self._on_discovery_datagram), sock=discovery_sock
+        )
+        self.discovery_socket = discovery_sock
+        self.discovery_task = self.loop.create_task(self._discovery_loop())
+
+    def _join_multicast(self, sock):
+        """Join the multicast group on `sock` and send our own multicasts through it"""
+        interface = socket.inet_aton(self.multicast_interface or '0.0.0.0')
+        membership = socket.inet_aton(self.multicast_group) + interface
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        # Panels on this machine are group members too; each drops only its
+        # own updates, by their per-instance source
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.multicast_interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+
+    def _on_datagram(self, data, addr):
+        """Handle a datagram on the main socket (event loop thread)"""
+        if addr[0] in self.peer_seen:
+            self.peer_seen[addr[0]] = time.monotonic()
+
+        if wire_format.is_binary(data):
+            message = wire_format.decode(data)
+            if message is not None:
+                # A peer that sends binary also reads it
+                self.peer_wire.setdefault(addr[0], data[2])
+                self.update_received.emit(message)
+            return
+
+        try:
+            message = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        self._note_wire(addr[0], message.pop('wire', None))
+
+        if message.get('type') == 'snapshot_request':
+            if message.get('request_id') not in self._snapshot_requests:
+                self.snapshot_requested.emit(addr[0], message.get('request_id', ''))
+        elif message.get('type') == 'snapshot_response':
+            if message.get('request_id') in self._snapshot_requests:
+                message['host'] = addr[0]
+                self.snapshot_received.emit(message)
+        else:
+            # Normal message handling
+            self.update_received.emit(message)
+
+    def _on_discovery_datagram(self, data, addr):
+        """Handle a discovery heartbeat or response (event loop thread)"""
+        try:
+            message = json.loads(data.decode())
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            return
+        if message.get('type') not in ('discovery', 'discovery_response'):
+            return
+        host = addr[0]
+        if message.get('id') == self.instance_id:
+            return  # Our own heartbeat; other panels on this machine are peers
+
+        self._note_wire(host, message.get('wire'))
+        new = host not in self.peers
+        self.peers.add(host)
+        self.peer_seen[host] = time.monotonic()
+        if new:
+            if message['type'] == 'discovery':
                 try:
-                    message = json.loads(data.decode())
-                    
-                    if message.get('type') == 'discovery':
-                        # Respond to discovery requests
-                        if addr[0] != self._get_local_ip():
-                            response = {'type': 'discovery_response', 'host': self._get_local_ip()}
-                            self.socket.sendto(json.dumps(response).encode(), addr)
-                    else:
-                        # Normal message handling
-                        self.update_received.emit(message)
-                except json.JSONDecodeError:
-                    continue
-                    
-            except ConnectionResetError:
-                time.sleep(0.1)
-            except Exception as e:
-                if self.running:  # Only log if we're supposed to be running
-                    print(f"Socket receive error: {e}")
-                time.sleep(1)
-                
-    def _discovery_loop(self):
-        """Thread function for automatic peer discovery"""
-        while self.running:
+                    self._sendto(self.discovery_socket, self.discovery_transport,
+                                 self._discovery_message('discovery_response'), addr)
+                except OSError as e:
+                    print(f"Discovery error: {e}")
+            self.peer_discovered.emit(host)
+
+    async def _discovery_loop(self):
+        """Send a discovery heartbeat and expire silent peers every DISCOVERY_INTERVAL seconds"""
+        while True:
             try:
-                if not self.broadcast_socket:
-                    time.sleep(5)
+                self._sendto(self.discovery_socket, self.discovery_transport,
+                             self._discovery_message('discovery'), ('<broadcast>', self.broadcast_port))
+            except OSError as e:
+                print(f"Discovery error: {e}")
+            self._expire_peers()
+            await asyncio.sleep(DISCOVERY_INTERVAL)
+
+    def _discovery_message(self, kind):
+        return json.dumps(self._with_wire({'type': kind, 'id': self.instance_id})).encode()
+
+    def _expire_peers(self):
+        deadline = time.monotonic() - PEER_TTL
+        for host, seen in list(self.peer_seen.items()):
+            if seen < deadline:
+                self._forget_peer(host)
+                self.peer_lost.emit(host)
+
+    def _forget_peer(self, host):
+        self.peers.discard(host)
+        self.peer_seen.pop(host, None)
+        self.peer_wire.pop(host, None)
+        self._send_failures.pop(host, None)
+
+    def _with_wire(self, message):
+        """Copy of a JSON message advertising the binary versions we read"""
+        return dict(message, wire=list(wire_format.SUPPORTED_VERSIONS))
+
+    def _note_wire(self, host, versions):
+        version = wire_format.negotiate(versions)
+        if version:
+            self.peer_wire[host] = version
+        else:
+            self.peer_wire.pop(host, None)
+
+    def _send(self, packets):
+        """Queue (data, (host, port)) packets for sending on the event loop"""
+        self.loop.call_soon_threadsafe(self._send_now, packets)
+
+    def _send_now(self, packets):
+        if not self.transport:
+            return
+        for data, (host, port) in packets:
+            try:
+                self._sendto(self.socket, self.transport, data, (host, port))
+                self._send_failures.pop(host, None)
+            except OSError as e:
+                print(f"Error sending to {host}: {e}")
+                if host == self.multicast_group:
+                    self._send_unicast(data)
                     continue
-                    
-                # Broadcast discovery request
-                message = {'type': 'discovery'}
-                self.broadcast_socket.sendto(
-                    json.dumps(message).encode(),
-                    ('<broadcast>', self.broadcast_port)
-                )
-                
-                # Listen for responses
-                start_time = time.time()
-                while time.time() - start_time < 1:  # Listen for 1 second
-                    try:
-                        data, addr = self.broadcast_socket.recvfrom(1024)
-                        message = json.loads(data.decode())
-                        if message.get('type') == 'discovery_response':
-                            peer_ip = message['host']
-                            if peer_ip not in self.peers and peer_ip != self._get_local_ip():
-                                self.peers.add(peer_ip)
-                                self.peer_discovered.emit(peer_ip)
-                    except socket.timeout:
-                        continue
-                        
-                time.sleep(5)  # Check for peers every 5 seconds
-                
-            except Exception as e:
-                if self.running:  # Only log if we're supposed to be running
-                    print(f"Discovery error: {e}")
-                time.sleep(5)
-                
-    def _get_local_ip(self):
-        """Get local IP address"""
+                # A single error can be transient (e.g. no route while a link comes up)
+                failures = self._send_failures.get(host, 0) + 1
+                self._send_failures[host] = failures
+                if failures >= PEER_SEND_FAILURES:
+                    self._forget_peer(host)
+                    self.peer_lost.emit(host)
+
+    def _sendto(self, sock, transport, data, addr):
+        """Send a datagram (event loop thread). Raises OSError if it cannot be sent.
+
+        transport.sendto() would only pass the error to the protocol, without
+        saying which peer it was for.
+        """
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(('8.8.8.8', 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except Exception:
-            return '127.0.0.1'
-            
+            sock.sendto(data, addr)
+        except BlockingIOError:
+            transport.sendto(data, addr)  # Send buffer full: the transport queues it
+
+    def _send_unicast(self, data):
+        """Fallback for a multicast that could not be sent: one copy per known peer"""
+        self._send_now([(data, (peer, self.port)) for peer in list(self.peers)])
+
+    def request_snapshot(self):
+        """Ask every peer for its current state.
+
+        The request goes to the known peers and as a broadcast on our port,
+        so it also reaches panels not discovered yet. Replies arrive through
+        snapshot_received. Returns the request id, or None if the socket
+        could not be started.
+        """
+        if not self.running and not self.start():
+            return None
+        request_id = uuid.uuid4().hex
+        self._snapshot_requests = {request_id}  # Late replies to older requests are ignored
+        data = json.dumps(self._with_wire({'type': 'snapshot_request', 'request_id': request_id})).encode()
+        if self.multicast:
+            self._send([(data, (self.multicast_group, self.port))])
+        else:
+            self._send([(data, (target, self.port)) for target in list(self.peers) + ['<broadcast>']])
+        return request_id
+
+    def send_snapshot(self, host, request_id, seq, state):
+        """Answer a snapshot request. `seq` is the newest signals_log id `state` includes"""
+        if not self.running:
+            return False
+        message = {'type': 'snapshot_response', 'request_id': request_id, 'seq': seq, 'state': state}
+        self._send([(json.dumps(self._with_wire(message)).encode(), (host, self.port))])
+        return True
+
     def send_update(self, message):
-        """Send an update to all known peers"""
+        """Send an update to all known peers.
+
+        Peers that negotiated a binary wire version get that version; the
+        others, and messages their version cannot carry, go as JSON. In
+        multicast mode the update is sent once, in the lowest format every
+        known peer reads.
+        """
         if not self.running:
             if not self.start():
                 return False
-                
-        for peer in list(self.peers):  # Create a copy to avoid modification during iteration
-            try:
-                if not self.socket:
-                    continue
-                self.socket.sendto(json.dumps(message).encode(), (peer, self.port))
-            except Exception as e:
-                print(f"Error sending to {peer}: {e}")
-                self.peers.discard(peer)  # Remove bad peers
+
+        if self.multicast:
+            versions = [self.peer_wire.get(peer) for peer in self.peers]
+            version = min(versions) if versions and None not in versions else None
+            data = wire_format.encode_state_update(message, version) if version else None
+            if data is None:
+                data = json.dumps(self._with_wire(message)).encode()
+            self._send([(data, (self.multicast_group, self.port))])
+            return True
+
+        binary = {}  # wire version -> encoded message, so each version is encoded once
+        json_data = None
+        packets = []
+        for peer in list(self.peers):
+            version = self.peer_wire.get(peer)
+            if version and version not in binary:
+                binary[version] = wire_format.encode_state_update(message, version)
+            data = binary.get(version)
+            if data is None:
+                if json_data is None:
+                    json_data = json.dumps(self._with_wire(message)).encode()
+                data = json_data
+            packets.append((data, (peer, self.port)))
+        self._send(packets)
         return True
-                
+
     def stop(self):
-        """Clean up resources"""
+        """Close both sockets. Returns at once; the event loop does the closing"""
         self.running = False
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
-            self.socket = None
-        if self.broadcast_socket:
-            try:
-                self.broadcast_socket.close()
-            except:
-                pass
-            self.broadcast_socket = None
-            
-        if self.receive_thread:
-            self.receive_thread.join(timeout=1)
-        if self.discovery_thread:
-            self.discovery_thread.join(timeout=1)
\ No newline at end of file
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.multicast = False
+        if self.discovery_task:
+            self.discovery_task.cancel()
+            self.discovery_task = None
+        for transport in (self.transport, self.discovery_transport):
+            if transport:
+                transport.close()
+        self.transport = None
+        self.discovery_transport = None
+        self.socket = None
+        self.discovery_socket = None
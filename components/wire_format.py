@@ -0,0 +1,147 @@
+import struct
+from datetime import datetime, timedelta
+
+# Compact binary encoding of state_update messages.
+#
+# A JSON state_update is about 300 bytes; the binary form is a few bytes
+# of header and codes plus the source name.
+#
+# Version 1 carries every field:
+#
+#   magic 'KP' | 1 | message type | led | ledL | button | buttonL | pwf
+#   | protocol | timestamp (int64 microseconds) | source length | source
+#
+# Version 2 carries sequenced deltas (see ManualWindow.broadcast_state):
+#
+#   magic 'KP' | 2 | message type | epoch (uint32) | seq (uint32) | flags
+#   | field mask | one code per field in the mask | timestamp
+#   | source length | source
+#
+# flags bit 0 marks a keyframe; mask bit i is set when the i-th entry of
+# _STATE_FIELDS is present. Field values are one-byte codes from the
+# tables below.
+#
+# Version 3 is version 2 plus pwf_version: mask bit 6 marks it, and it
+# follows the codes as an int64 (-1 for None).
+#
+# A message the requested version cannot carry makes
+# encode_state_update() return None so the caller can send JSON instead.
+# Peers advertise the versions they read in the 'wire' field of their
+# JSON messages, and SocketManager only sends binary to peers that did.
+
+MAGIC = b'KP'
+VERSION = 3
+SUPPORTED_VERSIONS = (1, 2, 3)
+
+MSG_STATE_UPDATE = 1
+FLAG_KEYFRAME = 0x01
+
+_HEADER = struct.Struct('!2sBB')
+_SEQUENCE = struct.Struct('!IIBB')
+_TAIL = struct.Struct('!qB')
+_PWF_VERSION = struct.Struct('!q')
+_PWF_VERSION_BIT = 1 << 6
+
+LED_CODES = {None: 0, 'off': 1, 'on': 2}
+BUTTON_CODES = {None: 0, 'not pressed': 1, 'pressed': 2}
+PWF_CODES = {None: 0, 'P': 1, 'S': 2, 'W': 3, 'F': 4}
+PROTOCOL_CODES = {None: 0, 'CAN': 1, 'LIN': 2}
+
+_STATE_FIELDS = (
+    ('led_state', LED_CODES),
+    ('ledL_state', LED_CODES),
+    ('button_state', BUTTON_CODES),
+    ('buttonL_state', BUTTON_CODES),
+    ('pwf_state', PWF_CODES),
+    ('protocol', PROTOCOL_CODES),
+)
+_FIELD_NAMES = {name for name, _ in _STATE_FIELDS}
+_KNOWN_FIELDS = {
+    1: {'type', 'source', 'timestamp'} | _FIELD_NAMES,
+    2: {'type', 'source', 'timestamp', 'epoch', 'seq', 'keyframe'} | _FIELD_NAMES,
+    3: {'type', 'source', 'timestamp', 'epoch', 'seq', 'keyframe', 'pwf_version'} | _FIELD_NAMES,
+}
+_VALUES = {name: {code: value for value, code in table.items()} for name, table in _STATE_FIELDS}
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+def is_binary(data):
+    return data[:2] == MAGIC
+
+def negotiate(versions):
+    """Highest wire version both sides read, or None for JSON only"""
+    common = set(versions or ()) & set(SUPPORTED_VERSIONS)
+    return max(common) if common else None
+
+def _to_micros(timestamp):
+    return (datetime.fromisoformat(timestamp) - _EPOCH) // _MICROSECOND if timestamp else 0
+
+def _from_micros(micros):
+    return (_EPOCH + micros * _MICROSECOND).isoformat() if micros else None
+
+def encode_state_update(message, version=VERSION):
+    """`version` binary form of a state_update dict, or None if that version cannot carry it"""
+    if message.get('type') != 'state_update' or not _KNOWN_FIELDS.get(version, set()).issuperset(message):
+        return None
+    try:
+        source = (message.get('source') or '').encode()
+        if len(source) > 255:
+            return None
+        tail = _TAIL.pack(_to_micros(message.get('timestamp')), len(source)) + source
+
+        if version == 1:
+            if not _FIELD_NAMES.issubset(message):
+                return None  # Deltas need version 2
+            codes = [table[message[name]] for name, table in _STATE_FIELDS]
+            return _HEADER.pack(MAGIC, 1, MSG_STATE_UPDATE) + bytes(codes) + tail
+
+        mask, codes = 0, []
+        for i, (name, table) in enumerate(_STATE_FIELDS):
+            if name in message:
+                mask |= 1 << i
+                codes.append(table[message[name]])
+        extra = b''
+        if 'pwf_version' in message:
+            mask |= _PWF_VERSION_BIT
+            pwf_version = message['pwf_version']
+            extra = _PWF_VERSION.pack(-1 if pwf_version is None else pwf_version)
+        flags = FLAG_KEYFRAME if message.get('keyframe') else 0
+        sequence = _SEQUENCE.pack(message.get('epoch', 0), message.get('seq', 0), flags, mask)
+        return _HEADER.pack(MAGIC, version, MSG_STATE_UPDATE) + sequence + bytes(codes) + extra + tail
+    except (KeyError, TypeError, ValueError, struct.error):
+        return None
+
+def decode(data):
+    """Message dict from a binary datagram, or None if it is malformed or of an unknown version"""
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, message_type = _HEADER.unpack_from(data)
+    if magic != MAGIC or version not in SUPPORTED_VERSIONS or message_type != MSG_STATE_UPDATE:
+        return None
+    message = {'type': 'state_update'}
+    offset = _HEADER.size
+    try:
+        if version == 1:
+            fields = _STATE_FIELDS
+        else:
+            epoch, seq, flags, mask = _SEQUENCE.unpack_from(data, offset)
+            offset += _SEQUENCE.size
+            message.update(epoch=epoch, seq=seq, keyframe=bool(flags & FLAG_KEYFRAME))
+            fields = [field for i, field in enumerate(_STATE_FIELDS) if mask & (1 << i)]
+        for name, _ in fields:
+            message[name] = _VALUES[name][data[offset]]
+            offset += 1
+        if version >= 3 and mask & _PWF_VERSION_BIT:
+            pwf_version, = _PWF_VERSION.unpack_from(data, offset)
+            offset += _PWF_VERSION.size
+            message['pwf_version'] = None if pwf_version < 0 else pwf_version
+        micros, source_length = _TAIL.unpack_from(data, offset)
+        offset += _TAIL.size
+        if len(data) != offset + source_length:
+            return None
+        message['source'] = data[offset:].decode()
+    except (IndexError, KeyError, struct.error, UnicodeDecodeError):
+        return None
+    message['timestamp'] = _from_micros(micros)
+    return message
@@ -1,7 +1,39 @@
-import mysql.connector
-from mysql.connector import Error, pooling
+import os
 from datetime import datetime
+import threading
 import time
+import uuid
+import hashlib
+from contextlib import contextmanager
+from offline_journal import OfflineJournal, journal_path
+from db_backends import MySQLBackend, SQLiteBackend
+from db_metrics import DbMetrics, InstrumentedConnection
+from db_leases import LeaseManager, caller
+from signal_archive import list_archives, read_archive, next_month
+
+# Storage backend: 'mysql' (default) or 'sqlite' for offline runs and benchmarks
+DB_BACKEND = os.environ.get('KPIT_DB_BACKEND', 'mysql')
+SQLITE_PATH = os.environ.get('KPIT_SQLITE_PATH', ':memory:')
+
+# Statements slower than this are printed; a non-zero interval dumps the
+# metrics periodically, to METRICS_PATH as JSON lines if that is set
+SLOW_QUERY_MS = float(os.environ.get('KPIT_SLOW_QUERY_MS', '100'))
+METRICS_INTERVAL = float(os.environ.get('KPIT_DB_METRICS_INTERVAL', '0'))
+METRICS_PATH = os.environ.get('KPIT_DB_METRICS_PATH')
+
+# Connections held longer than this many seconds are reported with their
+# borrower; KPIT_LEASE_RECLAIM=1 also takes them back (MySQL only)
+LEASE_DEADLINE = float(os.environ.get('KPIT_LEASE_DEADLINE', '30'))
+LEASE_RECLAIM = os.environ.get('KPIT_LEASE_RECLAIM') == '1'
+
+# Queued writes that repeat a signal's current value are dropped; with a
+# non-zero interval one repeat is still logged that often as a heartbeat
+HEARTBEAT_SECONDS = float(os.environ.get('KPIT_HEARTBEAT_SECONDS', '0'))
+
+# Ids below a ChangeFeed's cursor it reads again on every poll. With several
+# writers a lower id can commit after a higher one was read; this should
+# cover the rows others write while one transaction is open
+CHANGE_FEED_REREAD = int(os.environ.get('KPIT_CHANGE_FEED_REREAD', '200'))
 
 # Database Configuration
 DB_CONFIG = {
@@ -15,130 +47,927 @@ DB_CONFIG = {
     'pool_size': 10
 }
 
-# Create connection pool with retries
-connection_pool = None
-max_retries = 3
-retry_delay = 2  # seconds
+# Signals tracked per protocol by the control panels
+SIGNAL_NAMES = ('led', 'button', 'ledL', 'buttonL')
+TRACKED_SIGNALS = (('led', 'CAN'), ('button', 'CAN'), ('ledL', 'LIN'), ('buttonL', 'LIN'))
+_SIGNAL_PLACEHOLDERS = ', '.join(['%s'] * len(SIGNAL_NAMES))
 
-for attempt in range(max_retries):
-    try:
-        connection_pool = pooling.MySQLConnectionPool(**DB_CONFIG)
-        print("✅ Connection pool created successfully!")
-        break
-    except Error as e:
-        print(f"❌ Attempt {attempt+1} failed: {e}")
-        if attempt < max_retries - 1:
-            time.sleep(retry_delay)
-else:
-    print("❌ Failed to create connection pool after multiple attempts")
-
-def get_connection():
-    """Get a connection from the pool"""
-    if not connection_pool:
-        return None
+# Named statements used by this module. `python migrations.py check` runs
+# EXPLAIN on every entry, so new queries belong here rather than inline.
+QUERIES = {
+    'last_update_time': f"""
+        SELECT MAX(timestamp)
+        FROM signal_state_current
+        WHERE signal_name IN ({_SIGNAL_PLACEHOLDERS})
+    """,
+    'latest_change_id': "SELECT MAX(id) FROM signals_log",
+    'changes': """
+        SELECT id, signal_name, value, source, protocol, timestamp
+        FROM signals_log
+        WHERE id > %s
+        ORDER BY id
+        LIMIT %s
+    """,
+    'history': """
+        SELECT id, signal_name, value, source, protocol, timestamp
+        FROM signals_log
+        WHERE signal_name = %s AND protocol = %s AND timestamp >= %s AND timestamp < %s
+        ORDER BY timestamp
+    """,
+    'state_before': """
+        SELECT value, timestamp
+        FROM signals_log
+        WHERE signal_name = %s AND protocol = %s AND timestamp < %s
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """,
+    'state_snapshot': f"""
+        SELECT 'pwf_state', NULL, (
+            SELECT state FROM pwf_state
+            WHERE is_active = 1
+            ORDER BY timestamp DESC LIMIT 1
+        ), NULL
+        UNION ALL
+        SELECT 'pwf_version', NULL, (
+            SELECT version FROM pwf_state
+            WHERE is_active = 1
+            ORDER BY timestamp DESC LIMIT 1
+        ), NULL
+        UNION ALL
+        SELECT 'change_id', NULL, (SELECT MAX(id) FROM signals_log), NULL
+        UNION ALL
+        SELECT signal_name, protocol, value, timestamp
+        FROM signal_state_current
+        WHERE signal_name IN ({_SIGNAL_PLACEHOLDERS})
+    """,
+    # Steps of a PWF transition, for backends without the pwf_transition
+    # procedure (see migrations.py for the MySQL version)
+    'pwf_check': """
+        SELECT is_active, version
+        FROM pwf_state
+        WHERE state = %s
+    """,
+    'pwf_active_version': """
+        SELECT version
+        FROM pwf_state
+        WHERE is_active = 1
+        ORDER BY timestamp DESC LIMIT 1
+    """,
+    'pwf_deactivate': """
+        UPDATE pwf_state
+        SET is_active = 0
+        WHERE is_active = 1 AND state <> %s
+    """,
+    'pwf_activate': """
+        UPDATE pwf_state
+        SET is_active = 1, version = %s, timestamp = %s
+        WHERE state = %s
+    """,
+    'current_values': f"""
+        SELECT signal_name, protocol, value, timestamp
+        FROM signal_state_current
+        WHERE signal_name IN ({_SIGNAL_PLACEHOLDERS})
+    """,
+    'leds_on': """
+        SELECT signal_name, protocol
+        FROM signal_state_current
+        WHERE signal_name IN ('led', 'ledL') AND value = 'on'
+    """,
+}
+
+# One round trip: version check, audit row, activation and forced LED-off
+PWF_TRANSITION_CALL = "CALL pwf_transition(%s, %s, %s, %s, %s, %s, %s)"
+
+# LEDs switched off by a transition to P or S
+_FORCED_OFF = (('led', 'CAN'), ('ledL', 'LIN'))
+
+class PwfVersionConflict(Exception):
+    """Another panel changed the PWF state since the caller last read it"""
+
+metrics = DbMetrics({sql: name for name, sql in QUERIES.items()}, SLOW_QUERY_MS)
+if METRICS_INTERVAL > 0:
+    metrics.start_dump(METRICS_INTERVAL, METRICS_PATH)
+
+leases = LeaseManager(LEASE_DEADLINE, LEASE_RECLAIM)
+
+_backend = None
+_backend_lock = threading.Lock()
+_ready_callbacks = []
+
+def _notify_ready():
+    for callback in list(_ready_callbacks):
+        try:
+            callback()
+        except Exception as e:
+            print("Error in database ready callback:", e)
+
+def configure(backend=None, **options):
+    """Select the storage backend ('mysql' or 'sqlite') and its options.
+
+    For SQLite, pass path='file.db' (default SQLITE_PATH). Replaces any
+    backend already in use. Never blocks on the network: the MySQL pool
+    is created in the background (see warm_up).
+    """
+    global _backend
+    name = backend or DB_BACKEND
+    if name == 'sqlite':
+        new_backend = SQLiteBackend(options.get('path', SQLITE_PATH), on_ready=_notify_ready)
+    elif name == 'mysql':
+        new_backend = MySQLBackend(options.get('config', DB_CONFIG), on_ready=_notify_ready)
+    else:
+        raise ValueError(f"Unknown database backend: {name}")
     
+    with _backend_lock:
+        old_backend, _backend = _backend, new_backend
+    if old_backend:
+        old_backend.close()
+    return new_backend
+
+def get_backend():
+    """Get the configured storage backend, creating it on first use"""
+    with _backend_lock:
+        if _backend is not None:
+            return _backend
+    return configure()
+
+def warm_up():
+    """Start connecting in the background so the first query finds a ready pool"""
+    get_backend().warm_up()
+
+def is_ready():
+    """Whether the backend can hand out connections yet"""
+    return get_backend().ready.is_set()
+
+def wait_until_ready(timeout=None):
+    """Block until the backend is ready. Returns False on timeout"""
+    backend = get_backend()
+    backend.warm_up()
+    return backend.ready.wait(timeout)
+
+def add_ready_callback(callback):
+    """Call `callback()` whenever a backend becomes ready (from its warm-up thread).
+
+    Called right away if the current backend is already ready.
+    """
+    backend = get_backend()
+    _ready_callbacks.append(callback)
+    if backend.ready.is_set():
+        callback()
+
+def remove_ready_callback(callback):
+    if callback in _ready_callbacks:
+        _ready_callbacks.remove(callback)
+
+def get_connection(validate=False):
+    """Get a connection from the configured backend, or None if it is not ready
+
+    Pooled connections are only pinged when they have been idle for a
+    while; pass validate=True to always check the server answers.
+    Checkout time and every statement run on the connection are recorded
+    in `metrics`, and the connection is leased to the caller until it is
+    closed (see `leases`). Prefer `with connection() as conn:`.
+    """
+    backend = get_backend()
+    started = time.perf_counter()
+    conn = backend.get_connection(validate)
+    metrics.observe_checkout((time.perf_counter() - started) * 1000, conn is not None)
+    if not conn:
+        if backend.ready.is_set() and len(leases.active) >= backend.pool_size:
+            leases.starved()
+        return None
+    conn = leases.lease(conn, caller(), backend.pool_size)
+    return InstrumentedConnection(conn, metrics)
+
+@contextmanager
+def connection(validate=False):
+    """Borrow a connection for the duration of a with block.
+
+    Yields None if the database is unavailable. The connection is closed
+    (and its lease ended) however the block exits.
+    """
+    conn = get_connection(validate)
     try:
-        conn = connection_pool.get_connection()
-        conn.autocommit = False
-        
-        # Test the connection is actually working
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.fetchall()
-        cursor.close()
-        
-        return conn
-    except Error as e:
-        print(f"Error getting connection from pool: {e}")
+        yield conn
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+
+def get_pool_utilisation():
+    """Borrowed connections, utilisation history and lease statistics"""
+    return leases.utilisation()
+
+def get_metrics():
+    """Query latency histograms, checkout wait and error counts as a dict"""
+    snapshot = metrics.snapshot()
+    snapshot['pool_exhausted'] = getattr(get_backend(), 'exhausted', 0)
+    return snapshot
+
+def get_validation_stats():
+    """Connection validation counters of the MySQL pool (None for other backends)
+
+    'estimated_saved_ms' is the skipped validations times the average ping.
+    """
+    stats = getattr(get_backend(), 'validation_stats', None)
+    if stats is None:
         return None
+    stats = dict(stats)
+    average_ping = stats['ping_seconds'] / stats['validated'] if stats['validated'] else 0.0
+    stats['estimated_saved_ms'] = stats['skipped'] * average_ping * 1000
+    return stats
+
+def _fetch(query_name, params=(), dictionary=False):
+    """Run a read-only entry of QUERIES and return all its rows.
+
+    A read that fails because the connection went stale is retried once on
+    a revalidated connection. Returns None if the database is unavailable;
+    other errors are raised.
+    """
+    for attempt in (1, 2):
+        with connection() as conn:
+            if not conn:
+                return None
+            try:
+                cursor = conn.cursor(dictionary=dictionary)
+                cursor.execute(QUERIES[query_name], params)
+                rows = cursor.fetchall()
+                cursor.close()
+                return rows
+            except Exception as e:
+                if attempt == 2 or not _connection_lost(e):
+                    raise
 
 def get_last_update_time():
-    """Get the most recent timestamp from the database"""
-    conn = get_connection()
-    if not conn:
-        return None
-    
+    """Get the most recent timestamp of the tracked signals"""
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT MAX(timestamp) 
-            FROM signals_log 
-            WHERE signal_name IN ('led', 'button', 'ledL', 'buttonL')
-        """)
-        result = cursor.fetchone()
-        cursor.close()
-        return result[0] if result else None
+        rows = _fetch('last_update_time', SIGNAL_NAMES)
+        return rows[0][0] if rows else None
     except Exception as e:
         print("Error getting last update time:", e)
         return None
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
 
-def get_current_states():
-    """Get current states in a single optimized query"""
-    conn = get_connection()
-    if not conn:
-        return None, None, None
+def get_latest_change_id():
+    """Get the id of the newest signals_log row (0 for an empty table)"""
+    try:
+        rows = _fetch('latest_change_id')
+        if rows is None:
+            return None
+        return rows[0][0] or 0
+    except Exception as e:
+        print("Error getting latest change id:", e)
+        return None
+
+def get_changes(after_id, limit=500):
+    """Get up to `limit` signals_log rows with id > after_id, oldest first
+
+    Each row is a dict with id, signal_name, value, source, protocol and
+    timestamp. Returns None if the database is unavailable.
+    """
+    try:
+        return _fetch('changes', (after_id, limit), dictionary=True)
+    except Exception as e:
+        print("Error getting changes:", e)
+        return None
+
+class ChangeFeed:
+    """Incremental reader over signals_log driven by a row-id cursor.
+
+    poll() returns only rows the caller has not seen yet, so the work per
+    poll follows the number of changes rather than the size of the table,
+    and rows sharing the same timestamp are never skipped.
+
+    Ids are handed out at insert but rows only show at commit, so with
+    concurrent writers a lower id can appear after a higher one was read.
+    Every poll therefore reads the last `reread` ids again and returns the
+    rows among them it has not returned before; such a late row comes in
+    a later poll, behind rows with higher ids.
+    """
+    def __init__(self, signal_names=None, batch_size=500, last_id=None, reread=CHANGE_FEED_REREAD):
+        self.signal_names = tuple(signal_names) if signal_names else None
+        self.batch_size = batch_size
+        self.reread = reread
+        self.last_id = last_id
+        self._floor = last_id  # Rows up to this id are never returned
+        self._seen = set()  # Ids above _floor already returned
+
+    def seek_latest(self):
+        """Move the cursor to the newest row. Returns False if the DB is unavailable"""
+        latest = get_latest_change_id()
+        if latest is None:
+            return False
+        self.last_id = self._floor = latest
+        self._seen.clear()
+        return True
+
+    def skip(self, rows):
+        """Mark rows the caller got some other way (e.g. from the relay) as returned"""
+        if self.last_id is None or not rows:
+            return
+        self._seen.update(row['id'] for row in rows if row['id'] > self._floor)
+        self.last_id = max(self.last_id, max(row['id'] for row in rows))
+        self._trim()
+
+    def poll(self, max_batches=10):
+        """Fetch rows not returned yet and advance the cursor
+
+        Reads at most `max_batches` batches per call; anything left is
+        picked up by the next poll. Returns a list of row dicts, or None
+        if the database is unavailable.
+        """
+        if self.last_id is None and not self.seek_latest():
+            return None
+
+        changes = []
+        after_id = max(self._floor, self.last_id - self.reread)
+        for _ in range(max_batches):
+            rows = get_changes(after_id, self.batch_size)
+            if rows is None:
+                self._trim()
+                return changes or None
+            if not rows:
+                break
+            new = [row for row in rows if row['id'] not in self._seen]
+            self._seen.update(row['id'] for row in new)
+            # Filter here so the server only walks a primary-key range
+            if self.signal_names:
+                changes.extend(row for row in new if row['signal_name'] in self.signal_names)
+            else:
+                changes.extend(new)
+            after_id = rows[-1]['id']
+            self.last_id = max(self.last_id, after_id)
+            if len(rows) < self.batch_size:
+                break
+        self._trim()
+        return changes
+
+    def _trim(self):
+        # Ids that fell out of the re-read window are never looked at again
+        self._floor = max(self._floor, self.last_id - self.reread)
+        self._seen = {row_id for row_id in self._seen if row_id > self._floor}
+
+def get_signal_history(start, end=None, signals=TRACKED_SIGNALS, include_archive=False, archive_dir=None):
+    """Get signals_log rows with start <= timestamp < end, oldest first
+
+    `signals` is a list of (signal_name, protocol) pairs; each is one index
+    range scan. With include_archive=True, months already moved out by
+    retention.py are read back from their archive files as well. Rows are
+    dicts like get_changes() returns. Returns None if the database is
+    unavailable.
+    """
+    end = end or datetime.now()
+    rows = {}
+    with connection() as conn:
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor(dictionary=True)
+            for signal_name, protocol in signals:
+                cursor.execute(QUERIES['history'], (signal_name, protocol, start, end))
+                rows.update((row['id'], row) for row in cursor.fetchall())
+            cursor.close()
+        except Exception as e:
+            print("Error getting signal history:", e)
+            return None
+
+    if include_archive:
+        wanted = set(signals)
+        for month, path in list_archives(archive_dir):
+            if month >= end or next_month(month) <= start:
+                continue
+            for row in read_archive(path):
+                if (row['signal_name'], row['protocol']) in wanted and start <= row['timestamp'] < end:
+                    row.pop('event_id', None)
+                    rows.setdefault(row['id'], row)
+    return sorted(rows.values(), key=lambda row: (row['timestamp'], row['id']))
+
+def get_values_before(start, signals=TRACKED_SIGNALS, include_archive=False, archive_dir=None):
+    """Get the value each signal had at `start`: {(signal_name, protocol): value or None}
+
+    That is the value of its newest row before `start`. With
+    include_archive=True, months moved out by retention.py count too, so
+    a range starting in or just after an archived month still gets its
+    starting values. Returns None if the database is unavailable.
+    """
+    newest = {}  # (signal_name, protocol) -> (timestamp, value)
+    with connection() as conn:
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            for signal_name, protocol in signals:
+                cursor.execute(QUERIES['state_before'], (signal_name, protocol, start))
+                row = cursor.fetchone()
+                if row:
+                    newest[(signal_name, protocol)] = (row[1], row[0])
+            cursor.close()
+        except Exception as e:
+            print("Error getting signal values:", e)
+            return None
+
+    if include_archive:
+        # Newest month first; a signal found in one month needs no older ones
+        missing = set(signals)
+        for month, path in reversed(list_archives(archive_dir)):
+            if not missing:
+                break
+            if month >= start:
+                continue
+            found = set()
+            for row in read_archive(path):
+                key = (row['signal_name'], row['protocol'])
+                if key in missing and row['timestamp'] < start:
+                    found.add(key)
+                    if key not in newest or row['timestamp'] >= newest[key][0]:
+                        newest[key] = (row['timestamp'], row['value'])
+            missing -= found
+    return {key: newest[key][1] if key in newest else None for key in signals}
+
+def insert_signal_rows(cursor, rows):
+    """Insert (signal_name, value, source, timestamp, protocol, event_id) rows
+    into signals_log and refresh signal_state_current on the caller's cursor.
+
+    Both statements run in the caller's transaction, so they commit (or
+    roll back) together. Rows whose event_id is already logged are skipped,
+    and signal_state_current never moves back to an older timestamp, so
+    replaying the same rows is harmless. Returns the number of new log rows.
+    """
+    if not rows:
+        return 0
     
+    backend = get_backend()
+    cursor.execute(backend.insert_log_sql(len(rows)), [value for row in rows for value in row])
+    inserted = cursor.rowcount
+    cursor.execute(backend.upsert_state_sql(len(rows)), [value for row in rows for value in row[:5]])
+    return inserted
+
+def _signal_rows(signals, source, timestamp):
+    timestamp = timestamp or datetime.now()
+    return [(signal_name, value, source, timestamp, protocol, uuid.uuid4().hex)
+            for signal_name, value, protocol in signals]
+
+def log_signals(cursor, signals, source='GUI', timestamp=None):
+    """Append (signal_name, value, protocol) tuples to signals_log and
+    signal_state_current in the caller's transaction"""
+    return insert_signal_rows(cursor, _signal_rows(signals, source, timestamp))
+
+def suppress_unchanged(cursor, rows, heartbeat=None):
+    """Drop rows that repeat the current value of their (signal_name, protocol).
+
+    Current values come from signal_state_current in one lookup on the
+    caller's cursor, then follow the rows in order. A repeat is kept as a
+    heartbeat if the value was last logged `heartbeat` seconds or more
+    before it (default HEARTBEAT_SECONDS; 0 disables heartbeats). Signals
+    outside SIGNAL_NAMES are never dropped. Returns (kept rows, suppressed
+    count, heartbeat count).
+    """
+    if heartbeat is None:
+        heartbeat = HEARTBEAT_SECONDS
+    if not any(row[0] in SIGNAL_NAMES for row in rows):
+        return rows, 0, 0
+
+    cursor.execute(QUERIES['current_values'], SIGNAL_NAMES)
+    current = {}
+    for signal_name, protocol, value, timestamp in cursor.fetchall():
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        current[(signal_name, protocol)] = (value, timestamp)
+
+    kept, suppressed, heartbeats = [], 0, 0
+    for row in rows:
+        signal_name, value, _, timestamp, protocol = row[:5]
+        key = (signal_name, protocol)
+        if signal_name in SIGNAL_NAMES and key in current and current[key][0] == value:
+            logged_at = current[key][1]
+            if not heartbeat or (logged_at and (timestamp - logged_at).total_seconds() < heartbeat):
+                suppressed += 1
+                continue
+            heartbeats += 1
+        kept.append(row)
+        current[key] = (value, timestamp)
+    return kept, suppressed, heartbeats
+
+def _connection_lost(e):
+    """Whether `e` means the database dropped the connection.
+
+    If so, pooled connections are revalidated before they are reused.
+    """
+    backend = get_backend()
+    if not backend.is_connection_error(e):
+        return False
+    backend.connection_failed()
+    return True
+
+_journals = {}  # journal name of a database -> OfflineJournal
+_journals_lock = threading.Lock()
+
+def get_journal():
+    """Get the offline journal of the configured database, opening it on first use"""
+    name = get_backend().journal_name()
+    with _journals_lock:
+        if name not in _journals:
+            _journals[name] = OfflineJournal(journal_path(name) if name else ':memory:')
+        return _journals[name]
+
+def _replay_entries(conn, entries):
+    """Write journal entries to the database in one transaction on `conn`"""
+    cursor = conn.cursor()
+    rows = []
+    for seq, kind, payload in entries:
+        if kind == 'signals':
+            rows.extend(tuple(row) for row in payload)
+            continue
+        insert_signal_rows(cursor, rows)
+        rows = []
+        if kind == 'pwf_state':
+            _apply_pwf_state(cursor, *payload)
+    insert_signal_rows(cursor, rows)
+    conn.commit()
+    cursor.close()
+
+def replay_journal(batch_size=500):
+    """Replay journaled offline writes to MySQL in order.
+
+    Consecutive signal entries go out as one multi-row INSERT per batch.
+    Entries are removed from the journal only after their batch commits,
+    and event ids make a repeated replay harmless. If the database rejects
+    a batch for any reason other than a lost connection, its entries are
+    retried one by one and the rejected ones quarantined (see
+    OfflineJournal.quarantine), so one bad entry cannot block the rest.
+    Returns the number of entries replayed, or None if the database is
+    unavailable.
+    """
+    journal = get_journal()
+    replayed = 0
+    while True:
+        entries = journal.read(batch_size)
+        if not entries:
+            return replayed
+        
+        conn = get_connection()
+        if not conn:
+            return None
+        before = replayed
+        try:
+            try:
+                _replay_entries(conn, entries)
+                journal.remove_through(entries[-1][0])
+                replayed += len(entries)
+            except Exception as e:
+                conn.rollback()
+                if _connection_lost(e):
+                    print("Error replaying offline journal:", e)
+                    return None
+                for entry in entries:
+                    try:
+                        _replay_entries(conn, [entry])
+                        journal.remove_through(entry[0])
+                        replayed += 1
+                    except Exception as e:
+                        conn.rollback()
+                        if _connection_lost(e):
+                            print("Error replaying offline journal:", e)
+                            return None
+                        print(f"⚠️ Quarantined offline journal entry #{entry[0]}: {e}")
+                        journal.quarantine(*entry, e)
+        finally:
+            if conn and conn.is_connected():
+                conn.close()
+        if replayed > before:
+            print(f"✅ Replayed {replayed - before} offline journal entries")
+
+class WriteTicket:
+    """Handle returned by queue_signals to wait for a queued write to commit"""
+    def __init__(self):
+        self.ok = None
+        self._done = threading.Event()
+
+    def resolve(self, ok):
+        self.ok = ok
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait until the write is committed to MySQL. Returns False if it
+        failed or was only journaled for a later replay"""
+        return self._done.wait(timeout) and bool(self.ok)
+
+class WriteBehindQueue:
+    """Groups queued signal inserts into multi-row INSERTs with one commit per batch.
+
+    A batch is written at most `flush_interval` seconds after its first row
+    was queued, or as soon as it holds `max_batch` rows. Rows submitted
+    together always land in the same batch. Rows that do not change a
+    signal's value are dropped (see suppress_unchanged). While MySQL is
+    unreachable, batches go to the offline journal and are replayed on
+    reconnect.
+    """
+    def __init__(self, flush_interval=0.02, max_batch=500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.running = False
+        self.thread = None
+        self.stats = {
+            'batches': 0, 'rows': 0, 'journaled': 0, 'errors': 0,
+            'suppressed': 0, 'heartbeats': 0,
+        }
+        self._pending = []  # (rows, ticket, time.monotonic() queued) in submit order
+        self._pending_rows = 0
+        self._flush_requested = False
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Start the flush thread"""
+        with self._cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, rows):
+        """Queue (signal_name, value, source, timestamp, protocol) rows. Returns a WriteTicket"""
+        ticket = WriteTicket()
+        if not rows:
+            ticket.resolve(True)
+            return ticket
+        with self._cond:
+            self._pending.append((rows, ticket, time.monotonic()))
+            self._pending_rows += len(rows)
+            self._cond.notify()
+        self.start()
+        return ticket
+
+    def has_pending(self):
+        with self._cond:
+            return bool(self._pending)
+
+    def flush(self, timeout=None):
+        """Write everything queued so far. Returns True if it was committed"""
+        with self._cond:
+            if not self._pending:
+                return True
+            tickets = [ticket for _, ticket, _ in self._pending]
+            self._flush_requested = True
+            self._cond.notify()
+        return all(ticket.wait(timeout) for ticket in tickets)
+
+    def stop(self, timeout=2.0):
+        """Flush pending rows and stop the flush thread"""
+        flushed = self.flush(timeout)
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        return flushed
+
+    def _next_batch(self):
+        with self._cond:
+            while self.running and not self._pending:
+                self._cond.wait()
+            while (self.running and not self._flush_requested
+                   and self._pending_rows < self.max_batch):
+                # Deadline of the oldest row still waiting, however many
+                # batches were written since it was queued
+                remaining = self._pending[0][2] + self.flush_interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, count = [], 0
+            while self._pending and (not batch or count + len(self._pending[0][0]) <= self.max_batch):
+                rows, ticket, _ = self._pending.pop(0)
+                batch.append((rows, ticket))
+                count += len(rows)
+            self._pending_rows -= count
+            if not self._pending:
+                self._flush_requested = False
+            return batch
+
+    def _run(self):
+        """Thread function writing batches"""
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if not self.running:
+                    break
+                continue
+            ok = self._write([row for rows, _ in batch for row in rows])
+            for _, ticket in batch:
+                ticket.resolve(ok)
+
+    def _write(self, rows):
+        # Older journaled rows go first so signals_log keeps its order
+        journal = get_journal()
+        if journal.pending_count() and replay_journal() is None:
+            journal.append_rows(rows)
+            self.stats['journaled'] += len(rows)
+            return False
+        
+        conn = get_connection()
+        if not conn:
+            journal.append_rows(rows)
+            self.stats['journaled'] += len(rows)
+            return False
+        
+        try:
+            cursor = conn.cursor()
+            kept, suppressed, heartbeats = suppress_unchanged(cursor, rows)
+            insert_signal_rows(cursor, kept)
+            conn.commit()
+            cursor.close()
+            self.stats['batches'] += 1
+            self.stats['rows'] += len(kept)
+            self.stats['suppressed'] += suppressed
+            self.stats['heartbeats'] += heartbeats
+            return True
+        except Exception as e:
+            conn.rollback()
+            if _connection_lost(e):
+                journal.append_rows(rows)
+                self.stats['journaled'] += len(rows)
+            else:
+                print(f"Error flushing {len(rows)} queued signal rows:", e)
+                self.stats['errors'] += 1
+            return False
+        finally:
+            if conn and conn.is_connected():
+                conn.close()
+
+write_queue = WriteBehindQueue()
+
+def queue_signals(signals, source='GUI', timestamp=None, wait=False, timeout=2.0):
+    """Queue (signal_name, value, protocol) tuples for the next group commit.
+
+    Returns a WriteTicket, or with wait=True blocks until the batch is
+    committed and returns True/False.
+    """
+    ticket = write_queue.submit(_signal_rows(signals, source, timestamp))
+    if wait:
+        return ticket.wait(timeout)
+    return ticket
+
+def get_write_stats():
+    """Counters of the write-behind queue: batches, rows, suppressed, heartbeats, journaled, errors"""
+    return dict(write_queue.stats)
+
+def flush_writes(timeout=2.0):
+    """Commit every queued signal row now. Call before shutdown"""
+    return write_queue.flush(timeout)
+
+def get_state_snapshot():
+    """Get the active PWF state and the latest value of every signal in one round trip
+
+    Signal values are primary-key lookups on signal_state_current, so the
+    cost does not grow with signals_log.
+
+    Returns a dict:
+        {'pwf_state': 'W' or None,
+         'pwf_version': version of the active PWF state (see set_pwf_state),
+         'change_id': id of the newest signals_log row the snapshot includes,
+         'signals': {(signal_name, protocol): value},
+         'last_change': newest timestamp among the latest signals}
+    or None if the database is unavailable.
+    """
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                MAX(CASE WHEN signal_name = 'led' THEN value END) as led_state,
-                MAX(CASE WHEN signal_name = 'button' THEN value END) as button_state,
-                MAX(CASE WHEN signal_name = 'ledL' THEN value END) as ledL_state,
-                MAX(CASE WHEN signal_name = 'buttonL' THEN value END) as buttonL_state,
-                MAX(timestamp) as last_change
-            FROM (
-                SELECT signal_name, value, timestamp
-                FROM signals_log
-                WHERE signal_name IN ('led', 'button', 'ledL', 'buttonL')
-                ORDER BY timestamp DESC
-                LIMIT 4
-            ) as latest_states
-        """)
-        row = cursor.fetchone()
-        cursor.close()
-        return (
-            row[0] or 'off',  # CAN led
-            row[1] or 'not pressed',  # CAN button
-            row[2] or 'off',  # LIN led
-            row[3] or 'not pressed',  # LIN button
-            row[4]  # timestamp
-        )
+        rows = _fetch('state_snapshot', SIGNAL_NAMES)
+        if rows is None:
+            return None
+        
+        snapshot = {'pwf_state': None, 'pwf_version': None, 'change_id': 0, 'signals': {}, 'last_change': None}
+        for signal_name, protocol, value, timestamp in rows:
+            if signal_name == 'pwf_state':
+                snapshot['pwf_state'] = value
+                continue
+            if signal_name == 'pwf_version':
+                snapshot['pwf_version'] = int(value) if value is not None else None
+                continue
+            if signal_name == 'change_id':
+                snapshot['change_id'] = int(value) if value is not None else 0
+                continue
+            snapshot['signals'][(signal_name, protocol)] = value
+            if isinstance(timestamp, str):  # SQLite drops the column type through UNION
+                timestamp = datetime.fromisoformat(timestamp)
+            if timestamp and (snapshot['last_change'] is None or timestamp > snapshot['last_change']):
+                snapshot['last_change'] = timestamp
+        return snapshot
     except Exception as e:
-        print("Error getting states:", e)
+        print("Error getting state snapshot:", e)
+        return None
+
+def get_current_states():
+    """Get current CAN/LIN states from the state snapshot"""
+    snapshot = get_state_snapshot()
+    if snapshot is None:
         return None, None, None, None, None
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
+    
+    signals = snapshot['signals']
+    return (
+        signals.get(('led', 'CAN')) or 'off',  # CAN led
+        signals.get(('button', 'CAN')) or 'not pressed',  # CAN button
+        signals.get(('ledL', 'LIN')) or 'off',  # LIN led
+        signals.get(('buttonL', 'LIN')) or 'not pressed',  # LIN button
+        snapshot['last_change']  # timestamp
+    )
 
 def update_states(led_state, button_state, protocol='CAN'):
-    """Update states in the database"""
-    conn = get_connection()
+    """Update states in the database and wait for the group commit"""
+    if protocol == 'CAN':
+        signals = [('led', led_state, 'CAN'), ('button', button_state, 'CAN')]
+    else:  # LIN
+        signals = [('ledL', led_state, 'LIN'), ('buttonL', button_state, 'LIN')]
+    return queue_signals(signals, wait=True)
+
+def _apply_pwf_state(cursor, new_state, protocol, timestamp, event_id,
+                     expected_state=None, expected_version=None, commit=False):
+    """Run a PWF transition on `cursor`.
+
+    Checks the caller's view (expected_state, expected_version) unless
+    expected_version is None, logs the audit row, activates new_state with
+    the next version and switches the LEDs off for P/S. The audit row's
+    event id makes a replay harmless. Raises PwfVersionConflict if the
+    state moved on. Returns True if the transaction was already committed.
+    """
+    if get_backend().has_procedures:
+        try:
+            cursor.execute(PWF_TRANSITION_CALL, (
+                new_state, expected_state, expected_version, protocol, timestamp, event_id, int(commit)
+            ))
+        except Exception as e:
+            if getattr(e, 'sqlstate', None) == '45000':
+                raise PwfVersionConflict(str(e))
+            raise
+        return commit
+
+    if expected_version is not None:
+        cursor.execute(QUERIES['pwf_check'], (expected_state,))
+        row = cursor.fetchone()
+        if not row or row[0] != 1 or row[1] != expected_version:
+            raise PwfVersionConflict("pwf_state version conflict")
+        version = expected_version
+    else:
+        cursor.execute(QUERIES['pwf_active_version'])
+        row = cursor.fetchone()
+        version = row[0] if row else 0
+
+    if not insert_signal_rows(cursor, [('pwf_state_change', new_state, 'GUI', timestamp, protocol, event_id)]):
+        return False  # Already applied by an earlier replay
+    cursor.execute(QUERIES['pwf_deactivate'], (new_state,))
+    cursor.execute(QUERIES['pwf_activate'], (version + 1, timestamp, new_state))
+
+    if new_state in ('P', 'S'):
+        cursor.execute(QUERIES['leds_on'])
+        rows = [
+            (signal_name, 'off', 'GUI', timestamp, led_protocol, _derived_event_id(event_id, signal_name))
+            for signal_name, led_protocol in cursor.fetchall()
+            if (signal_name, led_protocol) in _FORCED_OFF
+        ]
+        insert_signal_rows(cursor, rows)
+    return False
+
+def _derived_event_id(event_id, signal_name):
+    # Same as MD5(CONCAT(event_id, signal_name)) in the pwf_transition procedure
+    return hashlib.md5((event_id + signal_name).encode()).hexdigest()
+
+def set_pwf_state(new_state, protocol='CAN', expected_state=None, expected_version=None):
+    """Activate a PWF state, log the change and switch the LEDs off for P/S
+
+    Pass the state and version last read (see get_state_snapshot) to make
+    the transition conditional: PwfVersionConflict is raised if another
+    panel changed the state in between. On MySQL the whole transition is
+    one CALL that also commits.
+
+    While MySQL is unreachable the change is journaled and replayed on
+    reconnect; it still counts as accepted.
+    """
+    # Queued signal writes go first, or a queued LED 'on' could land after
+    # the transition and undo the forced LED-off of P/S
+    flush_writes()
+    timestamp = datetime.now()
+    event_id = uuid.uuid4().hex
+    journal = get_journal()
+    # Older journaled writes go first so the changes apply in order
+    conn = None
+    if not journal.pending_count() or replay_journal() is not None:
+        conn = get_connection()
     if not conn:
-        return False
+        journal.append_pwf_state(new_state, protocol, timestamp, event_id)
+        return True
     
     try:
         cursor = conn.cursor()
-        
-        if protocol == 'CAN':
-            cursor.execute("""
-            INSERT INTO signals_log (signal_name, value, source, protocol)
-            VALUES (%s, %s, 'GUI', 'CAN'), (%s, %s, 'GUI', 'CAN')
-            """, ('led', led_state, 'button', button_state))
-        else:  # LIN
-            cursor.execute("""
-            INSERT INTO signals_log (signal_name, value, source, protocol)
-            VALUES (%s, %s, 'GUI', 'LIN'), (%s, %s, 'GUI', 'LIN')
-            """, ('ledL', led_state, 'buttonL', button_state))
-        
-        conn.commit()
+        if not _apply_pwf_state(cursor, new_state, protocol, timestamp, event_id,
+                                expected_state, expected_version, commit=True):
+            conn.commit()
         return True
+    except PwfVersionConflict:
+        conn.rollback()
+        raise
     except Exception as e:
-        print("Error updating states:", e)
         conn.rollback()
+        if _connection_lost(e):
+            journal.append_pwf_state(new_state, protocol, timestamp, event_id)
+            return True
+        print("Error setting PWF state:", e)
         return False
     finally:
         if conn and conn.is_connected():
@@ -150,6 +979,7 @@ if __name__ == "__main__":
     
     # Test 1: Check connection
     print("\n[1] Testing database connection...")
+    wait_until_ready(timeout=10)
     conn = get_connection()
     if conn:
         print("✅ Connection successful!")
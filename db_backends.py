@@ -0,0 +1,463 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+from datetime import datetime
+
+try:
+    import mysql.connector
+    from mysql.connector import Error
+except ImportError:  # Only needed for the MySQL backend
+    mysql = None
+
+class StorageBackend:
+    """Interface db.py uses to reach the signal store.
+
+    A backend hands out DB-API connections that accept %s placeholders and
+    support cursor(dictionary=True), commit(), rollback(), close() and
+    is_connected(), and builds the few statements whose syntax differs
+    between databases. `ready` is set once connections can be handed out;
+    `on_ready` is called (from any thread) at that moment.
+    """
+    name = None
+    pool_size = 1
+    # Whether the pwf_transition stored procedure can be called
+    has_procedures = False
+
+    def __init__(self, on_ready=None):
+        self.ready = threading.Event()
+        self.on_ready = on_ready
+
+    def _set_ready(self):
+        self.ready.set()
+        if self.on_ready:
+            self.on_ready()
+
+    def warm_up(self):
+        """Start preparing connections in the background. Never blocks"""
+
+    def get_connection(self, validate=False):
+        """Get a connection, or None if the store is unavailable.
+
+        validate=True asks for a connection proven to work by a round trip.
+        """
+        raise NotImplementedError
+
+    def connection_failed(self):
+        """Called after a statement failed because the store dropped the connection"""
+
+    def is_connection_error(self, e):
+        """Whether `e` means the store is unreachable rather than the statement is wrong"""
+        return False
+
+    def journal_name(self):
+        """Name of this database for its offline journal file (see offline_journal.journal_path).
+
+        None keeps the journal in memory.
+        """
+        return None
+
+    def insert_log_sql(self, count):
+        """INSERT of `count` signals_log rows that skips already-logged event ids"""
+        raise NotImplementedError
+
+    def upsert_state_sql(self, count):
+        """Upsert of `count` signal_state_current rows that never moves back in time"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PooledConnection:
+    """Connection borrowed from MySQLBackend's pool; close() hands it back.
+
+    Everything else is delegated to the mysql.connector connection.
+    is_connected() reports whether the handle is still borrowed and never
+    pings the server, so the usual `if conn.is_connected(): conn.close()`
+    costs no round trip.
+    """
+    def __init__(self, backend, cnx):
+        self._backend = backend
+        self._cnx = cnx
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+    def is_connected(self):
+        return not self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._backend._release(self._cnx)
+
+    def reclaim(self):
+        """Take the slot back from a borrower that kept it too long.
+
+        The MySQL connection itself is closed rather than reused, since the
+        borrower may still be running a statement on it.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._cnx.close()
+        except Error:
+            pass
+        finally:
+            self._backend._slots.release()
+
+class MySQLBackend(StorageBackend):
+    """MySQL server reached through a small pool of mysql.connector connections.
+
+    The first connection is opened on a background thread, retrying with
+    exponential backoff until the server answers, so neither import nor
+    get_connection ever waits for an unreachable host.
+
+    Connections are validated lazily: one idle for more than
+    `validate_after` seconds, or returned before the last connection
+    error was seen, is pinged (and reconnected if needed) before being
+    handed out. Everything else goes out without a round trip;
+    validation_stats counts both cases.
+    """
+    name = 'mysql'
+    # DB_CONFIG keys understood by mysql.connector's own pool, not by connect()
+    POOL_OPTIONS = ('pool_name', 'pool_size', 'pool_reset_session')
+
+    def __init__(self, config, on_ready=None, initial_delay=0.5, max_delay=30.0, validate_after=30.0):
+        if mysql is None:
+            raise ImportError("mysql-connector-python is required for the MySQL backend")
+        super().__init__(on_ready)
+        self.config = config
+        self.connect_config = {k: v for k, v in config.items() if k not in self.POOL_OPTIONS}
+        self.pool_size = config.get('pool_size', 5)
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.validate_after = validate_after
+        self.attempts = 0
+        self.last_error = None
+        self.warm_thread = None
+        self.validation_stats = {'validated': 0, 'skipped': 0, 'reconnected': 0, 'ping_seconds': 0.0}
+        self.exhausted = 0
+        self._idle = []  # (connection, released_at), most recently used last
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._pool_lock = threading.Lock()
+        self._failed_at = 0.0
+        self._closed = threading.Event()
+        self._warm_lock = threading.Lock()
+
+    def warm_up(self):
+        with self._warm_lock:
+            if self.ready.is_set() or self._closed.is_set():
+                return
+            if self.warm_thread and self.warm_thread.is_alive():
+                return
+            self.warm_thread = threading.Thread(target=self._create_pool, daemon=True)
+            self.warm_thread.start()
+
+    def _create_pool(self):
+        """Thread function opening the first connection with exponential backoff"""
+        delay = self.initial_delay
+        while not self._closed.is_set():
+            self.attempts += 1
+            try:
+                cnx = self._connect()
+                self.has_procedures = self._has_procedure(cnx, 'pwf_transition')
+                with self._pool_lock:
+                    self._idle.append((cnx, time.monotonic()))
+                print("✅ Connection pool created successfully!")
+                self._set_ready()
+                return
+            except Error as e:
+                self.last_error = e
+                print(f"❌ Attempt {self.attempts} failed: {e} (retrying in {delay:.1f}s)")
+            if self._closed.wait(delay):
+                return
+            delay = min(delay * 2, self.max_delay)
+
+    def _has_procedure(self, cnx, name):
+        cursor = cnx.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.routines
+            WHERE routine_schema = DATABASE() AND routine_name = %s
+        """, (name,))
+        found = cursor.fetchone()[0] > 0
+        cursor.close()
+        cnx.rollback()
+        return found
+
+    def _connect(self):
+        cnx = mysql.connector.connect(**self.connect_config)
+        cnx.autocommit = False
+        return cnx
+
+    def get_connection(self, validate=False):
+        """Get a pooled connection, or None while the pool is still being created.
+
+        With validate=True the connection is always pinged first.
+        """
+        if not self.ready.is_set():
+            self.warm_up()
+            return None
+        if not self._slots.acquire(blocking=False):
+            self.exhausted += 1
+            print("Error getting connection from pool: pool exhausted")
+            return None
+
+        with self._pool_lock:
+            cnx, released_at = self._idle.pop() if self._idle else (None, None)
+        try:
+            if cnx is None:
+                cnx = self._connect()
+            elif validate or released_at <= self._failed_at or time.monotonic() - released_at > self.validate_after:
+                self._validate(cnx)
+            else:
+                self.validation_stats['skipped'] += 1
+            return PooledConnection(self, cnx)
+        except Error as e:
+            self._slots.release()
+            print(f"Error getting connection from pool: {e}")
+            return None
+
+    def _validate(self, cnx):
+        """Ping `cnx`, reconnecting it once if the server dropped it"""
+        started = time.monotonic()
+        try:
+            cnx.ping()
+        except Error:
+            cnx.reconnect(attempts=1, delay=0)
+            cnx.autocommit = False
+            self.validation_stats['reconnected'] += 1
+        self.validation_stats['validated'] += 1
+        self.validation_stats['ping_seconds'] += time.monotonic() - started
+
+    def _release(self, cnx):
+        try:
+            # An unfinished transaction must not leak into the next borrower
+            if cnx.in_transaction:
+                cnx.rollback()
+            with self._pool_lock:
+                self._idle.append((cnx, time.monotonic()))
+        except Error:
+            pass  # Broken connection: drop it and let the slot open a new one
+        finally:
+            self._slots.release()
+
+    def connection_failed(self):
+        """Revalidate every idle connection before it is handed out again"""
+        self._failed_at = time.monotonic()
+
+    def is_connection_error(self, e):
+        return isinstance(e, (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError))
+
+    def journal_name(self):
+        return f"mysql-{self.config.get('host')}-{self.config.get('port', 3306)}-{self.config.get('database')}"
+
+    def insert_log_sql(self, count):
+        return f"""
+            INSERT INTO signals_log (signal_name, value, source, timestamp, protocol, event_id)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * count)}
+            ON DUPLICATE KEY UPDATE id = id
+        """
+
+    def upsert_state_sql(self, count):
+        # timestamp is assigned last so the conditions above still see the old value
+        return f"""
+            INSERT INTO signal_state_current (signal_name, value, source, timestamp, protocol)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * count)}
+            ON DUPLICATE KEY UPDATE
+                value = IF(VALUES(timestamp) >= timestamp, VALUES(value), value),
+                source = IF(VALUES(timestamp) >= timestamp, VALUES(source), source),
+                timestamp = GREATEST(timestamp, VALUES(timestamp))
+        """
+
+    def close(self):
+        self._closed.set()
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for cnx, _ in idle:
+            try:
+                cnx.close()
+            except Error:
+                pass
+
+# Mirrors the MySQL schema built by migrations.py
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS signals_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        signal_name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        source TEXT,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        protocol TEXT DEFAULT 'CAN',
+        event_id TEXT UNIQUE
+    );
+    CREATE INDEX IF NOT EXISTS idx_signals_name_protocol_ts ON signals_log (signal_name, protocol, timestamp);
+
+    CREATE TABLE IF NOT EXISTS pwf_state (
+        state TEXT PRIMARY KEY,
+        is_active INTEGER NOT NULL DEFAULT 0,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_pwf_active_ts ON pwf_state (is_active, timestamp);
+    INSERT INTO pwf_state (state, is_active)
+    SELECT state, 0 FROM (SELECT 'P' AS state UNION ALL SELECT 'S' UNION ALL SELECT 'W' UNION ALL SELECT 'F')
+    WHERE NOT EXISTS (SELECT 1 FROM pwf_state);
+
+    CREATE TABLE IF NOT EXISTS signal_state_current (
+        signal_name TEXT NOT NULL,
+        protocol TEXT NOT NULL,
+        value TEXT NOT NULL,
+        source TEXT,
+        timestamp TIMESTAMP,
+        PRIMARY KEY (signal_name, protocol)
+    );
+"""
+
+# Columns added after a table was first created: (table, column, definition)
+SQLITE_COLUMNS = [
+    ('pwf_state', 'version', "INTEGER NOT NULL DEFAULT 0"),
+]
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(sep=' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+class SQLiteCursor:
+    """DB-API cursor that accepts the %s placeholders used throughout db.py"""
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        self.dictionary = dictionary
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(sql.replace('%s', '?'), tuple(params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(sql.replace('%s', '?'), seq_of_params)
+        return self
+
+    def _convert(self, row):
+        if row is None or not self.dictionary:
+            return row
+        return {column[0]: value for column, value in zip(self._cursor.description, row)}
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+        return [self._convert(row) for row in rows]
+
+    def fetchall(self):
+        return [self._convert(row) for row in self._cursor.fetchall()]
+
+    def close(self):
+        self._cursor.close()
+
+class SQLiteConnection:
+    """Borrowed handle on the backend's single SQLite connection.
+
+    Holding one serialises access like a pool of size one; close() hands
+    it back.
+    """
+    def __init__(self, backend):
+        self._backend = backend
+        self._closed = False
+        self.autocommit = False
+
+    def cursor(self, dictionary=False, **kwargs):
+        return SQLiteCursor(self._backend.conn.cursor(), dictionary)
+
+    def commit(self):
+        self._backend.conn.commit()
+
+    def rollback(self):
+        self._backend.conn.rollback()
+
+    def is_connected(self):
+        return not self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # An unfinished transaction must not leak into the next borrower
+        if self._backend.conn.in_transaction:
+            self._backend.conn.rollback()
+        self._backend.lock.release()
+
+class SQLiteBackend(StorageBackend):
+    """Embedded SQLite store, either a file or ':memory:'"""
+    name = 'sqlite'
+
+    def __init__(self, path=':memory:', timeout=5.0, on_ready=None):
+        super().__init__(on_ready)
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        if path != ':memory:':
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SQLITE_SCHEMA)
+        for table, column, definition in SQLITE_COLUMNS:
+            columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        self.conn.commit()
+        self._set_ready()
+
+    def get_connection(self, validate=False):
+        if not self.lock.acquire(timeout=self.timeout):
+            print("Error getting SQLite connection: timed out waiting for the lock")
+            return None
+        return SQLiteConnection(self)
+
+    def is_connection_error(self, e):
+        return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+
+    def journal_name(self):
+        if self.path == ':memory:':
+            return None  # Gone with the process, like the database itself
+        path = os.path.abspath(self.path)
+        return f"sqlite-{os.path.basename(path)}-{hashlib.md5(path.encode()).hexdigest()[:8]}"
+
+    def insert_log_sql(self, count):
+        return f"""
+            INSERT INTO signals_log (signal_name, value, source, timestamp, protocol, event_id)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * count)}
+            ON CONFLICT (event_id) DO NOTHING
+        """
+
+    def upsert_state_sql(self, count):
+        return f"""
+            INSERT INTO signal_state_current (signal_name, value, source, timestamp, protocol)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * count)}
+            ON CONFLICT (signal_name, protocol) DO UPDATE SET
+                value = excluded.value,
+                source = excluded.source,
+                timestamp = excluded.timestamp
+            WHERE excluded.timestamp >= signal_state_current.timestamp
+        """
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,180 @@
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+from db_metrics import LatencyHistogram
+
+class Lease:
+    """One borrowed connection: who took it, when, and until when"""
+    def __init__(self, lease_id, borrower, deadline):
+        self.id = lease_id
+        self.borrower = borrower
+        self.thread = threading.current_thread().name
+        self.acquired_at = time.monotonic()
+        self.deadline = deadline
+        self.flagged = False
+        self.reclaimed = False
+        self.conn = None
+
+    def held_for(self):
+        return time.monotonic() - self.acquired_at
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'borrower': self.borrower,
+            'thread': self.thread,
+            'held_s': round(self.held_for(), 3),
+            'overdue': self.flagged,
+        }
+
+class LeasedConnection:
+    """Connection wrapper that ends its lease on close()"""
+    def __init__(self, conn, manager, lease):
+        self._conn = conn
+        self._manager = manager
+        self._lease = lease
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._lease is None:
+            return
+        lease, self._lease = self._lease, None
+        if lease.reclaimed:
+            return  # Already taken back by the lease manager
+        try:
+            self._conn.close()
+        finally:
+            self._manager.release(lease)
+
+class LeaseManager:
+    """Tracks every borrowed connection.
+
+    Leases held longer than `deadline` seconds are reported once with
+    their borrower; with `reclaim`, the connection is also taken back from
+    the borrower if the backend supports it. A sampler thread records pool
+    utilisation every `sample_interval` seconds.
+    """
+    def __init__(self, deadline=30.0, reclaim=False, sample_interval=5.0, history=720):
+        self.deadline = deadline
+        self.reclaim = reclaim
+        self.sample_interval = sample_interval
+        self.active = {}  # lease id -> Lease
+        self.hold_times = LatencyHistogram()
+        self.samples = collections.deque(maxlen=history)  # (time, in_use, pool_size)
+        self.stats = {'leases': 0, 'peak_in_use': 0, 'overdue': 0, 'reclaimed': 0, 'starved': 0}
+        self.pool_size = None
+        self.sampler = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def lease(self, conn, borrower, pool_size=None):
+        """Start a lease on `conn`; returns the wrapped connection"""
+        if pool_size:
+            self.pool_size = pool_size
+        lease = Lease(next(self._ids), borrower, time.monotonic() + self.deadline)
+        wrapped = LeasedConnection(conn, self, lease)
+        lease.conn = conn
+        with self._lock:
+            self.active[lease.id] = lease
+            self.stats['leases'] += 1
+            self.stats['peak_in_use'] = max(self.stats['peak_in_use'], len(self.active))
+        self._ensure_sampler()
+        return wrapped
+
+    def release(self, lease):
+        with self._lock:
+            self.active.pop(lease.id, None)
+            self.hold_times.observe(lease.held_for() * 1000)
+            lease.conn = None
+
+    def starved(self):
+        """Report the current holders after a checkout failed on a full pool"""
+        with self._lock:
+            self.stats['starved'] += 1
+            holders = sorted(self.active.values(), key=lambda lease: lease.acquired_at)
+        print(f"❌ Connection pool starved: {len(holders)} lease(s) held")
+        for lease in holders:
+            print(f"   #{lease.id} {lease.borrower} on {lease.thread} for {lease.held_for():.1f}s")
+
+    def check_deadlines(self):
+        """Flag (and with reclaim, take back) leases held past their deadline"""
+        now = time.monotonic()
+        with self._lock:
+            overdue = [lease for lease in self.active.values() if not lease.flagged and now > lease.deadline]
+            for lease in overdue:
+                lease.flagged = True
+                self.stats['overdue'] += 1
+        for lease in overdue:
+            print(f"⚠️ Connection lease #{lease.id} held for {lease.held_for():.1f}s by {lease.borrower} ({lease.thread})")
+            conn = lease.conn
+            if self.reclaim and conn is not None and hasattr(conn, 'reclaim'):
+                lease.reclaimed = True
+                conn.reclaim()
+                self.release(lease)
+                with self._lock:
+                    self.stats['reclaimed'] += 1
+                print(f"⚠️ Reclaimed connection lease #{lease.id}")
+
+    def utilisation(self):
+        """Current and historical pool utilisation.
+
+        'active_leases' lists the leases held right now; the counters
+        ('leases', 'peak_in_use', ...) cover the whole run.
+        """
+        with self._lock:
+            in_use = len(self.active)
+            samples = list(self.samples)
+            stats = dict(self.stats)
+            leases = [lease.as_dict() for lease in self.active.values()]
+            hold_times = self.hold_times.as_dict()
+        average = None
+        if samples and self.pool_size:
+            average = sum(used for _, used, _ in samples) / (len(samples) * self.pool_size)
+        return {
+            'in_use': in_use,
+            'pool_size': self.pool_size,
+            'average_utilisation': average,
+            'samples': samples,
+            'active_leases': leases,
+            'hold_ms': hold_times,
+            **stats,
+        }
+
+    def stop(self):
+        self._stop.set()
+
+    def _ensure_sampler(self):
+        if self.sampler and self.sampler.is_alive():
+            return
+        with self._lock:
+            if self.sampler and self.sampler.is_alive():
+                return
+            self._stop.clear()
+            self.sampler = threading.Thread(target=self._sample_loop, daemon=True)
+            self.sampler.start()
+
+    def _sample_loop(self):
+        """Thread function sampling utilisation and checking deadlines"""
+        while not self._stop.wait(self.sample_interval):
+            with self._lock:
+                self.samples.append((time.time(), len(self.active), self.pool_size))
+            self.check_deadlines()
+
+# Functions that only pass a connection through; the borrower is whoever called them
+_PASS_THROUGH = {'get_connection', 'connection', '_fetch', '__enter__'}
+
+def caller():
+    """'file:line function' of the first frame outside the connection plumbing"""
+    frame = sys._getframe(1)
+    while frame:
+        code = frame.f_code
+        if code.co_name not in _PASS_THROUGH and code.co_filename != __file__:
+            return f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+        frame = frame.f_back
+    return 'unknown'
@@ -0,0 +1,207 @@
+import json
+import threading
+import time
+
+# Upper bounds (ms) of the latency histogram buckets; the last one catches the rest
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf'))
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram in milliseconds"""
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile (0-100)"""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_ms': self.total_ms / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max_ms,
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS_MS, self.counts) if count},
+        }
+
+def statement_name(sql):
+    """Fallback name for SQL that is not in db.QUERIES, e.g. 'INSERT signals_log'"""
+    words = sql.split()
+    if not words:
+        return 'EMPTY'
+    verb = words[0].upper()
+    if verb == 'CALL' and len(words) > 1:
+        return f"CALL {words[1].split('(')[0]}"
+    lowered = [word.lower() for word in words]
+    for keyword in ('into', 'from', 'update', 'table'):
+        if keyword in lowered[:-1]:
+            return f"{verb} {words[lowered.index(keyword) + 1].strip('(`')}"
+    return verb
+
+class DbMetrics:
+    """Per-statement latency, pool checkout wait and error counters.
+
+    Statements from db.QUERIES are reported under their key, anything else
+    under statement_name(). Executions slower than `slow_query_ms` are
+    printed as they happen. Thread safe; recording costs a dict lookup and
+    a few additions under a lock.
+    """
+    def __init__(self, query_names=None, slow_query_ms=100.0):
+        self.query_names = query_names or {}
+        self.slow_query_ms = slow_query_ms
+        self.started = time.time()
+        self.queries = {}  # name -> LatencyHistogram
+        self.errors = {}   # name -> count
+        self.checkout = LatencyHistogram()
+        self.checkout_failures = 0
+        self.dump_thread = None
+        self._lock = threading.Lock()
+        self._dump_stop = threading.Event()
+
+    def name_for(self, sql):
+        return self.query_names.get(sql) or statement_name(sql)
+
+    def observe_query(self, name, ms, error=None):
+        with self._lock:
+            histogram = self.queries.get(name)
+            if histogram is None:
+                histogram = self.queries[name] = LatencyHistogram()
+            histogram.observe(ms)
+            if error is not None:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        if ms >= self.slow_query_ms:
+            status = f" (failed: {error})" if error is not None else ""
+            print(f"⚠️ Slow query {name}: {ms:.1f} ms{status}")
+
+    def observe_checkout(self, ms, ok):
+        with self._lock:
+            self.checkout.observe(ms)
+            if not ok:
+                self.checkout_failures += 1
+        if ms >= self.slow_query_ms:
+            print(f"⚠️ Slow connection checkout: {ms:.1f} ms")
+
+    def snapshot(self):
+        """All counters as plain dicts, safe to serialise"""
+        with self._lock:
+            return {
+                'since': self.started,
+                'queries': {name: histogram.as_dict() for name, histogram in self.queries.items()},
+                'errors': dict(self.errors),
+                'checkout': self.checkout.as_dict(),
+                'checkout_failures': self.checkout_failures,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.queries = {}
+            self.errors = {}
+            self.checkout = LatencyHistogram()
+            self.checkout_failures = 0
+
+    def format_report(self):
+        """Human readable table of the current counters"""
+        snapshot = self.snapshot()
+        lines = [f"{'query':<28}{'count':>8}{'avg':>9}{'p95':>9}{'max':>9}{'errors':>8}"]
+        for name, stats in sorted(snapshot['queries'].items()):
+            lines.append(
+                f"{name:<28}{stats['count']:>8}{stats['avg_ms']:>9.1f}"
+                f"{stats['p95_ms']:>9.1f}{stats['max_ms']:>9.1f}{snapshot['errors'].get(name, 0):>8}"
+            )
+        checkout = snapshot['checkout']
+        lines.append(
+            f"checkout: {checkout['count']} avg {checkout['avg_ms']:.1f} ms, "
+            f"p95 {checkout['p95_ms']:.1f} ms, {snapshot['checkout_failures']} failed"
+        )
+        return '\n'.join(lines)
+
+    def start_dump(self, interval=60.0, path=None):
+        """Dump the counters every `interval` seconds from a daemon thread.
+
+        With `path`, each dump is appended to it as one JSON line;
+        otherwise the report is printed.
+        """
+        if self.dump_thread and self.dump_thread.is_alive():
+            return
+        self._dump_stop.clear()
+        self.dump_thread = threading.Thread(target=self._dump_loop, args=(interval, path), daemon=True)
+        self.dump_thread.start()
+
+    def stop_dump(self):
+        self._dump_stop.set()
+
+    def _dump_loop(self, interval, path):
+        """Thread function writing periodic dumps"""
+        while not self._dump_stop.wait(interval):
+            try:
+                if path:
+                    with open(path, 'a') as f:
+                        f.write(json.dumps(dict(self.snapshot(), time=time.time())) + '\n')
+                else:
+                    print("=== DB metrics ===\n" + self.format_report())
+            except Exception as e:
+                print("Error dumping DB metrics:", e)
+
+class InstrumentedCursor:
+    """Cursor wrapper timing every execute() into a DbMetrics"""
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, sql, params):
+        started = time.perf_counter()
+        error = None
+        try:
+            return method(sql, params)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._metrics.observe_query(self._metrics.name_for(sql), elapsed_ms, error)
+
+    def execute(self, sql, params=()):
+        return self._timed(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(self._cursor.executemany, sql, seq_of_params)
+
+class InstrumentedConnection:
+    """Connection wrapper whose cursors report to a DbMetrics"""
+    def __init__(self, conn, metrics):
+        self._conn = conn
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._metrics)
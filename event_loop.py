@@ -0,0 +1,32 @@
+import asyncio
+import threading
+
+# The asyncio loop shared by the UDP endpoints of one process
+# (components/socket_manager.py, the change_relay.py and state_hub.py
+# clients). It runs on one daemon thread; callbacks hand results to their
+# owners, which for the Qt windows means emitting a signal.
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """The shared asyncio loop, started on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='socket-loop', daemon=True).start()
+        return _loop
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """Hands every datagram of one socket to a callback on the event loop"""
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        # ICMP port unreachable from a closed peer; the socket stays usable
+        if not isinstance(exc, ConnectionResetError):
+            print(f"Socket receive error: {exc}")
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+from datetime import datetime, timedelta
+import db
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for exports
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the parquet format
+    pa = None
+
+# Columnar export of signals_log for offline analysis.
+#
+#   python export_history.py OUT_DIR                  parquet (needs pyarrow)
+#   python export_history.py OUT_DIR --format npz     NumPy .npz parts
+#   python export_history.py OUT_DIR --chunk 100000   rows per chunk
+#
+# The table is read in id-ordered chunks and each chunk is written out
+# before the next is fetched, so memory stays flat whatever the table size.
+# OUT_DIR/checkpoint.json remembers the last exported id: running the
+# export again only fetches newer rows into new part files.
+#
+# Columns: id (int64), timestamp (int64 microseconds since 1970-01-01 in
+# the database's wall-clock time) and dictionary-encoded signal_name,
+# value, source and protocol.
+
+CHUNK_ROWS = 50000
+CHECKPOINT = 'checkpoint.json'
+DICTIONARY_COLUMNS = ('signal_name', 'value', 'source', 'protocol')
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+def to_micros(timestamp):
+    """Wall-clock datetime to int64 microseconds since 1970-01-01"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return (timestamp - _EPOCH) // _MICROSECOND
+
+def from_micros(micros):
+    return _EPOCH + timedelta(microseconds=int(micros))
+
+def read_checkpoint(out_dir):
+    path = os.path.join(out_dir, CHECKPOINT)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _write_checkpoint(out_dir, checkpoint):
+    path = os.path.join(out_dir, CHECKPOINT)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
+
+def _chunks(after_id, chunk_rows):
+    """Yield signals_log rows with id > after_id as lists of tuples"""
+    while True:
+        with db.connection() as conn:
+            if not conn:
+                raise ConnectionError("database unavailable")
+            cursor = conn.cursor()
+            cursor.execute(db.QUERIES['changes'], (after_id, chunk_rows))
+            rows = cursor.fetchall()
+            cursor.close()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0]
+        if len(rows) < chunk_rows:
+            return
+
+def _columns(rows):
+    """Split (id, signal_name, value, source, protocol, timestamp) tuples into columns"""
+    ids, signal_names, values, sources, protocols, timestamps = zip(*rows)
+    return {
+        'id': ids,
+        'timestamp': [to_micros(timestamp) for timestamp in timestamps],
+        'signal_name': signal_names,
+        'value': values,
+        'source': sources,
+        'protocol': protocols,
+    }
+
+class ParquetWriter:
+    """One parquet file per export run, one row group per chunk"""
+    def __init__(self, path):
+        if pa is None:
+            raise ImportError("pyarrow is required for the parquet format")
+        self.path = path
+        self.schema = pa.schema([
+            ('id', pa.int64()),
+            ('timestamp', pa.int64()),
+        ] + [(name, pa.dictionary(pa.int32(), pa.string())) for name in DICTIONARY_COLUMNS])
+        self.writer = pq.ParquetWriter(path + '.partial', self.schema, compression='zstd')
+
+    def write(self, columns):
+        arrays = [
+            pa.array(columns['id'], pa.int64()),
+            pa.array(columns['timestamp'], pa.int64()),
+        ] + [pa.array(columns[name], pa.string()).dictionary_encode() for name in DICTIONARY_COLUMNS]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.path + '.partial', self.path)
+
+def _write_npz(path, columns):
+    """One compressed .npz per chunk: codes plus a <name>_dictionary array per encoded column"""
+    arrays = {
+        'id': np.asarray(columns['id'], dtype=np.int64),
+        'timestamp': np.asarray(columns['timestamp'], dtype=np.int64),
+    }
+    for name in DICTIONARY_COLUMNS:
+        values = np.array(['' if value is None else value for value in columns[name]], dtype=object)
+        dictionary, codes = np.unique(values, return_inverse=True)
+        arrays[name] = codes.astype(np.int32)
+        arrays[name + '_dictionary'] = dictionary.astype(str)
+    with open(path + '.partial', 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + '.partial', path)
+
+def export(out_dir, fmt='parquet', chunk_rows=CHUNK_ROWS):
+    """Export signals_log rows newer than the checkpoint in `out_dir`.
+
+    Returns the number of rows exported. The checkpoint advances only after
+    the data it covers is on disk, so an interrupted export resumes where
+    it stopped.
+    """
+    if np is None:
+        raise ImportError("numpy is required for exports")
+    if fmt not in ('parquet', 'npz'):
+        raise ValueError(f"Unknown export format: {fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    checkpoint = read_checkpoint(out_dir) or {'format': fmt, 'last_id': 0}
+    if checkpoint['format'] != fmt:
+        raise ValueError(f"{out_dir} holds a {checkpoint['format']} export")
+
+    first_id = checkpoint['last_id'] + 1
+    exported = 0
+    writer = None
+    try:
+        for rows in _chunks(checkpoint['last_id'], chunk_rows):
+            columns = _columns(rows)
+            last_id = rows[-1][0]
+            if fmt == 'npz':
+                _write_npz(os.path.join(out_dir, f"signals_log_{rows[0][0]}_{last_id}.npz"), columns)
+            else:
+                if writer is None:
+                    writer = ParquetWriter(os.path.join(out_dir, f"signals_log_{first_id}.parquet"))
+                writer.write(columns)
+            exported += len(rows)
+            checkpoint['last_id'] = last_id
+            if fmt == 'npz':
+                _write_checkpoint(out_dir, checkpoint)
+            print(f"Exported {exported} rows (up to id {last_id})")
+    finally:
+        # A parquet file only becomes readable once closed
+        if writer is not None:
+            writer.close()
+            _write_checkpoint(out_dir, checkpoint)
+    return exported
+
+def load_export(out_dir):
+    """Read an export back as a dict of NumPy arrays.
+
+    Dictionary-encoded columns come back as (codes, dictionary) pairs,
+    re-coded against one dictionary shared by all parts without
+    materialising the strings; decode with dictionary[codes].
+    """
+    if np is None:
+        raise ImportError("numpy is required to load exports")
+    parts = sorted(
+        (name for name in os.listdir(out_dir)
+         if name.startswith('signals_log_') and name.endswith(('.npz', '.parquet'))),
+        key=lambda name: int(name[len('signals_log_'):].split('_')[0].split('.')[0])
+    )
+    ids, timestamps = [], []
+    codes = {name: [] for name in DICTIONARY_COLUMNS}
+    dictionaries = {name: {} for name in DICTIONARY_COLUMNS}  # value -> shared code
+
+    def recode(column, part_codes, part_dictionary):
+        shared = dictionaries[column]
+        mapping = np.array([shared.setdefault(value, len(shared)) for value in part_dictionary], dtype=np.int32)
+        codes[column].append(mapping[part_codes] if len(mapping) else np.empty(0, dtype=np.int32))
+
+    for name in parts:
+        path = os.path.join(out_dir, name)
+        if name.endswith('.npz'):
+            with np.load(path) as part:
+                ids.append(part['id'])
+                timestamps.append(part['timestamp'])
+                for column in DICTIONARY_COLUMNS:
+                    recode(column, part[column], part[column + '_dictionary'].tolist())
+            continue
+
+        if pa is None:
+            raise ImportError("pyarrow is required to read parquet exports")
+        parquet = pq.ParquetFile(path)
+        for group in range(parquet.num_row_groups):
+            table = parquet.read_row_group(group)
+            ids.append(table.column('id').to_numpy())
+            timestamps.append(table.column('timestamp').to_numpy())
+            for column in DICTIONARY_COLUMNS:
+                for chunk in table.column(column).chunks:
+                    # NULLs are null indices; point them at an extra '' entry,
+                    # as the npz parts store them
+                    dictionary = ['' if value is None else value for value in chunk.dictionary.to_pylist()] + ['']
+                    indices = chunk.indices.fill_null(len(dictionary) - 1)
+                    recode(column, indices.to_numpy(zero_copy_only=False), dictionary)
+
+    result = {
+        'id': np.concatenate(ids) if ids else np.empty(0, dtype=np.int64),
+        'timestamp': np.concatenate(timestamps) if timestamps else np.empty(0, dtype=np.int64),
+    }
+    for column in DICTIONARY_COLUMNS:
+        dictionary = np.array(list(dictionaries[column]), dtype=str)
+        result[column] = (
+            np.concatenate(codes[column]) if codes[column] else np.empty(0, dtype=np.int32),
+            dictionary,
+        )
+    return result
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0].startswith('--'):
+        print("Usage: python export_history.py OUT_DIR [--format parquet|npz] [--chunk ROWS]")
+        raise SystemExit(2)
+    fmt = args[args.index('--format') + 1] if '--format' in args else 'parquet'
+    chunk_rows = int(args[args.index('--chunk') + 1]) if '--chunk' in args else CHUNK_ROWS
+    if not db.wait_until_ready(timeout=30):
+        print("❌ Database did not become reachable")
+        raise SystemExit(1)
+    count = export(args[0], fmt, chunk_rows)
+    print(f"✅ Exported {count} new rows to {args[0]}")
@@ -4,91 +4,35 @@ from PyQt5.QtWidgets import (
     QApplication, QWidget, QPushButton, QLabel,
     QVBoxLayout, QTextEdit, QHBoxLayout, QFrame
 )
-from PyQt5.QtCore import Qt, QSize, QTimer
+from PyQt5.QtCore import Qt, QSize, QTimer, pyqtSignal
 from PyQt5.QtGui import QPainter, QBrush, QColor, QRadialGradient, QFont, QLinearGradient
 import db
+from change_relay import RelayClient
 from datetime import datetime
 
 # --- Config ---
 RASPBERRY_IP = '10.20.0.33'
 RASPBERRY_PORT = 40000
 POLL_INTERVAL = 2000  # 0.5 second polling
+RELAY_POLL_INTERVAL = 15000  # Fallback polling while change_relay.py pushes changes
 
 # --- Database Functions ---
-def get_last_update_time():
-    """Get the most recent timestamp from the database"""
-    conn = db.get_connection()
-    if not conn:
-        return None
-    
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT MAX(timestamp) 
-            FROM signals_log 
-            WHERE signal_name IN ('led', 'button')
-        """)
-        return cursor.fetchone()[0]
-    except Exception as e:
-        print("Error getting last update time:", e)
-        return None
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
-
 def get_current_states():
-    """Get current states in a single optimized query"""
-    conn = db.get_connection()
-    if not conn:
+    """Get current states from the single-query state snapshot"""
+    snapshot = db.get_state_snapshot()
+    if snapshot is None:
         return None, None, None
     
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                MAX(CASE WHEN signal_name = 'led' THEN value END) as led_state,
-                MAX(CASE WHEN signal_name = 'button' THEN value END) as button_state,
-                MAX(timestamp) as last_change
-            FROM (
-                SELECT signal_name, value, timestamp
-                FROM signals_log
-                WHERE signal_name IN ('led', 'button')
-                ORDER BY timestamp DESC
-                LIMIT 2
-            ) as latest_states
-        """)
-        row = cursor.fetchone()
-        return row[0] or 'off', row[1] or 'not pressed', row[2]
-    except Exception as e:
-        print("Error getting states:", e)
-        return None, None, None
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
+    signals = snapshot['signals']
+    return (
+        signals.get(('led', 'CAN')) or 'off',
+        signals.get(('button', 'CAN')) or 'not pressed',
+        snapshot['last_change']
+    )
 
 def update_states(led_state, button_state):
     """Update states in the database"""
-    conn = db.get_connection()
-    if not conn:
-        return False
-    
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO signals_log (signal_name, value, source)
-            VALUES (%s, %s, 'GUI'), (%s, %s, 'GUI')
-            ON DUPLICATE KEY UPDATE 
-                value = VALUES(value),
-                timestamp = CURRENT_TIMESTAMP
-        """, ('led', led_state, 'button', button_state))
-        conn.commit()
-        return True
-    except Exception as e:
-        print("Error updating states:", e)
-        return False
-    finally:
-        if conn and conn.is_connected():
-            conn.close()
+    return db.update_states(led_state, button_state, 'CAN')
 
 # --- UDP Function ---
 def send_udp_message(signal_name, value):
@@ -184,6 +128,11 @@ class PhysicalButton(QPushButton):
 
 # --- Main Window ---
 class MainWindow(QWidget):
+    database_ready = pyqtSignal()
+    relay_changes = pyqtSignal(list)
+    relay_status = pyqtSignal(bool)
+    relay_gap = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Car Lamp Control Panel")
@@ -207,13 +156,20 @@ class MainWindow(QWidget):
         # Current states
         self.current_led_state = 'off'
         self.current_button_state = 'not pressed'
-        self.last_db_change = None
+        self.change_feed = db.ChangeFeed(signal_names=('led', 'button'))
         
         # Optimized polling timer
         self.poll_timer = QTimer(self)
         self.poll_timer.setTimerType(Qt.PreciseTimer)
         self.poll_timer.timeout.connect(self.check_for_updates)
         self.poll_timer.start(POLL_INTERVAL)
+
+        # Changes pushed by change_relay.py arrive here without polling
+        self.relay_changes.connect(self.apply_changes)
+        self.relay_status.connect(self.on_relay_status)
+        self.relay_gap.connect(self.check_for_updates)
+        self.relay_client = RelayClient(self.relay_changes.emit, self.relay_status.emit, self.relay_gap.emit)
+        self.relay_client.start()
         
         # Layout
         control_frame = QFrame()
@@ -232,16 +188,20 @@ class MainWindow(QWidget):
         self.toggle_btn.clicked.connect(self.toggle_led)
         self.log("Application started")
         
-        # Initial state load
+        # Initial state load, repeated once the connection pool is up
         self.load_initial_state()
+        self.database_ready.connect(self.load_initial_state)
+        self._ready_callback = self.database_ready.emit
+        db.add_ready_callback(self._ready_callback)
 
     def load_initial_state(self):
         """Load initial state from database"""
+        # Position the change feed first so nothing written after the snapshot is missed
+        self.change_feed.seek_latest()
         led_state, button_state, last_change = get_current_states()
         if led_state is not None:
             self.current_led_state = led_state
             self.current_button_state = button_state
-            self.last_db_change = last_change
             self.update_ui()
             self.log("Initial state loaded")
 
@@ -267,21 +227,37 @@ class MainWindow(QWidget):
     def check_for_updates(self):
         """Check for external changes in database"""
         try:
-            # First check if there are any changes at all
-            last_change = get_last_update_time()
-            if last_change == self.last_db_change:
+            # Only rows written since the last poll
+            changes = self.change_feed.poll()
+            if not changes:
                 return  # No changes since last check
-            
-            # Only fetch full state if we know there's a change
-            led_state, button_state, last_change = get_current_states()
-            if led_state is None:
+            self.apply_changes(changes)
+        except Exception as e:
+            self.log(f"Update check error: {str(e)}")
+
+    def on_relay_status(self, connected):
+        self.poll_timer.setInterval(RELAY_POLL_INTERVAL if connected else POLL_INTERVAL)
+        self.log("Change relay connected" if connected else "Change relay lost; polling the database")
+        if not connected:
+            self.check_for_updates()
+
+    def apply_changes(self, changes):
+        """Apply signals_log rows from the change feed or the relay"""
+        try:
+            # Pushed rows need not be polled again
+            self.change_feed.skip(changes)
+            changes = [row for row in changes if row['signal_name'] in ('led', 'button')]
+            if not changes:
                 return
+
+            latest = {row['signal_name']: row['value'] for row in changes}
+            led_state = latest.get('led', self.current_led_state)
+            button_state = latest.get('button', self.current_button_state)
                 
             if (led_state != self.current_led_state or 
                 button_state != self.current_button_state):
                 self.current_led_state = led_state
                 self.current_button_state = button_state
-                self.last_db_change = last_change
                 
                 # Update UI in the next event loop cycle
                 QTimer.singleShot(0, self.update_ui)
@@ -294,6 +270,11 @@ class MainWindow(QWidget):
         except Exception as e:
             self.log(f"Update check error: {str(e)}")
 
+    def closeEvent(self, event):
+        self.relay_client.stop()
+        db.remove_ready_callback(self._ready_callback)
+        super().closeEvent(event)
+
     def update_ui(self):
         """Update all UI elements based on current state"""
         # Update lamp
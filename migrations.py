@@ -0,0 +1,434 @@
+import sys
+from datetime import datetime
+import db
+from signal_archive import month_start, next_month, partition_name
+
+# Versioned schema migrations.
+#
+#   python migrations.py          apply every pending migration
+#   python migrations.py check    EXPLAIN every query in db.QUERIES and fail
+#                                 on full scans or filesorts
+#
+# Applied versions are recorded in schema_migrations, so running the
+# upgrade again is a no-op.
+
+# Tables the application expects. Applied before the versioned migrations
+# on every run; IF NOT EXISTS keeps them harmless on existing databases.
+BASELINE = [
+    """
+    CREATE TABLE IF NOT EXISTS signals_log (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        signal_name VARCHAR(64) NOT NULL,
+        value VARCHAR(64) NOT NULL,
+        source VARCHAR(32),
+        timestamp DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+        protocol VARCHAR(8) DEFAULT 'CAN'
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pwf_state (
+        state CHAR(1) PRIMARY KEY,
+        is_active TINYINT(1) NOT NULL DEFAULT 0,
+        timestamp DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+    )
+    """,
+    # Seed the four modes only into an empty table
+    """
+    INSERT INTO pwf_state (state, is_active)
+    SELECT modes.state, 0
+    FROM (SELECT 'P' AS state UNION ALL SELECT 'S' UNION ALL SELECT 'W' UNION ALL SELECT 'F') modes
+    WHERE NOT EXISTS (SELECT 1 FROM pwf_state)
+    """,
+]
+
+def add_index(table, name, columns, unique=False):
+    """Migration step creating an index unless one already starts with `columns`"""
+    def step(cursor):
+        cursor.execute("""
+            SELECT index_name, column_name
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s
+            ORDER BY index_name, seq_in_index
+        """, (table,))
+        indexes = {}
+        for index_name, column_name in cursor.fetchall():
+            indexes.setdefault(index_name, []).append(column_name.lower())
+        wanted = [column.lower() for column in columns]
+        if any(existing[:len(wanted)] == wanted for existing in indexes.values()):
+            return
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        cursor.execute(f"CREATE {kind} {name} ON {table} ({', '.join(columns)})")
+    return step
+
+def add_column(table, column, definition):
+    """Migration step adding a column unless it already exists"""
+    def step(cursor):
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        if cursor.fetchone()[0]:
+            return
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+def drop_index(table, name):
+    """Migration step dropping an index if it exists"""
+    def step(cursor):
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (table, name))
+        if cursor.fetchone()[0]:
+            cursor.execute(f"DROP INDEX {name} ON {table}")
+    return step
+
+def set_primary_key(table, columns):
+    """Migration step replacing the primary key unless it already is `columns`"""
+    def step(cursor):
+        cursor.execute("""
+            SELECT column_name
+            FROM information_schema.key_column_usage
+            WHERE table_schema = DATABASE() AND table_name = %s AND constraint_name = 'PRIMARY'
+            ORDER BY ordinal_position
+        """, (table,))
+        if [row[0].lower() for row in cursor.fetchall()] == [column.lower() for column in columns]:
+            return
+        cursor.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY ({', '.join(columns)})")
+    return step
+
+def _require_datetime(cursor, table, column):
+    """Make `column` a DATETIME if it is a TIMESTAMP, which TO_DAYS partitioning rejects.
+
+    BASELINE never changes an existing table, so older lab databases may
+    still have a TIMESTAMP here. Its precision, nullability and
+    CURRENT_TIMESTAMP default are kept; any other type is an error.
+    """
+    cursor.execute("""
+        SELECT data_type, is_nullable, datetime_precision, column_default
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    row = cursor.fetchone()
+    if not row:
+        raise ValueError(f"Cannot partition {table}: column {column} does not exist")
+    data_type, nullable, precision, default = row
+    if data_type.lower() in ('date', 'datetime'):
+        return
+    if data_type.lower() != 'timestamp':
+        raise ValueError(f"Cannot partition {table} by month: {column} is {data_type.upper()}, not DATE or DATETIME")
+
+    definition = f"DATETIME({precision or 0}) {'NULL' if nullable == 'YES' else 'NOT NULL'}"
+    if default and default.upper().startswith('CURRENT_TIMESTAMP'):
+        definition += f" DEFAULT CURRENT_TIMESTAMP({precision or 0})"
+    print(f"Converting {table}.{column} from TIMESTAMP to DATETIME for partitioning")
+    cursor.execute(f"ALTER TABLE {table} MODIFY {column} {definition}")
+
+def partition_by_month(table, column):
+    """Migration step range-partitioning `table` by month of `column`.
+
+    Creates one partition per month from the oldest row up to next month,
+    plus pmax for anything later; retention.py keeps adding months. A
+    TIMESTAMP column is converted to DATETIME first.
+    """
+    def step(cursor):
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL
+        """, (table,))
+        if cursor.fetchone()[0]:
+            return
+        _require_datetime(cursor, table, column)
+        cursor.execute(f"SELECT MIN({column}) FROM {table}")
+        month = month_start(cursor.fetchone()[0] or datetime.now())
+        last = next_month(datetime.now())
+        partitions = []
+        while month <= last:
+            partitions.append(
+                f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{next_month(month):%Y-%m-%d}'))"
+            )
+            month = next_month(month)
+        partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        cursor.execute(f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS({column})) ({', '.join(partitions)})")
+    return step
+
+# (version, description, steps) - append new entries, never edit applied ones.
+# A step is either an SQL string or a callable taking the cursor.
+MIGRATIONS = [
+    (1, "signal_state_current table with backfill from signals_log", [
+        """
+        CREATE TABLE IF NOT EXISTS signal_state_current (
+            signal_name VARCHAR(64) NOT NULL,
+            protocol VARCHAR(8) NOT NULL,
+            value VARCHAR(64) NOT NULL,
+            source VARCHAR(32),
+            timestamp DATETIME(6),
+            PRIMARY KEY (signal_name, protocol)
+        )
+        """,
+        # Rows already written by the new code are newer than anything in
+        # the log, so only fill in keys that are still missing
+        """
+        INSERT IGNORE INTO signal_state_current (signal_name, protocol, value, source, timestamp)
+        SELECT l.signal_name, l.protocol, l.value, l.source, l.timestamp
+        FROM signals_log l
+        JOIN (
+            SELECT MAX(id) AS id
+            FROM signals_log
+            WHERE protocol IS NOT NULL
+            GROUP BY signal_name, protocol
+        ) latest ON latest.id = l.id
+        """,
+    ]),
+    (2, "composite indexes for signal lookups and the active PWF state", [
+        add_index('signals_log', 'idx_signals_name_protocol_ts', ['signal_name', 'protocol', 'timestamp']),
+        add_index('pwf_state', 'idx_pwf_active_ts', ['is_active', 'timestamp']),
+        add_index('pwf_state', 'idx_pwf_state', ['state']),
+    ]),
+    (3, "signals_log.event_id for idempotent offline journal replay", [
+        add_column('signals_log', 'event_id', "CHAR(32) NULL"),
+        add_index('signals_log', 'uq_signals_event_id', ['event_id'], unique=True),
+    ]),
+    (4, "pwf_state.version and the pwf_transition procedure", [
+        add_column('pwf_state', 'version', "BIGINT NOT NULL DEFAULT 0"),
+        "DROP PROCEDURE IF EXISTS pwf_transition",
+        # Mirrors db._apply_pwf_state. Only the row the caller saw active is
+        # locked, and a stale view fails with SQLSTATE 45000 instead of
+        # overwriting another panel's change.
+        """
+        CREATE PROCEDURE pwf_transition(
+            IN p_state CHAR(1),
+            IN p_expected_state CHAR(1),
+            IN p_expected_version BIGINT,
+            IN p_protocol VARCHAR(8),
+            IN p_timestamp DATETIME(6),
+            IN p_event_id CHAR(32),
+            IN p_commit TINYINT
+        )
+        BEGIN
+            DECLARE v_active TINYINT DEFAULT 0;
+            DECLARE v_version BIGINT DEFAULT 0;
+
+            IF p_expected_version IS NOT NULL THEN
+                SELECT is_active, version INTO v_active, v_version
+                FROM pwf_state
+                WHERE state = p_expected_state
+                FOR UPDATE;
+                IF v_active <> 1 OR v_version <> p_expected_version THEN
+                    SIGNAL SQLSTATE '45000' SET MESSAGE_TEXT = 'pwf_state version conflict';
+                END IF;
+            ELSE
+                SELECT COALESCE(MAX(version), 0) INTO v_version
+                FROM pwf_state
+                WHERE is_active = 1;
+            END IF;
+
+            -- The audit row doubles as the idempotency key for replays
+            INSERT INTO signals_log (signal_name, value, source, timestamp, protocol, event_id)
+            VALUES ('pwf_state_change', p_state, 'GUI', p_timestamp, p_protocol, p_event_id)
+            ON DUPLICATE KEY UPDATE id = id;
+
+            IF ROW_COUNT() = 1 THEN
+                UPDATE pwf_state SET is_active = 0 WHERE is_active = 1 AND state <> p_state;
+                UPDATE pwf_state
+                SET is_active = 1, version = v_version + 1, timestamp = p_timestamp
+                WHERE state = p_state;
+
+                IF p_state IN ('P', 'S') THEN
+                    INSERT INTO signals_log (signal_name, value, source, timestamp, protocol, event_id)
+                    SELECT signal_name, 'off', 'GUI', p_timestamp, protocol, MD5(CONCAT(p_event_id, signal_name))
+                    FROM signal_state_current
+                    WHERE ((signal_name = 'led' AND protocol = 'CAN') OR (signal_name = 'ledL' AND protocol = 'LIN'))
+                      AND value = 'on'
+                    ON DUPLICATE KEY UPDATE id = signals_log.id;
+
+                    UPDATE signal_state_current
+                    SET value = 'off', source = 'GUI', timestamp = GREATEST(timestamp, p_timestamp)
+                    WHERE ((signal_name = 'led' AND protocol = 'CAN') OR (signal_name = 'ledL' AND protocol = 'LIN'))
+                      AND value = 'on';
+                END IF;
+            END IF;
+
+            IF p_commit THEN
+                COMMIT;
+            END IF;
+        END
+        """,
+    ]),
+    # MySQL requires the partitioning column in every unique key. Replays
+    # reuse the journaled timestamp, so (event_id, timestamp) still makes
+    # them idempotent.
+    (5, "monthly partitions on signals_log for retention.py", [
+        set_primary_key('signals_log', ['id', 'timestamp']),
+        add_index('signals_log', 'uq_signals_event_ts', ['event_id', 'timestamp'], unique=True),
+        drop_index('signals_log', 'uq_signals_event_id'),
+        partition_by_month('signals_log', 'timestamp'),
+    ]),
+]
+
+# Sample parameters used to EXPLAIN each entry of db.QUERIES
+EXPLAIN_PARAMS = {
+    'last_update_time': db.SIGNAL_NAMES,
+    'latest_change_id': (),
+    'changes': (0, 500),
+    'history': ('led', 'CAN', '2025-01-01', '2025-02-01'),
+    'state_before': ('led', 'CAN', '2025-01-01'),
+    'state_snapshot': db.SIGNAL_NAMES,
+    'pwf_check': ('W',),
+    'pwf_active_version': (),
+    'pwf_deactivate': ('W',),
+    'pwf_activate': (1, '2025-01-01 00:00:00', 'W'),
+    'current_values': db.SIGNAL_NAMES,
+    'leds_on': (),
+}
+
+# Tiny lookup tables (pwf_state, signal_state_current) may legitimately be
+# scanned when an index exists; only flag those above this many rows
+SMALL_TABLE_ROWS = 16
+
+def get_schema_version(cursor):
+    """Get the highest applied migration version (0 for a fresh database)"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT MAX(version) FROM schema_migrations")
+    row = cursor.fetchone()
+    return row[0] or 0
+
+def _run_step(cursor, step):
+    if callable(step):
+        step(cursor)
+    else:
+        cursor.execute(step)
+
+def migrate(target=None):
+    """Apply the baseline and pending migrations in order, up to `target` if given.
+
+    Returns the list of versions applied, or None if the database is
+    unavailable or a migration failed.
+    """
+    if db.get_backend().name == 'sqlite':
+        return []  # SQLiteBackend creates its schema when it opens the file
+
+    conn = db.get_connection(validate=True)
+    if not conn:
+        print("❌ Cannot migrate: database unavailable")
+        return None
+
+    applied = []
+    try:
+        cursor = conn.cursor()
+        for statement in BASELINE:
+            cursor.execute(statement)
+        conn.commit()
+
+        current = get_schema_version(cursor)
+        for version, description, steps in MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+            print(f"Applying migration {version}: {description}")
+            for step in steps:
+                _run_step(cursor, step)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+            applied.append(version)
+        cursor.close()
+        return applied
+    except Exception as e:
+        print(f"❌ Migration failed after {applied}: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+
+def _plan_problems(plan):
+    """List full scans and filesorts in the rows of an EXPLAIN result"""
+    problems = []
+    for row in plan:
+        table = row.get('table')
+        if not table or table.startswith('<'):
+            continue  # Derived tables and union results
+        extra = row.get('Extra') or ''
+        rows = row.get('rows') or 0
+        tolerated = row.get('possible_keys') and rows <= SMALL_TABLE_ROWS
+        if row.get('type') == 'ALL' and not tolerated:
+            problems.append(f"full scan on {table} ({rows} rows)")
+        if 'Using filesort' in extra and not tolerated:
+            problems.append(f"filesort on {table}")
+    return problems
+
+def _sqlite_plan_problems(plan):
+    """List table scans and temporary sorts in an SQLite EXPLAIN QUERY PLAN"""
+    problems = []
+    for row in plan:
+        detail = row[-1]
+        if detail.startswith('SCAN ') and 'USING' not in detail and 'CONSTANT ROW' not in detail:
+            problems.append(f"full scan: {detail}")
+        if 'TEMP B-TREE' in detail:
+            problems.append(f"filesort: {detail}")
+    return problems
+
+def check_indexes():
+    """EXPLAIN every query in db.QUERIES.
+
+    Returns a dict {query_name: [problem, ...]} of the queries that fall
+    back to a full scan or filesort (empty when all is well), or None if
+    the database is unavailable.
+    """
+    conn = db.get_connection(validate=True)
+    if not conn:
+        print("❌ Cannot check indexes: database unavailable")
+        return None
+
+    sqlite = db.get_backend().name == 'sqlite'
+    failures = {}
+    try:
+        cursor = conn.cursor(dictionary=not sqlite)
+        for name, sql in db.QUERIES.items():
+            if name not in EXPLAIN_PARAMS:
+                failures[name] = ["no sample parameters in migrations.EXPLAIN_PARAMS"]
+                continue
+            if sqlite:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, EXPLAIN_PARAMS[name])
+                problems = _sqlite_plan_problems(cursor.fetchall())
+            else:
+                cursor.execute("EXPLAIN " + sql, EXPLAIN_PARAMS[name])
+                problems = _plan_problems(cursor.fetchall())
+            if problems:
+                failures[name] = problems
+        cursor.close()
+        conn.rollback()
+        return failures
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+
+if __name__ == "__main__":
+    if not db.wait_until_ready(timeout=30):
+        print("❌ Database did not become reachable")
+        raise SystemExit(1)
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        failures = check_indexes()
+        if failures is None:
+            raise SystemExit(1)
+        for name, problems in failures.items():
+            print(f"❌ {name}: {'; '.join(problems)}")
+        if failures:
+            raise SystemExit(1)
+        print(f"✅ All {len(db.QUERIES)} queries use indexes")
+    else:
+        applied = migrate()
+        if applied is None:
+            raise SystemExit(1)
+        print(f"✅ Schema up to date ({len(applied)} migration(s) applied)")
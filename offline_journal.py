@@ -0,0 +1,111 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+
+# Local store-and-forward journal for writes made while MySQL is unreachable.
+# Each database gets its own file in JOURNAL_DIR (see journal_path), so rows
+# journaled against one database are never replayed into another.
+JOURNAL_DIR = os.environ.get('KPIT_JOURNAL_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+def journal_path(database):
+    """Journal file for `database`, a name identifying the backend and database"""
+    return os.path.join(JOURNAL_DIR, f"offline_journal.{re.sub(r'[^A-Za-z0-9_.-]+', '_', database)}.sqlite3")
+
+class OfflineJournal:
+    """Append-only SQLite journal of signal rows and PWF changes.
+
+    Entries keep their insertion order and are removed only after they
+    have been replayed to MySQL. Every entry carries the event ids used by
+    the replay, so replaying the same entry twice is harmless. An entry
+    the database rejects is moved to the quarantine table instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS quarantine (
+                seq INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                error TEXT,
+                quarantined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self._conn.commit()
+
+    def append_rows(self, rows):
+        """Journal (signal_name, value, source, timestamp, protocol, event_id) rows"""
+        payload = [
+            [signal_name, value, source, _format_timestamp(timestamp), protocol, event_id]
+            for signal_name, value, source, timestamp, protocol, event_id in rows
+        ]
+        self._append('signals', payload)
+
+    def append_pwf_state(self, new_state, protocol, timestamp, event_id):
+        """Journal a PWF state change"""
+        self._append('pwf_state', [new_state, protocol, _format_timestamp(timestamp), event_id])
+
+    def _append(self, kind, payload):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO journal (kind, payload) VALUES (?, ?)",
+                (kind, json.dumps(payload))
+            )
+            self._conn.commit()
+
+    def pending_count(self):
+        """Number of journal entries waiting to be replayed"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+
+    def read(self, limit=500):
+        """Oldest entries as (seq, kind, payload) tuples"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, kind, payload FROM journal ORDER BY seq LIMIT ?", (limit,)
+            ).fetchall()
+        return [(seq, kind, json.loads(payload)) for seq, kind, payload in rows]
+
+    def remove_through(self, seq):
+        """Drop every entry up to and including `seq` once it has been replayed"""
+        with self._lock:
+            self._conn.execute("DELETE FROM journal WHERE seq <= ?", (seq,))
+            self._conn.commit()
+
+    def quarantine(self, seq, kind, payload, error):
+        """Move an entry the database rejected out of the replay order"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO quarantine (seq, kind, payload, error) VALUES (?, ?, ?, ?)",
+                (seq, kind, json.dumps(payload), str(error))
+            )
+            self._conn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self._conn.commit()
+
+    def quarantined(self):
+        """Quarantined entries as (seq, kind, payload, error) tuples"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, kind, payload, error FROM quarantine ORDER BY seq"
+            ).fetchall()
+        return [(seq, kind, json.loads(payload), error) for seq, kind, payload, error in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def _format_timestamp(timestamp):
+    if hasattr(timestamp, 'isoformat'):
+        return timestamp.isoformat(sep=' ')
+    return timestamp
@@ -0,0 +1,203 @@
+import os
+import sys
+from datetime import datetime, timedelta, date
+import db
+from signal_archive import (
+    ARCHIVE_DIR, month_start, next_month, partition_name, archive_path, write_archive
+)
+
+# signals_log retention job.
+#
+#   python retention.py            archive and drop months older than
+#                                  KPIT_RETENTION_DAYS, add future partitions
+#   python retention.py --dry-run  only list what would be archived
+#
+# Each month goes to ARCHIVE_DIR/signals_log_YYYYMM.jsonl.gz before its
+# partition is dropped; db.get_signal_history(include_archive=True) still
+# reads it. signal_state_current keeps the latest values, so dropping old
+# rows never changes what the panels show.
+
+RETENTION_DAYS = int(os.environ.get('KPIT_RETENTION_DAYS', '90'))
+FUTURE_MONTHS = 2  # Partitions kept ready ahead of the current month
+EXPORT_BATCH = 5000
+
+_ARCHIVE_SELECT = "SELECT id, signal_name, value, source, protocol, timestamp, event_id FROM signals_log"
+
+def _from_to_days(value):
+    # MySQL's TO_DAYS counts from year 0, Python ordinals from year 1
+    days = int(value)
+    return datetime.combine(date.fromordinal(days - 365), datetime.min.time())
+
+def get_partitions(cursor):
+    """(name, upper_bound) of the signals_log partitions, in order.
+
+    upper_bound is None for the MAXVALUE partition. Empty if the table is
+    not partitioned.
+    """
+    cursor.execute("""
+        SELECT partition_name, partition_description
+        FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = 'signals_log' AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position
+    """)
+    partitions = []
+    for name, description in cursor.fetchall():
+        bound = None if description in (None, 'MAXVALUE') else _from_to_days(description)
+        partitions.append((name, bound))
+    return partitions
+
+def ensure_future_partitions(cursor, months=FUTURE_MONTHS):
+    """Split pmax so the next `months` months each get their own partition"""
+    partitions = get_partitions(cursor)
+    bounds = [bound for _, bound in partitions if bound]
+    if not bounds or partitions[-1][1] is not None:
+        return []
+
+    wanted = month_start(datetime.now())
+    for _ in range(months + 1):
+        wanted = next_month(wanted)
+    added = []
+    bound = max(bounds)
+    while bound < wanted:
+        added.append(f"PARTITION {partition_name(bound)} VALUES LESS THAN (TO_DAYS('{next_month(bound):%Y-%m-%d}'))")
+        bound = next_month(bound)
+    if added:
+        maxvalue = partitions[-1][0]
+        cursor.execute(
+            f"ALTER TABLE signals_log REORGANIZE PARTITION {maxvalue} INTO "
+            f"({', '.join(added)}, PARTITION {maxvalue} VALUES LESS THAN MAXVALUE)"
+        )
+    return added
+
+def _expired_months(cursor, cutoff, partitioned):
+    """(month, partition or None) whose rows are all older than `cutoff`"""
+    if partitioned:
+        return [
+            (month_start(bound - timedelta(days=1)), name)
+            for name, bound in get_partitions(cursor)
+            if bound and bound <= cutoff
+        ]
+
+    cursor.execute("SELECT MIN(timestamp) FROM signals_log")
+    oldest = cursor.fetchone()[0]
+    if isinstance(oldest, str):
+        oldest = datetime.fromisoformat(oldest)
+    months = []
+    month = month_start(oldest) if oldest else None
+    while month and next_month(month) <= cutoff:
+        months.append((month, None))
+        month = next_month(month)
+    return months
+
+def _export_batches(cursor, month, partition):
+    """Rows of one month as dict batches, walked by id"""
+    last_id = 0
+    while True:
+        if partition:
+            cursor.execute(
+                f"{_ARCHIVE_SELECT} PARTITION ({partition}) WHERE id > %s ORDER BY id LIMIT %s",
+                (last_id, EXPORT_BATCH)
+            )
+        else:
+            cursor.execute(
+                f"{_ARCHIVE_SELECT} WHERE timestamp >= %s AND timestamp < %s AND id > %s ORDER BY id LIMIT %s",
+                (month, next_month(month), last_id, EXPORT_BATCH)
+            )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+def _count_rows(cursor, month, partition):
+    if partition:
+        cursor.execute(f"SELECT COUNT(*) AS row_count FROM signals_log PARTITION ({partition})")
+    else:
+        cursor.execute(
+            "SELECT COUNT(*) AS row_count FROM signals_log WHERE timestamp >= %s AND timestamp < %s",
+            (month, next_month(month))
+        )
+    return cursor.fetchone()['row_count']
+
+def archive_month(conn, month, partition=None, archive_dir=None):
+    """Archive one month of signals_log and remove it from the table.
+
+    The rows are written to the archive file first; the partition (or, on
+    SQLite, the rows) is dropped only if the file holds every row.
+    Returns the number of rows archived, or None if the counts differ.
+    """
+    cursor = conn.cursor(dictionary=True)
+    path = archive_path(month, archive_dir)
+    written = write_archive(path, _export_batches(cursor, month, partition))
+    present = _count_rows(cursor, month, partition)
+    if present != written:
+        print(f"❌ {month:%Y-%m}: archived {written} rows but {present} are in the table; not dropping")
+        cursor.close()
+        conn.rollback()
+        return None
+
+    if not written:
+        os.remove(path)  # Nothing to keep for an empty month
+
+    if partition:
+        cursor.execute(f"ALTER TABLE signals_log DROP PARTITION {partition}")
+    else:
+        cursor.execute(
+            "DELETE FROM signals_log WHERE timestamp >= %s AND timestamp < %s",
+            (month, next_month(month))
+        )
+    conn.commit()
+    cursor.close()
+    print(f"✅ Archived {written} rows of {month:%Y-%m}" + (f" to {path}" if written else ""))
+    return written
+
+def run_retention(retention_days=RETENTION_DAYS, archive_dir=None, dry_run=False):
+    """Archive every month older than `retention_days` and keep future partitions ready.
+
+    Returns a list of (month, rows archived or None), or None if the
+    database is unavailable.
+    """
+    conn = db.get_connection(validate=True)
+    if not conn:
+        print("❌ Cannot run retention: database unavailable")
+        return None
+
+    partitioned = db.get_backend().name == 'mysql'
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    results = []
+    try:
+        cursor = conn.cursor()
+        if partitioned and not get_partitions(cursor):
+            print("❌ signals_log is not partitioned yet; run python migrations.py first")
+            return None
+        months = _expired_months(cursor, cutoff, partitioned)
+        if partitioned and not dry_run:
+            for added in ensure_future_partitions(cursor):
+                print(f"Added {added.split()[1]}")
+        cursor.close()
+        conn.rollback()
+
+        for month, partition in months:
+            if dry_run:
+                print(f"Would archive {month:%Y-%m}" + (f" (partition {partition})" if partition else ""))
+                results.append((month, None))
+                continue
+            results.append((month, archive_month(conn, month, partition, archive_dir)))
+        return results
+    except Exception as e:
+        print(f"❌ Retention failed: {e}")
+        conn.rollback()
+        return None
+    finally:
+        if conn and conn.is_connected():
+            conn.close()
+
+if __name__ == "__main__":
+    if not db.wait_until_ready(timeout=30):
+        print("❌ Database did not become reachable")
+        raise SystemExit(1)
+    dry_run = '--dry-run' in sys.argv[1:]
+    results = run_retention(dry_run=dry_run)
+    if results is None or (not dry_run and any(rows is None for _, rows in results)):
+        raise SystemExit(1)
+    print(f"✅ Retention done ({len(results)} month(s), archive dir {ARCHIVE_DIR})")
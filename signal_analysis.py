@@ -0,0 +1,200 @@
+from datetime import datetime
+import db
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the history arrays
+    np = None
+
+# Vectorized signal history.
+#
+# get_history() turns a time range of signals_log into NumPy arrays, one
+# SignalSeries per (signal_name, protocol). The helpers below work on
+# those arrays only, so they take milliseconds even over millions of
+# rows - fast enough for Robot verdicts and dashboards.
+#
+# Times are int64 microseconds since 1970-01-01 in the database's
+# wall-clock time, the same as export_history.py.
+
+# Values counted as the signal being active (LED lit, button pressed)
+ON_VALUES = ('on', 'pressed', '1', 'true')
+
+_EPOCH = np.datetime64('1970-01-01T00:00:00', 'us') if np is not None else None
+
+def to_micros(value):
+    """datetime, ISO string or microseconds to int64 microseconds"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return int((np.datetime64(value, 'us') - _EPOCH).astype(np.int64))
+    return int(value)
+
+def _micros_array(timestamps):
+    stamps = np.array(timestamps, dtype='datetime64[us]')
+    return (stamps - _EPOCH).astype(np.int64)
+
+class SignalSeries:
+    """History of one signal as parallel arrays.
+
+    timestamps: int64 microseconds, ascending
+    codes:      int32 index into `dictionary` for each change
+    initial:    value in force at `start` (from before the range), or None
+    """
+    def __init__(self, name, protocol, timestamps, codes, dictionary, start, end, initial=None):
+        self.name = name
+        self.protocol = protocol
+        self.timestamps = timestamps
+        self.codes = codes
+        self.dictionary = dictionary
+        self.start = start
+        self.end = end
+        self.initial = initial
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def values(self):
+        """Decoded values as a string array"""
+        return self.dictionary[self.codes]
+
+    def states(self, on_values=ON_VALUES):
+        """0/1 array: whether each change made the signal active"""
+        active = np.isin(self.dictionary, on_values)
+        return active[self.codes].astype(np.int8)
+
+    def initial_state(self, on_values=ON_VALUES):
+        return int(self.initial in on_values) if self.initial is not None else 0
+
+def _series(name, protocol, rows, start, end, initial):
+    """SignalSeries from (timestamp, value) rows"""
+    lookup = {}
+    codes = np.fromiter((lookup.setdefault(value, len(lookup)) for _, value in rows), dtype=np.int32, count=len(rows))
+    dictionary = np.array(list(lookup), dtype=str) if lookup else np.empty(0, dtype=str)
+    timestamps = _micros_array([timestamp for timestamp, _ in rows]) if rows else np.empty(0, dtype=np.int64)
+    return SignalSeries(name, protocol, timestamps, codes, dictionary, start, end, initial)
+
+def get_history(start, end=None, signals=db.TRACKED_SIGNALS, include_archive=False, archive_dir=None):
+    """Get a time range of signals as {(signal_name, protocol): SignalSeries}.
+
+    Each signal is one index range scan plus one lookup of the value in
+    force at `start`. With include_archive=True, months moved out by
+    retention.py are merged back in, for the starting values as well.
+    Returns None if the database is unavailable.
+    """
+    if np is None:
+        raise ImportError("numpy is required for the history arrays")
+    end = end or datetime.now()
+    changes = db.get_signal_history(start, end, signals, include_archive, archive_dir)
+    if changes is None:
+        return None
+    rows = {key: [] for key in signals}  # key -> [(timestamp, value)], oldest first
+    for row in changes:
+        rows[(row['signal_name'], row['protocol'])].append((row['timestamp'], row['value']))
+
+    initial = db.get_values_before(start, signals, include_archive, archive_dir)
+    if initial is None:
+        return None
+
+    start_us, end_us = to_micros(start), to_micros(end)
+    history = {}
+    for key, ordered in rows.items():
+        history[key] = _series(key[0], key[1], ordered, start_us, end_us, initial[key])
+    return history
+
+def series_from_export(export, signal_name, protocol, start=None, end=None):
+    """SignalSeries for one signal of an export_history.load_export() result"""
+    if np is None:
+        raise ImportError("numpy is required for the history arrays")
+    name_codes, name_dictionary = export['signal_name']
+    protocol_codes, protocol_dictionary = export['protocol']
+    value_codes, value_dictionary = export['value']
+    mask = (name_dictionary[name_codes] == signal_name) & (protocol_dictionary[protocol_codes] == protocol)
+
+    timestamps = export['timestamp']
+    start = to_micros(start) if start is not None else (int(timestamps.min()) if len(timestamps) else 0)
+    end = to_micros(end) if end is not None else (int(timestamps.max()) + 1 if len(timestamps) else 0)
+    initial = None
+    before = mask & (timestamps < start)
+    if before.any():
+        last = np.flatnonzero(before)[np.argmax(timestamps[before])]
+        initial = str(value_dictionary[value_codes[last]])
+
+    mask &= (timestamps >= start) & (timestamps < end)
+    order = np.argsort(timestamps[mask], kind='stable')
+    return SignalSeries(
+        signal_name, protocol, timestamps[mask][order], value_codes[mask][order].astype(np.int32),
+        value_dictionary, start, end, initial
+    )
+
+def _intervals(series, on_values=ON_VALUES):
+    """Change times with the range start prepended, the 0/1 state from each, and each state's duration"""
+    times = np.concatenate(([series.start], series.timestamps))
+    states = np.concatenate(([series.initial_state(on_values)], series.states(on_values)))
+    durations = np.diff(np.append(times, series.end))
+    return times, states, durations
+
+def on_time(series, on_values=ON_VALUES):
+    """Total seconds the signal was active within the range"""
+    _, states, durations = _intervals(series, on_values)
+    return float(np.sum(durations[states == 1])) / 1e6
+
+def duty_cycle(series, on_values=ON_VALUES):
+    """Fraction (0..1) of the range the signal was active"""
+    span = series.end - series.start
+    if span <= 0:
+        return 0.0
+    return on_time(series, on_values) * 1e6 / span
+
+def edges(series, rising=True, on_values=ON_VALUES):
+    """Timestamps where the signal became active (rising) or inactive (falling).
+
+    Rewrites of an unchanged value are not edges.
+    """
+    times, states, _ = _intervals(series, on_values)
+    change = np.diff(states)
+    return times[1:][change == (1 if rising else -1)]
+
+def toggle_count(series, on_values=ON_VALUES):
+    """Number of actual state changes within the range"""
+    _, states, _ = _intervals(series, on_values)
+    return int(np.count_nonzero(np.diff(states)))
+
+def toggle_frequency(series, on_values=ON_VALUES):
+    """State changes per second over the range"""
+    span = series.end - series.start
+    if span <= 0:
+        return 0.0
+    return toggle_count(series, on_values) * 1e6 / span
+
+def on_periods(series, on_values=ON_VALUES):
+    """Seconds of every separate active period (the last may be cut by the range end)"""
+    _, states, durations = _intervals(series, on_values)
+    # Merge consecutive active intervals (rewrites of 'on') into one period
+    period_ids = np.cumsum(np.diff(np.concatenate(([0], states))) == 1)
+    active = states == 1
+    if not active.any():
+        return np.empty(0)
+    return np.bincount(period_ids[active], weights=durations[active])[np.unique(period_ids[active])] / 1e6
+
+def press_to_led_latency(button, led, max_latency=None, on_values=ON_VALUES):
+    """Seconds from each button press to the next time the LED came on.
+
+    A press counts only if the LED came on before the following press (and
+    within `max_latency` seconds if given); the result has one entry per
+    answered press.
+    """
+    presses = edges(button, True, on_values)
+    lit = edges(led, True, on_values)
+    if not len(presses) or not len(lit):
+        return np.empty(0)
+
+    next_press = np.append(presses[1:], np.iinfo(np.int64).max)
+    following = np.searchsorted(lit, presses, side='left')
+    answered = following < len(lit)
+    presses, next_press, following = presses[answered], next_press[answered], following[answered]
+    latencies = lit[following] - presses
+
+    valid = lit[following] < next_press
+    if max_latency is not None:
+        valid &= latencies <= max_latency * 1e6
+    return latencies[valid] / 1e6
@@ -0,0 +1,74 @@
+import os
+import gzip
+import json
+from datetime import datetime
+
+# Compressed monthly archives of signals_log rows dropped by retention.py
+ARCHIVE_DIR = os.environ.get(
+    'KPIT_ARCHIVE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+)
+
+ARCHIVE_COLUMNS = ('id', 'signal_name', 'value', 'source', 'protocol', 'timestamp', 'event_id')
+
+def month_start(value):
+    """First instant of the month containing `value`"""
+    return datetime(value.year, value.month, 1)
+
+def next_month(value):
+    """First instant of the month after the one containing `value`"""
+    if value.month == 12:
+        return datetime(value.year + 1, 1, 1)
+    return datetime(value.year, value.month + 1, 1)
+
+def partition_name(month):
+    """signals_log partition holding the rows of `month`, e.g. p202507"""
+    return f"p{month.year:04d}{month.month:02d}"
+
+def archive_path(month, archive_dir=None):
+    return os.path.join(archive_dir or ARCHIVE_DIR, f"signals_log_{month.year:04d}{month.month:02d}.jsonl.gz")
+
+def write_archive(path, batches):
+    """Write row dicts from `batches` (an iterable of lists) to a gzip JSON lines file.
+
+    The file only appears under its final name once complete. Returns the
+    number of rows written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    count = 0
+    with gzip.open(partial, 'wt', encoding='utf-8') as f:
+        for rows in batches:
+            for row in rows:
+                record = {column: row.get(column) for column in ARCHIVE_COLUMNS}
+                if hasattr(record['timestamp'], 'isoformat'):
+                    record['timestamp'] = record['timestamp'].isoformat(sep=' ')
+                f.write(json.dumps(record) + '\n')
+                count += 1
+    os.replace(partial, path)
+    return count
+
+def read_archive(path):
+    """Yield the row dicts of an archive file, timestamps as datetimes"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            yield row
+
+def list_archives(archive_dir=None):
+    """(month_start, path) of every archive file, oldest first"""
+    archive_dir = archive_dir or ARCHIVE_DIR
+    if not os.path.isdir(archive_dir):
+        return []
+    archives = []
+    for name in os.listdir(archive_dir):
+        if not (name.startswith('signals_log_') and name.endswith('.jsonl.gz')):
+            continue
+        stamp = name[len('signals_log_'):-len('.jsonl.gz')]
+        try:
+            month = datetime(int(stamp[:4]), int(stamp[4:6]), 1)
+        except ValueError:
+            continue
+        archives.append((month, os.path.join(archive_dir, name)))
+    return sorted(archives)
@@ -0,0 +1,218 @@
+import sys
+import time
+import db
+from change_relay import (
+    ChangeRelay, RelayClient, RELAY_HOST, RELAY_PORT, POLL_INTERVAL, HEARTBEAT_INTERVAL, encode_message
+)
+
+# Central state-sync hub.
+#
+#   python state_hub.py                  hub on KPIT_RELAY_PORT
+#   python state_hub.py --interval 0.02  poll signals_log every 20 ms
+#
+# The hub is a change_relay.py that also keeps the panel state in memory.
+# It is the only process that polls the database. A subscribing panel gets
+# the full state once and then only the fields that changed. Panels publish
+# their own updates to the hub, which forwards them to every other panel,
+# so each update costs one datagram per panel instead of one per pair of
+# panels. Plain relay subscribers (main1.py) keep getting signals_log rows.
+#
+# Panels use the hub when one answers on KPIT_RELAY_HOST and otherwise
+# fall back to direct mode: polling the database and gossiping with peers.
+#
+# Extra messages on top of change_relay.py:
+#   panel -> hub   {'type': 'subscribe', 'mode': 'state'}
+#                  {'type': 'resync'}                  ask for the full state again
+#                  {'type': 'publish', 'message': {...}}
+#   hub -> panel   {'type': 'hub_state', 'seq': n, 'full': bool, 'state': {...}}
+#                  {'type': 'hub_heartbeat', 'seq': n, 'db_online': bool}
+#                  {'type': 'peer_update', 'message': {...}}
+# 'state' holds pwf_state, pwf_version, change_id (newest signals_log id
+# it includes) and one value per tracked signal name; deltas only hold the
+# fields that changed. seq counts deltas, so a
+# panel that misses one asks for a resync.
+
+def state_from_snapshot(snapshot):
+    """Hub state dict from db.get_state_snapshot()"""
+    state = {
+        'pwf_state': snapshot['pwf_state'],
+        'pwf_version': snapshot['pwf_version'],
+        'change_id': snapshot['change_id'],
+    }
+    for signal_name, protocol in db.TRACKED_SIGNALS:
+        state[signal_name] = snapshot['signals'].get((signal_name, protocol))
+    return state
+
+class StateHub(ChangeRelay):
+    """ChangeRelay that keeps the authoritative panel state and fans out deltas"""
+    def __init__(self, host='0.0.0.0', port=RELAY_PORT, interval=POLL_INTERVAL):
+        super().__init__(host, port, interval)
+        self.state = None
+        self.seq = 0
+        self.db_online = False
+        self.state_subscribers = set()
+        self.stats.update({'deltas': 0, 'resyncs': 0, 'forwarded': 0})
+
+    def _handle_message(self, message, addr):
+        kind = message.get('type')
+        if kind == 'subscribe' and message.get('mode') == 'state':
+            new = addr not in self.subscribers
+            self.subscribers[addr] = time.monotonic()
+            self.state_subscribers.add(addr)
+            if new:
+                print(f"Panel subscribed to state: {addr[0]}:{addr[1]}")
+                self._send_full(addr)
+        elif kind == 'resync' and addr in self.state_subscribers:
+            self.stats['resyncs'] += 1
+            self._send_full(addr)
+        elif kind == 'publish' and addr in self.state_subscribers:
+            forward = encode_message({'type': 'peer_update', 'message': message.get('message')})
+            for target in list(self.state_subscribers):
+                if target != addr:
+                    self._send(target, forward)
+                    self.stats['forwarded'] += 1
+        else:
+            if kind == 'unsubscribe':
+                self.state_subscribers.discard(addr)
+            super()._handle_message(message, addr)
+
+    def _expire_subscribers(self):
+        super()._expire_subscribers()
+        self.state_subscribers &= set(self.subscribers)
+
+    def _row_subscribers(self):
+        return [addr for addr in self.subscribers if addr not in self.state_subscribers]
+
+    def _poll(self):
+        rows = super()._poll()
+        self.db_online = rows is not None
+        if self.db_online and self.state is None:
+            self._refresh_state()
+        return rows
+
+    def _push_rows(self, after_id, rows, targets=None):
+        super()._push_rows(after_id, rows, self._row_subscribers())
+        if self.state is None:
+            return
+        changed = {}
+        for row in rows:
+            if row['signal_name'] == 'pwf_state_change':
+                # The new version is only in pwf_state
+                changed.update(self._refresh_state(send=False))
+            elif (row['signal_name'], row['protocol']) in db.TRACKED_SIGNALS:
+                if self.state[row['signal_name']] != row['value']:
+                    self.state[row['signal_name']] = row['value']
+                    changed[row['signal_name']] = row['value']
+        self.state['change_id'] = changed['change_id'] = rows[-1]['id']
+        self._send_delta(changed)
+
+    def _heartbeat(self, targets=None):
+        super()._heartbeat(self._row_subscribers())
+        seq = self.seq if self.state is not None else None  # None: no state to sync yet
+        self._broadcast({'type': 'hub_heartbeat', 'seq': seq, 'db_online': self.db_online},
+                        self.state_subscribers)
+
+    def _refresh_state(self, send=True):
+        """Reload the state from the database. Returns the fields that changed"""
+        snapshot = db.get_state_snapshot()
+        if snapshot is None:
+            return {}
+        state = state_from_snapshot(snapshot)
+        if self.state is None:
+            self.state = state
+            for addr in list(self.state_subscribers):
+                self._send_full(addr)
+            return {}
+        changed = {key: value for key, value in state.items() if self.state.get(key) != value}
+        self.state = state
+        if send and changed:
+            self._send_delta(changed)
+        return changed
+
+    def _send_delta(self, changed):
+        self.seq += 1
+        self.stats['deltas'] += 1
+        self._broadcast({'type': 'hub_state', 'seq': self.seq, 'full': False, 'state': changed},
+                        self.state_subscribers)
+
+    def _send_full(self, addr):
+        if self.state is None:
+            return  # Sent once the database answers
+        self._send(addr, {'type': 'hub_state', 'seq': self.seq, 'full': True, 'state': self.state})
+
+class HubClient(RelayClient):
+    """Panel side of the hub.
+
+    on_state(state, full) gets the full state after subscribing or a
+    resync, and the changed fields otherwise. on_peer_update(message) gets
+    updates published by other panels. Against a plain change_relay.py the
+    client still hands rows to on_changes, and `hub_mode` stays False.
+    """
+    def __init__(self, on_state, on_peer_update, on_changes, on_status=None, on_gap=None,
+                 host=RELAY_HOST, port=RELAY_PORT):
+        super().__init__(on_changes, on_status, on_gap, host, port)
+        self.on_state = on_state
+        self.on_peer_update = on_peer_update
+        self.subscribe_message = {'type': 'subscribe', 'mode': 'state'}
+        self.hub_mode = False
+        self.db_online = False
+        self.seq = None
+        self._last_resync = 0.0
+
+    def publish(self, message):
+        """Send a state update to every other panel through the hub. Returns False in direct mode"""
+        if not (self.running and self.hub_mode):
+            return False
+        self._send({'type': 'publish', 'message': message})
+        return True
+
+    def resync(self):
+        """Ask the hub for the full state"""
+        now = time.monotonic()
+        if not self.running or now - self._last_resync < HEARTBEAT_INTERVAL:
+            return  # One request is already on its way
+        self._last_resync = now
+        self._send({'type': 'resync'})
+
+    def _handle_message(self, message):
+        kind = message.get('type')
+        if kind == 'hub_state':
+            self.hub_mode = True
+            if message['full']:
+                self.seq = message['seq']
+                self.on_state(message['state'], True)
+            elif self.seq is not None and message['seq'] == self.seq + 1:
+                self.seq = message['seq']
+                self.on_state(message['state'], False)
+            elif self.seq is None or message['seq'] > self.seq:
+                self.resync()  # Missed a delta
+        elif kind == 'hub_heartbeat':
+            self.hub_mode = True
+            self.db_online = message['db_online']
+            if message['seq'] is not None and message['seq'] != self.seq:
+                self.resync()
+        elif kind == 'peer_update':
+            self.on_peer_update(message['message'])
+        else:
+            super()._handle_message(message)
+
+    def _set_connected(self, connected):
+        if not connected:
+            self.hub_mode = False
+            self.db_online = False
+            self.seq = None
+        super()._set_connected(connected)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    port = int(args[args.index('--port') + 1]) if '--port' in args else RELAY_PORT
+    interval = float(args[args.index('--interval') + 1]) if '--interval' in args else POLL_INTERVAL
+    db.warm_up()
+    hub = StateHub(port=port, interval=interval)
+    if not hub.bind():
+        raise SystemExit(1)
+    print(f"✅ State hub listening on UDP {port}, polling every {interval * 1000:.0f} ms")
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        hub.stop()
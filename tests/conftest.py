@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# The modules under test live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('KPIT_DB_BACKEND', 'sqlite')
+
+import db
+import offline_journal
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Fresh SQLite store, with its offline journal in the test's directory"""
+    monkeypatch.setattr(offline_journal, 'JOURNAL_DIR', str(tmp_path))
+    backend = db.configure('sqlite', path=str(tmp_path / 'kpit.sqlite3'))
+    yield backend
+    db.flush_writes()
+    for journal in db._journals.values():
+        journal.close()
+    db._journals.clear()
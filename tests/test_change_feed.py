@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import db
+
+def _insert(*rows):
+    """Insert (id, signal_name, value) rows with explicit ids"""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO signals_log (id, signal_name, value, source, timestamp, protocol) VALUES (%s, %s, %s, 'GUI', %s, 'CAN')",
+            [(row_id, name, value, datetime(2026, 10, 18, 10)) for row_id, name, value in rows]
+        )
+        conn.commit()
+        cursor.close()
+
+def test_poll_advances_the_cursor(sqlite_db):
+    _insert((1, 'led', 'on'))
+    feed = db.ChangeFeed()
+    assert feed.poll() == []  # Starts at the newest row
+    assert feed.last_id == 1
+
+    _insert((2, 'led', 'off'), (3, 'button', 'pressed'))
+    assert [row['id'] for row in feed.poll()] == [2, 3]
+    assert feed.last_id == 3
+    assert feed.poll() == []
+
+def test_row_committed_out_of_id_order_is_delivered(sqlite_db):
+    feed = db.ChangeFeed(last_id=0)
+    _insert((1, 'led', 'on'), (3, 'led', 'off'))
+    assert [row['id'] for row in feed.poll()] == [1, 3]
+
+    # Id 2 was handed out before 3 but its transaction committed later
+    _insert((2, 'button', 'pressed'))
+    assert [row['id'] for row in feed.poll()] == [2]
+    assert feed.last_id == 3
+    assert feed.poll() == []
+
+def test_rows_outside_the_window_are_not_reread(sqlite_db):
+    feed = db.ChangeFeed(last_id=0, reread=2)
+    _insert((1, 'led', 'on'), (5, 'led', 'off'))
+    assert [row['id'] for row in feed.poll()] == [1, 5]
+    _insert((2, 'led', 'on'), (4, 'led', 'on'))
+    assert [row['id'] for row in feed.poll()] == [4]
+
+def test_skipped_rows_are_not_returned(sqlite_db):
+    feed = db.ChangeFeed(last_id=0)
+    _insert((1, 'led', 'on'), (2, 'led', 'off'))
+    feed.skip([{'id': 1}, {'id': 2}])  # e.g. pushed by the relay
+    assert feed.last_id == 2
+    assert feed.poll() == []
@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import pytest
+
+import db
+import export_history
+
+np = pytest.importorskip('numpy')
+
+@pytest.fixture
+def logged(sqlite_db):
+    rows = [('led', 'on', 'GUI', datetime(2026, 10, 18, 10), 'CAN', 'export-1'),
+            ('led', 'off', None, datetime(2026, 10, 18, 11), 'LIN', 'export-2')]
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        db.insert_signal_rows(cursor, rows)
+        conn.commit()
+        cursor.close()
+    return rows
+
+@pytest.mark.parametrize('fmt', ['parquet', 'npz'])
+def test_round_trip_with_null_source(logged, tmp_path, fmt):
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+    assert export_history.export(str(tmp_path), fmt) == 2
+
+    loaded = export_history.load_export(str(tmp_path))
+    decoded = {}
+    for name in export_history.DICTIONARY_COLUMNS:
+        codes, dictionary = loaded[name]
+        decoded[name] = list(dictionary[codes])
+    assert decoded['source'] == ['GUI', '']
+    assert decoded['value'] == ['on', 'off']
+    assert decoded['protocol'] == ['CAN', 'LIN']
+    assert list(loaded['timestamp']) == [export_history.to_micros(row[3]) for row in logged]
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import pytest
+
+import db
+from signal_archive import archive_path, write_archive
+
+def _log(rows):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            db.insert_signal_rows(cursor, rows)
+        finally:
+            conn.commit()
+            cursor.close()
+
+@pytest.fixture
+def history(sqlite_db, tmp_path):
+    # June has been moved out by retention, July is still in signals_log
+    _log([('led', 'on', 'GUI', datetime(2026, 6, 30, 23, 0), 'CAN', 'archived-1')])
+    archived = db.get_signal_history(datetime(2026, 6, 1), datetime(2026, 7, 1), [('led', 'CAN')])
+    write_archive(archive_path(datetime(2026, 6, 1), str(tmp_path)), [archived])
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM signals_log WHERE event_id = 'archived-1'")
+        conn.commit()
+        cursor.close()
+    _log([('led', 'off', 'GUI', datetime(2026, 7, 1, 1, 0), 'CAN', 'live-1'),
+          ('led', 'on', 'GUI', datetime(2026, 7, 1, 2, 0), 'CAN', 'live-2')])
+    return str(tmp_path)
+
+def test_signal_history_merges_archives(history):
+    start, end = datetime(2026, 6, 1), datetime(2026, 8, 1)
+    assert [row['value'] for row in db.get_signal_history(start, end, [('led', 'CAN')])] == ['off', 'on']
+    rows = db.get_signal_history(start, end, [('led', 'CAN')], include_archive=True, archive_dir=history)
+    assert [row['value'] for row in rows] == ['on', 'off', 'on']
+
+def test_analysis_history_uses_archives(history):
+    pytest.importorskip('numpy')
+    import signal_analysis
+
+    series = signal_analysis.get_history(datetime(2026, 6, 1), datetime(2026, 8, 1), [('led', 'CAN')],
+                                         include_archive=True, archive_dir=history)[('led', 'CAN')]
+    assert list(series.values()) == ['on', 'off', 'on']
+    assert series.initial is None
+
+def test_starting_values_come_from_archives(history):
+    signals = [('led', 'CAN')]
+    just_after = datetime(2026, 7, 1)  # June is only in the archive
+    assert db.get_values_before(just_after, signals) == {('led', 'CAN'): None}
+    assert db.get_values_before(just_after, signals, include_archive=True, archive_dir=history) == {('led', 'CAN'): 'on'}
+    inside = datetime(2026, 6, 30, 23, 30)
+    assert db.get_values_before(inside, signals, include_archive=True, archive_dir=history) == {('led', 'CAN'): 'on'}
+    # A live row before `start` is newer than anything archived
+    later = datetime(2026, 7, 1, 1, 30)
+    assert db.get_values_before(later, signals, include_archive=True, archive_dir=history) == {('led', 'CAN'): 'off'}
+
+def test_analysis_starts_from_archived_state(history):
+    pytest.importorskip('numpy')
+    import signal_analysis
+
+    series = signal_analysis.get_history(datetime(2026, 7, 1), datetime(2026, 7, 2), [('led', 'CAN')],
+                                         include_archive=True, archive_dir=history)[('led', 'CAN')]
+    assert series.initial == 'on'
+    assert series.initial_state() == 1
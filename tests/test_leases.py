@@ -0,0 +1,13 @@
+import db
+
+def test_utilisation_lists_held_leases(sqlite_db):
+    conn = db.get_connection()
+    try:
+        utilisation = db.get_pool_utilisation()
+        assert utilisation['in_use'] == 1
+        [lease] = utilisation['active_leases']
+        assert 'test_utilisation_lists_held_leases' in lease['borrower']
+        assert isinstance(utilisation['leases'], int)
+    finally:
+        conn.close()
+    assert db.get_pool_utilisation()['active_leases'] == []
@@ -0,0 +1,81 @@
+import os
+import socket
+import time
+from functools import partial
+
+import pytest
+
+pytest.importorskip('PyQt5')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication
+
+from components import Manual, socket_manager
+from components.socket_manager import SocketManager
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+def _wait_for(condition, timeout=5.0):
+    app = QApplication.instance()
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    return condition()
+
+@pytest.fixture
+def make_panel(sqlite_db, monkeypatch):
+    """Panels on this machine, on a loopback multicast group"""
+    app = QApplication.instance() or QApplication([])
+    monkeypatch.setattr(socket_manager, 'DISCOVERY_INTERVAL', 0.2)
+    monkeypatch.setattr(Manual, 'SocketManager', partial(
+        SocketManager, port=_free_port(), broadcast_port=_free_port(),
+        multicast_group='239.255.43.99', multicast_interface='127.0.0.1'
+    ))
+    windows = []
+    def make():
+        windows.append(Manual.ManualWindow())
+        return windows[-1]
+    yield make
+    for window in windows:
+        window.close()
+    app.processEvents()
+
+@pytest.fixture
+def panels(make_panel):
+    return [make_panel(), make_panel()]
+
+def test_panels_on_one_machine_apply_each_others_updates(panels):
+    first, second = panels
+    assert first.source != second.source
+    assert first.socket_manager.multicast and second.socket_manager.multicast
+    assert _wait_for(lambda: first.socket_manager.peers and second.socket_manager.peers)
+
+    first.current_pwf_state = 'W'
+    first.broadcast_state()
+    assert _wait_for(lambda: second.current_pwf_state == 'W')
+
+    second.toggle_btn.current_led_state = 'on'
+    second.broadcast_state()
+    assert _wait_for(lambda: first.toggle_btn.current_led_state == 'on')
+
+def test_sequences_are_kept_per_panel_instance(make_panel, monkeypatch):
+    ahead, behind, receiver = make_panel(), make_panel(), make_panel()
+    sent = {ahead: [], behind: []}
+    for sender, messages in sent.items():
+        monkeypatch.setattr(sender.socket_manager, 'send_update', messages.append)
+    for panel in (ahead, behind, receiver):
+        panel.current_pwf_state = 'W'  # LED updates apply in W
+
+    for _ in range(3):
+        ahead.broadcast_state(keyframe=True)
+    behind.toggle_btn.current_led_state = 'on'
+    behind.broadcast_state()
+    assert [message['seq'] for message in sent[ahead]] == [1, 2, 3]
+    assert [message['seq'] for message in sent[behind]] == [1]
+
+    for message in sent[ahead] + sent[behind]:
+        receiver.handle_socket_update(message)
+    assert receiver.toggle_btn.current_led_state == 'on'
@@ -0,0 +1,34 @@
+from datetime import datetime
+import pytest
+import migrations
+
+class ScriptedCursor:
+    """Cursor recording statements and answering fetchone() from a script"""
+    def __init__(self, results):
+        self.results = list(results)
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append(' '.join(sql.split()))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+def test_partitioning_converts_a_timestamp_column():
+    cursor = ScriptedCursor([(0,), ('timestamp', 'NO', 6, 'CURRENT_TIMESTAMP(6)'), (datetime(2025, 6, 3),)])
+    migrations.partition_by_month('signals_log', 'timestamp')(cursor)
+
+    modify = "ALTER TABLE signals_log MODIFY timestamp DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)"
+    assert modify in cursor.statements
+    partition = next(i for i, sql in enumerate(cursor.statements) if 'PARTITION BY RANGE' in sql)
+    assert cursor.statements.index(modify) < partition
+
+def test_partitioning_leaves_a_datetime_column_alone():
+    cursor = ScriptedCursor([(0,), ('datetime', 'NO', 6, 'CURRENT_TIMESTAMP(6)'), (None,)])
+    migrations.partition_by_month('signals_log', 'timestamp')(cursor)
+    assert not any('MODIFY' in sql for sql in cursor.statements)
+
+def test_partitioning_rejects_other_column_types():
+    cursor = ScriptedCursor([(0,), ('varchar', 'NO', None, None)])
+    with pytest.raises(ValueError, match='VARCHAR'):
+        migrations.partition_by_month('signals_log', 'timestamp')(cursor)
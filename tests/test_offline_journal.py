@@ -0,0 +1,39 @@
+from datetime import datetime
+import db
+
+def test_rejected_entry_is_quarantined(sqlite_db):
+    journal = db.get_journal()
+    now = datetime.now()
+    journal.append_rows([('led', None, 'GUI', now, 'CAN', 'bad-event')])
+    journal.append_rows([('button', 'pressed', 'GUI', now, 'CAN', 'good-event')])
+    journal.append_pwf_state('W', 'CAN', now, 'pwf-event')
+
+    assert db.replay_journal() == 2
+    assert journal.pending_count() == 0
+    [(seq, kind, payload, error)] = journal.quarantined()
+    assert kind == 'signals' and payload[0][5] == 'bad-event'
+    assert 'NOT NULL' in error
+
+    snapshot = db.get_state_snapshot()
+    assert snapshot['pwf_state'] == 'W'
+    assert snapshot['signals'][('button', 'CAN')] == 'pressed'
+
+def test_writes_go_through_after_a_rejected_entry(sqlite_db):
+    db.get_journal().append_rows([('led', None, 'GUI', datetime.now(), 'CAN', 'bad-event')])
+    assert db.queue_signals([('led', 'on', 'CAN')], wait=True)
+    assert db.get_state_snapshot()['signals'][('led', 'CAN')] == 'on'
+
+def test_each_database_has_its_own_journal(sqlite_db, tmp_path):
+    db.get_journal().append_rows([('led', 'on', 'GUI', datetime.now(), 'CAN', 'first-db-event')])
+    first = db.get_journal().path
+
+    db.configure('sqlite', path=str(tmp_path / 'other.sqlite3'))
+    assert db.get_journal().path != first
+    assert db.get_journal().pending_count() == 0
+    assert db.replay_journal() == 0
+    assert db.get_state_snapshot()['signals'] == {}
+
+def test_in_memory_database_keeps_its_journal_in_memory(sqlite_db, tmp_path):
+    db.configure('sqlite', path=':memory:')
+    assert db.get_journal().path == ':memory:'
+    assert not list(tmp_path.glob('offline_journal.*'))
@@ -0,0 +1,15 @@
+import db
+
+def test_transition_applies_after_queued_writes(sqlite_db, monkeypatch):
+    # Keep the writes queued long enough for the transition to overtake them
+    monkeypatch.setattr(db.write_queue, 'flush_interval', 1.0)
+    assert db.set_pwf_state('W')
+    snapshot = db.get_state_snapshot()
+
+    db.queue_signals([('button', 'pressed', 'CAN'), ('led', 'on', 'CAN')])
+    assert db.set_pwf_state('P', expected_state='W', expected_version=snapshot['pwf_version'])
+
+    snapshot = db.get_state_snapshot()
+    assert snapshot['pwf_state'] == 'P'
+    assert snapshot['signals'][('led', 'CAN')] == 'off'
+    assert snapshot['signals'][('button', 'CAN')] == 'pressed'
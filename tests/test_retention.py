@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+
+import db
+import retention
+from signal_archive import list_archives, month_start
+
+def test_expired_month_moves_to_the_archive(sqlite_db, tmp_path):
+    old = datetime.now() - timedelta(days=400)
+    month = month_start(old)
+    recent = datetime.now() - timedelta(days=1)
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        db.insert_signal_rows(cursor, [('led', 'on', 'GUI', old, 'CAN', 'old-1'),
+                                       ('led', 'off', 'GUI', recent, 'CAN', 'recent-1')])
+        conn.commit()
+        cursor.close()
+
+    results = retention.run_retention(retention_days=90, archive_dir=str(tmp_path))
+    assert (month, 1) in results
+    assert [month for month, _ in list_archives(str(tmp_path))] == [month]
+
+    # signals_log only keeps the recent row; the archived one still shows in history
+    start = old - timedelta(days=1)
+    rows = db.get_signal_history(start, None, [('led', 'CAN')])
+    assert [row['value'] for row in rows] == ['off']
+    rows = db.get_signal_history(start, None, [('led', 'CAN')], include_archive=True, archive_dir=str(tmp_path))
+    assert [row['value'] for row in rows] == ['on', 'off']
@@ -0,0 +1,31 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import db
+
+def _insert(rows):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            return db.insert_signal_rows(cursor, rows)
+        finally:
+            conn.commit()
+            cursor.close()
+
+def test_duplicate_event_id_is_skipped(sqlite_db):
+    row = ('led', 'on', 'GUI', datetime(2026, 10, 18, 10), 'CAN', 'event-1')
+    assert _insert([row]) == 1
+    assert _insert([row]) == 0
+
+def test_invalid_log_row_raises(sqlite_db):
+    # Only event_id conflicts are skipped; a NOT NULL violation still fails
+    row = ('led', None, 'GUI', datetime(2026, 10, 18, 10), 'CAN', 'event-2')
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            with pytest.raises(sqlite3.IntegrityError):
+                cursor.execute(db.get_backend().insert_log_sql(1), row)
+        finally:
+            cursor.close()
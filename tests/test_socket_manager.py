@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+pytest.importorskip('PyQt5')
+from components.socket_manager import SocketManager, PEER_SEND_FAILURES
+
+class FailingSocket:
+    """Socket whose sends to `failing` hosts raise"""
+    def __init__(self, failing):
+        self.failing = failing
+        self.sent = []
+
+    def sendto(self, data, addr):
+        if addr[0] in self.failing:
+            raise OSError("Network is unreachable")
+        self.sent.append((data, addr))
+
+@pytest.fixture
+def manager():
+    manager = SocketManager(port=0)
+    manager.transport = object()  # _send_now only sends while a transport is open
+    return manager
+
+def test_peer_dropped_after_repeated_send_errors(manager):
+    lost = []
+    manager.peer_lost.connect(lost.append)
+    manager.peers.update({'10.0.0.2', '10.0.0.3'})
+    manager.socket = FailingSocket({'10.0.0.2'})
+    packets = [(b'update', (peer, manager.port)) for peer in ('10.0.0.2', '10.0.0.3')]
+
+    for _ in range(PEER_SEND_FAILURES - 1):
+        manager._send_now(packets)
+    assert manager.peers == {'10.0.0.2', '10.0.0.3'}
+
+    manager._send_now(packets)
+    assert manager.peers == {'10.0.0.3'}
+    assert lost == ['10.0.0.2']
+
+def test_failed_multicast_falls_back_to_unicast(manager):
+    manager.multicast_group = '239.255.43.21'
+    manager.peers.update({'10.0.0.2', '10.0.0.3'})
+    manager.socket = FailingSocket({'239.255.43.21'})
+
+    manager._send_now([(b'update', ('239.255.43.21', manager.port))])
+    assert sorted(addr[0] for _, addr in manager.socket.sent) == ['10.0.0.2', '10.0.0.3']
+
+def _heartbeat(instance_id):
+    return json.dumps({'type': 'discovery', 'id': instance_id, 'wire': [1, 2, 3]}).encode()
+
+def test_own_heartbeat_is_never_a_peer(manager):
+    manager.discovery_socket = FailingSocket(set())
+    # After a DHCP renew or a roam our heartbeats come from a new address
+    for address in ('10.0.0.5', '192.168.1.7'):
+        manager._on_discovery_datagram(_heartbeat(manager.instance_id), (address, manager.broadcast_port))
+    assert manager.peers == set()
+
+    # Another panel on this machine is a peer at the same address
+    manager._on_discovery_datagram(_heartbeat('other-panel'), ('192.168.1.7', manager.broadcast_port))
+    assert manager.peers == {'192.168.1.7'}
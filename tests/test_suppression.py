@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+import db
+
+START = datetime(2026, 10, 18, 10)
+
+def _queue(value, seconds):
+    assert db.queue_signals([('led', value, 'CAN')], timestamp=START + timedelta(seconds=seconds), wait=True)
+
+def _logged():
+    return [(row['value'], row['timestamp']) for row in db.get_changes(0)]
+
+def test_repeated_values_are_not_logged(sqlite_db, monkeypatch):
+    monkeypatch.setattr(db, 'HEARTBEAT_SECONDS', 0)
+    before = db.get_write_stats()['suppressed']
+    for seconds, value in enumerate(('on', 'on', 'off', 'off', 'on')):
+        _queue(value, seconds)
+    assert [value for value, _ in _logged()] == ['on', 'off', 'on']
+    assert db.get_write_stats()['suppressed'] - before == 2
+    assert db.get_state_snapshot()['signals'][('led', 'CAN')] == 'on'
+
+def test_repeat_is_logged_as_heartbeat_after_the_interval(sqlite_db, monkeypatch):
+    monkeypatch.setattr(db, 'HEARTBEAT_SECONDS', 60)
+    before = db.get_write_stats()['heartbeats']
+    _queue('on', 0)
+    _queue('on', 30)   # Within the interval: dropped
+    _queue('on', 60)   # A heartbeat
+    _queue('on', 90)   # Within the interval of that heartbeat: dropped
+    assert _logged() == [('on', START), ('on', START + timedelta(seconds=60))]
+    assert db.get_write_stats()['heartbeats'] - before == 1
+
+def test_repeats_within_one_batch_are_dropped(sqlite_db, monkeypatch):
+    monkeypatch.setattr(db, 'HEARTBEAT_SECONDS', 0)
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        rows = [('led', value, 'GUI', START + timedelta(seconds=i), 'CAN') for i, value in enumerate(('on', 'on', 'off'))]
+        kept, suppressed, heartbeats = db.suppress_unchanged(cursor, rows)
+        cursor.close()
+    assert [row[1] for row in kept] == ['on', 'off']
+    assert (suppressed, heartbeats) == (1, 0)
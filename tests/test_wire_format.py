@@ -0,0 +1,19 @@
+from components import wire_format
+
+def _keyframe(**extra):
+    message = {'type': 'state_update', 'led_state': 'on', 'ledL_state': 'off', 'button_state': 'not pressed',
+               'buttonL_state': 'pressed', 'pwf_state': 'W', 'protocol': 'CAN', 'source': 'GUI_test',
+               'epoch': 1760000000, 'seq': 4, 'keyframe': True, 'timestamp': '2026-10-18T10:00:00'}
+    message.update(extra)
+    return message
+
+def test_pwf_version_roundtrip():
+    for pwf_version in (12, None):
+        message = _keyframe(pwf_version=pwf_version)
+        assert wire_format.decode(wire_format.encode_state_update(message)) == message
+
+def test_older_versions_cannot_carry_pwf_version():
+    message = _keyframe(pwf_version=12)
+    assert wire_format.encode_state_update(message, 2) is None
+    plain = _keyframe()
+    assert wire_format.decode(wire_format.encode_state_update(plain, 2)) == plain
@@ -0,0 +1,72 @@
+import time
+
+import db
+
+class RecordingQueue(db.WriteBehindQueue):
+    """Write-behind queue that records its batches instead of writing them"""
+    def __init__(self, write_time=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.write_time = write_time
+        self.batches = []  # (time.monotonic() written, rows)
+
+    def _write(self, rows):
+        self.batches.append((time.monotonic(), rows))
+        time.sleep(self.write_time)
+        return True
+
+def _row(value, signal_name='led'):
+    return (signal_name, value, 'GUI', None, 'CAN')
+
+def test_leftover_rows_keep_their_flush_deadline():
+    queue = RecordingQueue(write_time=0.3, flush_interval=0.5, max_batch=3)
+    try:
+        queue.submit([_row('on'), _row('off')])
+        time.sleep(0.55)  # First batch is being written
+        queue.submit([_row('on', 'button'), _row('off', 'button')])
+        queued = time.monotonic()
+        assert queue.submit([_row('on', 'ledL'), _row('off', 'ledL')]).wait(3)
+
+        # The last rows wait behind the second batch, not a fresh interval after it
+        written, rows = queue.batches[2]
+        assert rows[0][0] == 'ledL'
+        assert written - queued < 0.5 + 0.1
+    finally:
+        queue.stop()
+
+def test_submits_within_the_interval_share_one_batch():
+    queue = RecordingQueue(flush_interval=0.2)
+    try:
+        tickets = [queue.submit([_row(value)]) for value in ('on', 'off', 'on')]
+        assert all(ticket.wait(2) for ticket in tickets)
+        assert [rows for _, rows in queue.batches] == [[_row('on'), _row('off'), _row('on')]]
+    finally:
+        queue.stop()
+
+def test_full_batches_keep_submit_order_and_submits_whole():
+    queue = RecordingQueue(flush_interval=0.2, max_batch=3)
+    try:
+        tickets = [queue.submit([_row('on', name), _row('off', name)]) for name in ('led', 'button', 'ledL')]
+        assert all(ticket.wait(2) for ticket in tickets)
+        assert [[row[0] for row in rows] for _, rows in queue.batches] == [
+            ['led', 'led'], ['button', 'button'], ['ledL', 'ledL']
+        ]
+    finally:
+        queue.stop()
+
+def test_flush_does_not_wait_for_the_interval():
+    queue = RecordingQueue(flush_interval=30)
+    try:
+        queue.submit([_row('on')])
+        started = time.monotonic()
+        assert queue.flush(2)
+        assert time.monotonic() - started < 1
+    finally:
+        queue.stop()
+
+def test_queued_rows_reach_signals_log_in_order(sqlite_db):
+    for value in ('on', 'off', 'on'):
+        db.queue_signals([('led', value, 'CAN')])
+    assert db.flush_writes()
+    rows = db.get_changes(0)
+    assert [row['value'] for row in rows] == ['on', 'off', 'on']
+    assert [row['id'] for row in rows] == sorted(row['id'] for row in rows)